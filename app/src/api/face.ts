@@ -60,9 +60,12 @@ export async function debugExtract(imageBase64: string): Promise<{ ok: boolean;
   return res.json();
 }
 
+export type DuplicateMatch = { student_id: string; similarity: number };
+
 export type EnrollResult =
   | { success: true; count: number }
-  | { success: false; reason: 'duplicate'; duplicate: { student_id: string; similarity: number } };
+  /** duplicate = คนที่คล้ายที่สุด, duplicates = ทุกคนที่อาจซ้ำ (เรียงจากคล้ายมากไปน้อย) */
+  | { success: false; reason: 'duplicate'; duplicate: DuplicateMatch; duplicates: DuplicateMatch[] };
 
 export async function enrollFace(
   userId: string,
@@ -92,7 +95,12 @@ export async function enrollFace(
   }
   const data = await res.json().catch(() => ({}));
   if (res.status === 409 && data?.duplicate) {
-    return { success: false, reason: 'duplicate', duplicate: data.duplicate };
+    return {
+      success: false,
+      reason: 'duplicate',
+      duplicate: data.duplicate,
+      duplicates: Array.isArray(data.duplicates) && data.duplicates.length ? data.duplicates : [data.duplicate],
+    };
   }
   if (!res.ok) {
     if (data.debug) {
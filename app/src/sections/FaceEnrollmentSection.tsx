@@ -263,6 +263,8 @@ export function FaceEnrollmentSection({ onBack, initialStudentId }: FaceEnrollme
     open: boolean;
     duplicateStudentId: string;
     similarity: number;
+    /** นักเรียนคนอื่นที่คล้ายรองลงมา (ไม่รวมคนแรก) */
+    others: { student_id: string; similarity: number }[];
     imageBase64: string;
   } | null>(null);
   const duplicateResolveRef = useRef<(() => void) | null>(null);
@@ -384,6 +386,7 @@ export function FaceEnrollmentSection({ onBack, initialStudentId }: FaceEnrollme
               open: true,
               duplicateStudentId: result.duplicate.student_id,
               similarity: result.duplicate.similarity,
+              others: result.duplicates.filter((d) => d.student_id !== result.duplicate.student_id),
               imageBase64: base64,
             });
           });
@@ -1064,6 +1067,18 @@ export function FaceEnrollmentSection({ onBack, initialStudentId }: FaceEnrollme
                 <strong className="text-amber-600">{duplicateDialog?.duplicateStudentId}</strong>{' '}
                 ถึง <strong className="text-amber-600">{Math.round((duplicateDialog?.similarity ?? 0) * 100)}%</strong>
               </p>
+              {duplicateDialog && duplicateDialog.others.length > 0 && (
+                <div className="text-sm">
+                  <p>และยังคล้ายกับนักเรียนรหัส:</p>
+                  <ul className="list-disc pl-5">
+                    {duplicateDialog.others.map((d) => (
+                      <li key={d.student_id}>
+                        <strong className="text-amber-600">{d.student_id}</strong> ({Math.round(d.similarity * 100)}%)
+                      </li>
+                    ))}
+                  </ul>
+                </div>
+              )}
               <p className="text-sm text-gray-600">
                 คุณต้องการบันทึกใบหน้านี้ต่อหรือไม่?
               </p>
@@ -1,35 +1,67 @@
 """Face enroll and recognize API."""
+import asyncio
 import base64
 import logging
 import os
+import tempfile
+import time
 import numpy as np
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse
 
 logger = logging.getLogger("face")
 
-from config import SIMILARITY_THRESHOLD, MIN_MARGIN, DATA_DIR, MIN_ENROLLMENTS_FOR_ATTENDANCE
+from config import (
+    SIMILARITY_THRESHOLD,
+    MIN_MARGIN,
+    DATA_DIR,
+    MIN_ENROLLMENTS_FOR_ATTENDANCE,
+    RECOGNIZE_BATCH_MAX_IMAGES,
+    DUPLICATE_TOP_K,
+    VIDEO_MAX_BYTES,
+)
 from services.face_service import (
     get_embedding_from_base64,
     get_embedding_from_base64_debug,
-    embedding_similarity,
+    get_embedding_from_bytes,
+    get_embeddings_from_base64_batch,
+    get_face_embeddings_from_base64,
+    embed_faces_batch,
     embedding_to_similarity,
     model_order_for_dim,
 )
 from repositories.embedding_store import (
-    add_embedding,
+    enroll_embedding,
     get_embeddings,
     get_count,
     remove_all,
     remove_by_index,
-    get_all_for_class,
     get_counts_for_class,
+    aget_class_gallery,
+    aget_embeddings_for_students,
+    get_user_index,
 )
+from repositories import gallery_index
+from repositories.gallery_index import ClassGallery, GalleryMatrix, best_two_from_scores, normalize_rows
+from core import metrics
+from core.executors import InferenceBusy, run_inference, run_io, submit_inference
+from services.assignment import max_weight_assignment
+from services.video_attendance import process_video
 from schemas.face import (
     EnrollRequest,
     EnrollResponse,
     RecognizeRequest,
     RecognizeResponse,
+    IdentifyRequest,
+    IdentifyResponse,
+    RecognizeBatchRequest,
+    RecognizeBatchResponse,
+    RecognizeGroupRequest,
+    RecognizeGroupResponse,
+    FaceBox,
+    FaceMatch,
+    RecognizeVideoResponse,
+    VideoStudent,
     CountResponse,
     EnrolledStudentsResponse,
     FaceCountsResponse,
@@ -39,60 +71,126 @@ from schemas.face import (
 router = APIRouter()
 
 
-def _check_duplicate(user_id: str, class_id: str, embedding: list[float], exclude_student_id: str) -> tuple[str, float] | None:
-    """If embedding matches another student, return (student_id, similarity).
-    ตรวจสอบที่ 95% (0.95) เพื่อแจ้งเตือนผู้ใช้"""
+def _duplicate_score(cosine: np.ndarray) -> np.ndarray:
+    """Display similarity (0-1) used by the duplicate warning, from cosine scores (`embedding_to_similarity`)."""
+    return np.clip((cosine + 1) / 2, 0, 1)
+
+
+async def _euclidean_duplicate_scores(
+    user_id: str, class_id: str, gallery: GalleryMatrix, embedding: list[float]
+) -> np.ndarray:
+    """Per-student best 128-d score, 1 - Euclidean distance on the raw stored vectors (like
+    `embedding_similarity`); the gallery only keeps normalized rows, which would change the distance."""
+    stored = await aget_embeddings_for_students(user_id, class_id, gallery.student_ids)
+    query = np.asarray(embedding, dtype=np.float64)
+    similarity = np.full(len(gallery.student_ids), -1.0)
+    for i, student_id in enumerate(gallery.student_ids):
+        rows = [e for e in stored.get(student_id) or [] if len(e) == query.size]
+        if rows:
+            distances = np.linalg.norm(np.asarray(rows, dtype=np.float64) - query, axis=1)
+            similarity[i] = np.clip(1 - distances.min(), 0, 1)
+    return similarity
+
+
+async def _find_duplicates(
+    user_id: str,
+    class_id: str,
+    gallery: ClassGallery,
+    embedding: list[float],
+    exclude_student_id: str,
+    top_k: int = DUPLICATE_TOP_K,
+) -> list[tuple[str, float]]:
+    """Other students whose face matches `embedding`: up to `top_k` (student_id, similarity), most similar first.
+    ตรวจสอบที่ 95% (0.95) เพื่อแจ้งเตือนผู้ใช้
+
+    One GEMV + segmented max against the cached class gallery; on a quantized gallery only students that
+    could reach the threshold within their error bound are re-scored from storage. 128-d galleries are
+    scored on the raw stored vectors (one storage query), exactly like `embedding_similarity`.
+    """
     dim = len(embedding)
     # ใช้ threshold 95% สำหรับการแจ้งเตือน (สูงกว่า threshold ปกติ)
     # เพื่อให้แจ้งเตือนเฉพาะกรณีที่คล้ายกันมากจริงๆ
+    threshold = 0.95
+    matrix = gallery.matrix(dim)
+    query = _normalize_query(embedding)
+    if matrix is None or query is None:
+        return []
     if dim == 128:
-        threshold = 0.95  # สำหรับ 128-dim models
-    elif dim == 4096:
-        threshold = 0.95  # สำหรับ 4096-dim models
+        # 128-d (face_recognition) ใช้ Euclidean บนเวกเตอร์ดิบเหมือนเดิม
+        similarity = await _euclidean_duplicate_scores(user_id, class_id, matrix, embedding)
     else:
-        threshold = 0.95  # สำหรับ Facenet512 (512-dim) และอื่นๆ
-    candidates = get_all_for_class(user_id, class_id)
-    for student_id, embs in candidates:
-        if student_id == exclude_student_id:
-            continue
-        for emb in embs:
-            sim = embedding_similarity(embedding, emb)
-            # แปลง similarity เป็น percentage (0-1) แล้วเปรียบเทียบกับ 0.95
-            similarity_score = embedding_to_similarity(sim, dim)
-            if similarity_score >= threshold:
-                return (student_id, similarity_score)
-    return None
-
-
-def _get_existing_dim_for_student(user_id: str, class_id: str, student_id: str) -> int | None:
-    """Return embedding dimension already stored for a student (first found)."""
-    records = get_embeddings(user_id, class_id, student_id)
-    for r in records:
-        emb = r.get("embedding")
-        if emb:
-            return len(emb)
-    return None
-
-
-def _get_dims_for_class(user_id: str, class_id: str) -> set[int]:
-    """Return all embedding dimensions stored for a class."""
-    dims: set[int] = set()
-    candidates = get_all_for_class(user_id, class_id)
-    for _, embs in candidates:
-        for emb in embs:
-            if emb:
-                dims.add(len(emb))
-    return dims
+        scores = matrix.student_scores(query)[0]
+        if matrix.quantized:
+            reachable = np.flatnonzero(_duplicate_score(scores + matrix.student_bounds()) >= threshold)
+            if reachable.size:
+                scores = matrix.rerank(query, scores, await _exact_rows(user_id, class_id, matrix, reachable))
+        similarity = _duplicate_score(scores)
+    if exclude_student_id in matrix.student_ids:
+        similarity[matrix.student_ids.index(exclude_student_id)] = -1.0
+    hits = np.flatnonzero(similarity >= threshold)
+    if hits.size > top_k:
+        hits = hits[np.argpartition(-similarity[hits], top_k - 1)[:top_k]]
+    hits = hits[np.argsort(-similarity[hits], kind="stable")]
+    return [(matrix.student_ids[int(i)], float(similarity[i])) for i in hits]
+
+
+async def _exact_rows(user_id: str, class_id: str, gallery: GalleryMatrix, indices) -> dict[str, np.ndarray]:
+    """Full-precision normalized rows for some gallery students (one storage query)."""
+    student_ids = [gallery.student_ids[int(i)] for i in indices]
+    return {
+        sid: normalize_rows(embs)
+        for sid, embs in (await aget_embeddings_for_students(user_id, class_id, student_ids)).items()
+        if embs
+    }
+
+
+async def _exact_best_two(
+    user_id: str,
+    class_id: str,
+    gallery: GalleryMatrix,
+    query_normalized: np.ndarray,
+    scores: np.ndarray,
+    query_dim: int,
+) -> tuple[str | None, float, float]:
+    """Best/second-best from one row of `student_scores()`, with the decision kept exact on quantized galleries.
+
+    A quantized score is within `student_bounds()` of the float32 one. The approximate result is used
+    as-is when no student can reach the threshold, or when the top two are unambiguous and the decision
+    is the same at both ends of the error interval (the rules are monotone in best and second).
+    Otherwise every student that could still be in the top two is re-scored at full precision.
+    """
+    best_student_id, best, second = best_two_from_scores(gallery.student_ids, scores)
+    if not gallery.quantized or scores.size == 0:
+        return best_student_id, best, second
+    bounds = gallery.student_bounds()
+    threshold = 0.4 if query_dim == 128 else SIMILARITY_THRESHOLD
+    if not np.any(scores + bounds >= threshold):
+        metrics.inc("gallery_rerank_total", outcome="skipped")
+        return best_student_id, best, second
+    candidates = gallery.ambiguous_students(scores)
+    if best_student_id is not None and len(candidates) <= 2:
+        i = int(np.argmax(scores))
+        others = [int(j) for j in candidates if j != i]
+        second_bound = float(bounds[others[0]]) if others else 0.0
+        identity_certain = all(scores[i] - bounds[i] > scores[j] + bounds[j] for j in others)
+        pessimistic = _decide_match(best_student_id, best - float(bounds[i]), second + second_bound, query_dim)
+        optimistic = _decide_match(best_student_id, best + float(bounds[i]), max(0.0, second - second_bound), query_dim)
+        if identity_certain and pessimistic.matched == optimistic.matched:
+            metrics.inc("gallery_rerank_total", outcome="skipped")
+            return best_student_id, best, second
+    metrics.inc("gallery_rerank_total", outcome="reranked")
+    refined = gallery.rerank(query_normalized, scores, await _exact_rows(user_id, class_id, gallery, candidates))
+    return best_two_from_scores(gallery.student_ids, refined)
 
 
 @router.get("/ping")
-def ping():
+async def ping():
     """ทดสอบว่า Backend เชื่อมต่อได้"""
     return {"ok": True, "message": "Backend เชื่อมต่อได้", "endpoint": "face-api"}
 
 
 @router.post("/debug-image")
-def debug_image(req: DebugImageRequest):
+async def debug_image(req: DebugImageRequest):
     """ทดสอบว่า backend สามารถรับรูปภาพได้ (ไม่บันทึกลง disk เพื่อความปลอดภัย)"""
     try:
         s = req.image_base64.strip()
@@ -107,109 +205,111 @@ def debug_image(req: DebugImageRequest):
 
 
 @router.post("/debug-extract")
-def debug_extract(req: DebugImageRequest):
+async def debug_extract(req: DebugImageRequest):
     """ทดสอบ extract embedding และ return error details เพื่อ debug"""
-    return get_embedding_from_base64_debug(req.image_base64 or "")
+    return await run_inference(get_embedding_from_base64_debug, req.image_base64 or "")
+
+
+async def _read_image_upload(request: Request) -> bytes:
+    """Encoded image of an upload request: the `image` part of a multipart form, or the raw body
+    (Content-Type image/jpeg, image/png or application/octet-stream)."""
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="ต้องแนบไฟล์รูปในฟิลด์ image")
+        image = await upload.read()
+    else:
+        image = await request.body()
+    if not image:
+        raise HTTPException(status_code=400, detail="ไม่มีข้อมูลรูปภาพ")
+    return image
 
 
 @router.post("/enroll", response_model=EnrollResponse)
-def enroll(req: EnrollRequest):
+async def enroll(req: EnrollRequest):
+    return await _enroll(req)
+
+
+@router.post("/enroll/upload", response_model=EnrollResponse)
+async def enroll_upload(
+    request: Request,
+    user_id: str,
+    class_id: str,
+    student_id: str,
+    allow_duplicate: bool = False,
+    force_new_model: bool = False,
+):
+    """เหมือน /enroll แต่ส่งรูปเป็นไฟล์ (multipart ฟิลด์ `image` หรือ body ดิบ image/jpeg) แทน base64 ใน JSON"""
+    image = await _read_image_upload(request)
+    req = EnrollRequest(
+        user_id=user_id,
+        class_id=class_id,
+        student_id=student_id,
+        image_base64="",
+        allow_duplicate=allow_duplicate,
+        force_new_model=force_new_model,
+    )
+    return await _enroll(req, image)
+
+
+async def _enroll(req: EnrollRequest, image: bytes | None = None):
+    """Enroll from `req.image_base64`, or from already-decoded upload bytes when `image` is given."""
+    image_len = len(image) if image is not None else len(req.image_base64 or "")
     try:
-        print(
-            f"\n>>> [ENROLL] request received - user={req.user_id} class={req.class_id} "
-            f"student={req.student_id} image_len={len(req.image_base64 or '')}"
-        )
-        logger.info("POST /enroll received — user=%s class=%s student=%s image_len=%d", req.user_id, req.class_id, req.student_id, len(req.image_base64 or ""))
-        existing_dim = _get_existing_dim_for_student(req.user_id, req.class_id, req.student_id)
+        logger.info("POST /enroll received — user=%s class=%s student=%s image_len=%d", req.user_id, req.class_id, req.student_id, image_len)
+        # The class gallery (cached after the first request) answers the dim, duplicate and count checks
+        gallery = await aget_class_gallery(req.user_id, req.class_id)
+        existing_dim = gallery.student_dim(req.student_id)
         preferred_models = model_order_for_dim(existing_dim) if existing_dim else None
-        result = get_embedding_from_base64(req.image_base64, preferred_models=preferred_models)
+        if image is None:
+            result = await run_inference(get_embedding_from_base64, req.image_base64, preferred_models=preferred_models)
+        else:
+            result = await run_inference(get_embedding_from_bytes, image, preferred_models=preferred_models)
         if not result:
-            debug = get_embedding_from_base64_debug(req.image_base64)
+            debug_base64 = req.image_base64 if image is None else base64.b64encode(image).decode("ascii")
+            debug = await run_inference(get_embedding_from_base64_debug, debug_base64)
             # ไม่บันทึกรูปภาพลง disk เพื่อความปลอดภัยและความเป็นส่วนตัวของนักเรียน
             # มี debug info ใน response แล้ว (image_dims, errors)
             return JSONResponse(status_code=400, content={"detail": "ไม่พบใบหน้าในภาพ", "debug": debug})
         emb, conf = result
-        if existing_dim and len(emb) != existing_dim:
-            remove_all(req.user_id, req.class_id, req.student_id)
-            logger.info("dim ไม่ตรง (expected=%s got=%s): ล้าง embedding เก่าอัตโนมัติ user=%s class=%s student=%s", existing_dim, len(emb), req.user_id, req.class_id, req.student_id)
-            print(f">>> [ENROLL] โมเดลไม่ตรง (expected dim={existing_dim}, got dim={len(emb)}) — ล้างข้อมูลเก่าอัตโนมัติแล้ว user={req.user_id} class={req.class_id} student={req.student_id}")
-        dup = _check_duplicate(req.user_id, req.class_id, emb, req.student_id)
-        if dup and not req.allow_duplicate:
-            other_id, sim = dup
+        model_changed = bool(existing_dim) and len(emb) != existing_dim
+        duplicates = [] if req.allow_duplicate else await _find_duplicates(
+            req.user_id, req.class_id, gallery, emb, req.student_id
+        )
+        if duplicates:
+            matches = [{"student_id": other_id, "similarity": sim} for other_id, sim in duplicates]
             return JSONResponse(
                 status_code=409,
                 content={
                     "detail": "ใบหน้านี้ใกล้เคียงกับนักเรียนคนอื่น ต้องการยืนยันการลงทะเบียนหรือไม่",
-                    "duplicate": {"student_id": other_id, "similarity": sim},
+                    # `duplicate` = คนที่คล้ายที่สุด (client เดิม), `duplicates` = ทุกคนที่อาจซ้ำ เรียงจากคล้ายมากไปน้อย
+                    "duplicate": matches[0],
+                    "duplicates": matches,
                 },
             )
-        count = get_count(req.user_id, req.class_id, req.student_id)
-        if count >= 5:
+        if model_changed:
+            # ข้อมูลเก่าของโมเดลอื่นจะถูกแทนที่ใน enroll_embedding (transaction เดียวกับการ insert)
+            logger.info("dim ไม่ตรง (expected=%s got=%s): ล้าง embedding เก่าอัตโนมัติ user=%s class=%s student=%s", existing_dim, len(emb), req.user_id, req.class_id, req.student_id)
+        elif gallery.student_count(req.student_id) >= 5:
             raise HTTPException(status_code=400, detail="มีข้อมูลใบหน้าครบ 5 รายการแล้ว")
-        add_embedding(req.user_id, req.class_id, req.student_id, emb, conf)
-        return EnrollResponse(success=True, count=count + 1, message="ลงทะเบียนสำเร็จ")
-    except HTTPException:
+        count = await run_io(enroll_embedding, req.user_id, req.class_id, req.student_id, emb, conf)
+        return EnrollResponse(success=True, count=count, message="ลงทะเบียนสำเร็จ")
+    except (HTTPException, InferenceBusy):
         raise
     except Exception as e:
         logger.exception("ENROLL failed: %s", e)
-        print(f">>> [ENROLL] ERROR: {type(e).__name__}: {e}")
         raise HTTPException(status_code=500, detail=f"ลงทะเบียนล้มเหลว: {type(e).__name__}: {str(e)}")
 
 
-@router.post("/recognize", response_model=RecognizeResponse)
-def recognize(req: RecognizeRequest):
-    from repositories.embedding_store import get_normalized_embeddings_for_class
-    
-    # ดึง embedding จากรูปสแกนแบบเดียวกับตอนลงทะเบียน (ไม่บังคับโมเดล = ใช้ mediapipe + Facenet512)
-    # เพื่อให้จับคู่ได้กับข้อมูลที่ลงทะเบียนใหม่ (512)
-    result = get_embedding_from_base64(req.image_base64, preferred_models=None)
-    if not result:
-        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
-    query_emb, _ = result
-    query_dim = len(query_emb)
+def _decide_match(
+    best_student_id: str | None,
+    best_similarity: float,
+    second_best_similarity: float,
+    query_dim: int,
+) -> RecognizeResponse:
+    """Apply threshold and margin rules to the best/second-best gallery scores."""
     threshold = 0.4 if query_dim == 128 else SIMILARITY_THRESHOLD
-
-    # Get pre-normalized embeddings cache (much faster!)
-    # Only match against students with at least MIN_ENROLLMENTS_FOR_ATTENDANCE images
-    normalized_by_dim = get_normalized_embeddings_for_class(
-        req.user_id, req.class_id, min_embeddings=MIN_ENROLLMENTS_FOR_ATTENDANCE
-    )
-    if query_dim not in normalized_by_dim or not normalized_by_dim[query_dim]:
-        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
-
-    # Convert query to numpy array and normalize once
-    query_arr = np.array(query_emb, dtype=np.float32)
-    query_norm = np.linalg.norm(query_arr)
-    if query_norm == 0:
-        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
-    query_normalized = query_arr / query_norm
-
-    best_student_id = None
-    best_similarity = 0.0
-    second_best_similarity = 0.0
-
-    # Ultra-fast vectorized computation using pre-normalized embeddings
-    for student_id, normalized_matrix, _ in normalized_by_dim[query_dim]:
-        # normalized_matrix is already (n_embeddings, dim) and normalized
-        # Compute all similarities at once (vectorized)
-        similarities = np.dot(normalized_matrix, query_normalized)
-        
-        # Find best match for this student
-        max_sim = float(np.max(similarities))
-        
-        if max_sim > best_similarity:
-            second_best_similarity = best_similarity
-            best_similarity = max_sim
-            best_student_id = student_id
-        elif max_sim > second_best_similarity:
-            second_best_similarity = max_sim
-        
-        # Early exit if we found a very good match (ultra-fast path)
-        # เพิ่ม threshold สำหรับ early exit เพื่อความแม่นยำสูงขึ้น
-        from config import HIGH_CONFIDENCE_THRESHOLD
-        if best_similarity > HIGH_CONFIDENCE_THRESHOLD:  # Very high confidence (0.75)
-            break
-
     if best_student_id is None:
         return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
 
@@ -250,46 +350,446 @@ def recognize(req: RecognizeRequest):
     )
 
 
+def _normalize_query(query_emb: list[float]) -> np.ndarray | None:
+    query_arr = np.asarray(query_emb, dtype=np.float32)
+    query_norm = np.linalg.norm(query_arr)
+    if query_norm == 0:
+        return None
+    return query_arr / query_norm
+
+
+@router.post("/recognize", response_model=RecognizeResponse)
+async def recognize(req: RecognizeRequest):
+    # ดึง embedding จากรูปสแกนแบบเดียวกับตอนลงทะเบียน (ไม่บังคับโมเดล = ใช้ mediapipe + Facenet512)
+    # เพื่อให้จับคู่ได้กับข้อมูลที่ลงทะเบียนใหม่ (512)
+    result = await run_inference(
+        get_embedding_from_base64, req.image_base64, preferred_models=None, deadline_ms=req.deadline_ms
+    )
+    return await _match_in_class(req.user_id, req.class_id, result)
+
+
+@router.post("/recognize/upload", response_model=RecognizeResponse)
+async def recognize_upload(request: Request, user_id: str, class_id: str, deadline_ms: int | None = None):
+    """เหมือน /recognize แต่ส่งรูปเป็นไฟล์ (multipart ฟิลด์ `image` หรือ body ดิบ image/jpeg) แทน base64 ใน JSON"""
+    image = await _read_image_upload(request)
+    result = await run_inference(get_embedding_from_bytes, image, preferred_models=None, deadline_ms=deadline_ms)
+    return await _match_in_class(user_id, class_id, result)
+
+
+async def _match_in_class(
+    user_id: str, class_id: str, result: tuple[list[float], float] | None
+) -> RecognizeResponse:
+    """Match an extraction result against one class gallery."""
+    if not result:
+        metrics.inc("match_total", kind="single", outcome="no_face")
+        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
+    return await _match_in_gallery(user_id, class_id, await aget_class_gallery(user_id, class_id), result)
+
+
+async def _match_in_gallery(
+    user_id: str,
+    class_id: str,
+    class_gallery: ClassGallery,
+    result: tuple[list[float], float] | None,
+    kind: str = "single",
+) -> RecognizeResponse:
+    """Match an extraction result against an already loaded class gallery (e.g. one pinned by a stream).
+
+    `kind` labels the match_seconds / match_total metrics ("single", "video", ...).
+    """
+    if not result:
+        metrics.inc("match_total", kind=kind, outcome="no_face")
+        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
+    with metrics.timer("match_seconds", kind=kind):
+        decision = await _score_in_gallery(user_id, class_id, class_gallery, result)
+    metrics.inc("match_total", kind=kind, outcome="matched" if decision.matched else "unmatched")
+    return decision
+
+
+async def _score_in_gallery(
+    user_id: str, class_id: str, class_gallery: ClassGallery, result: tuple[list[float], float]
+) -> RecognizeResponse:
+    query_emb, _ = result
+    query_dim = len(query_emb)
+
+    # Contiguous (N_embeddings, dim) gallery for this class, served from the in-process index
+    gallery = class_gallery.matrix(query_dim)
+    if gallery is None:
+        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
+
+    query_normalized = _normalize_query(query_emb)
+    if query_normalized is None:
+        return RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
+
+    # One GEMV + segmented max over all students;
+    # only match against students with at least MIN_ENROLLMENTS_FOR_ATTENDANCE images
+    scores = gallery.student_scores(query_normalized, min_embeddings=MIN_ENROLLMENTS_FOR_ATTENDANCE)[0]
+    best_student_id, best_similarity, second_best_similarity = await _exact_best_two(
+        user_id, class_id, gallery, query_normalized, scores, query_dim
+    )
+    return _decide_match(best_student_id, best_similarity, second_best_similarity, query_dim)
+
+
+@router.post("/identify", response_model=IdentifyResponse)
+async def identify(req: IdentifyRequest):
+    """ระบุตัวนักเรียนจากทุกห้องเรียนของผู้ใช้ (เช่น kiosk ที่ประตูโรงเรียน) ด้วย ANN index ของทั้ง tenant"""
+    result = await run_inference(
+        get_embedding_from_base64, req.image_base64, preferred_models=None, deadline_ms=req.deadline_ms
+    )
+    if not result:
+        return IdentifyResponse(student_id=None, classroom_id=None, student_name=None, similarity=0, matched=False)
+    query_emb, _ = result
+    query_normalized = _normalize_query(query_emb)
+    if query_normalized is None:
+        return IdentifyResponse(student_id=None, classroom_id=None, student_name=None, similarity=0, matched=False)
+
+    # Built from storage on first use, then kept up to date by enroll/delete
+    index = await run_io(get_user_index, req.user_id, len(query_emb))
+    # Same rule as class recognition: only students with MIN_ENROLLMENTS_FOR_ATTENDANCE images can match
+    hits = index.search(query_normalized, k=2, min_embeddings=MIN_ENROLLMENTS_FOR_ATTENDANCE)
+    best_student_id, best_classroom_id, best = hits[0] if hits and hits[0][2] > 0 else (None, None, 0.0)
+    second = max(0.0, hits[1][2]) if len(hits) > 1 else 0.0
+    decision = _decide_match(best_student_id, best, second, len(query_emb))
+    metrics.inc("identify_total", outcome="matched" if decision.matched else "unmatched")
+    return IdentifyResponse(
+        student_id=decision.student_id,
+        classroom_id=best_classroom_id if decision.matched else None,
+        student_name=None,
+        similarity=decision.similarity,
+        matched=decision.matched,
+    )
+
+
+class _StreamSession:
+    """One kiosk's `/stream` session: the newest unprocessed frame plus the pinned class gallery."""
+
+    def __init__(self, user_id: str, class_id: str, gallery: ClassGallery):
+        self.user_id = user_id
+        self.class_id = class_id
+        self.gallery = gallery
+        self.frame: bytes | None = None
+        self.frame_no = 0
+        self.dropped = 0
+        self.has_frame = asyncio.Event()
+        self._reload: asyncio.Task | None = None
+
+    def push(self, frame: bytes) -> None:
+        # Only the newest frame matters on a live feed: an unprocessed older one is replaced, not queued
+        if self.frame is not None:
+            self.dropped += 1
+            metrics.inc("stream_frames_total", outcome="dropped")
+        self.frame = frame
+        self.frame_no += 1
+        self.has_frame.set()
+
+    def take(self) -> tuple[bytes, int, int]:
+        frame, dropped = self.frame, self.dropped
+        self.frame, self.dropped = None, 0
+        self.has_frame.clear()
+        return frame, self.frame_no, dropped
+
+    def current_gallery(self) -> ClassGallery:
+        """The pinned gallery, swapped for the cached one after enroll/delete patched it. When the cache
+        entry expired the session keeps matching against its pin while one reload runs in the background."""
+        cached = gallery_index.get(self.user_id, self.class_id)
+        if cached is not None:
+            self.gallery = cached
+        elif self._reload is None or self._reload.done():
+            self._reload = asyncio.create_task(self._refresh())
+        return self.gallery
+
+    async def _refresh(self) -> None:
+        self.gallery = await aget_class_gallery(self.user_id, self.class_id)
+
+
+async def _stream_receive(websocket: WebSocket, session: _StreamSession) -> None:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes"):
+            session.push(message["bytes"])
+        elif message.get("text") == "ping":
+            await websocket.send_json({"type": "pong"})
+
+
+async def _stream_process(websocket: WebSocket, session: _StreamSession, deadline_ms: int | None) -> None:
+    while True:
+        await session.has_frame.wait()
+        frame, frame_no, dropped = session.take()
+        started = time.perf_counter()
+        try:
+            result = await run_inference(get_embedding_from_bytes, frame, preferred_models=None, deadline_ms=deadline_ms)
+        except InferenceBusy:
+            metrics.inc("stream_frames_total", outcome="busy")
+            await websocket.send_json({"type": "busy", "frame": frame_no})
+            continue
+        match = await _match_in_gallery(session.user_id, session.class_id, session.current_gallery(), result)
+        metrics.inc("stream_frames_total", outcome="processed")
+        await websocket.send_json({
+            "type": "match",
+            "frame": frame_no,
+            "dropped": dropped,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "face_found": result is not None,
+            **match.model_dump(),
+        })
+
+
+@router.websocket("/stream")
+async def stream(websocket: WebSocket, user_id: str, class_id: str, deadline_ms: int | None = None):
+    """เช็คชื่อแบบต่อเนื่องสำหรับ kiosk: เปิด WebSocket ครั้งเดียวต่อห้อง แล้วส่งเฟรม JPEG เป็น binary message
+
+    Server ตอบกลับ {"type": "match", "frame", "student_id", "similarity", "matched", ...} ต่อเฟรมที่ประมวลผล
+    ถ้าประมวลผลไม่ทัน จะข้ามเฟรมเก่าไปใช้เฟรมล่าสุดเสมอ (จำนวนที่ข้ามอยู่ใน "dropped")
+    """
+    await websocket.accept()
+    session = _StreamSession(user_id, class_id, await aget_class_gallery(user_id, class_id))
+    await websocket.send_json({"type": "ready", "students": len(session.gallery.counts())})
+    metrics.inc("stream_sessions_total")
+    receiver = asyncio.create_task(_stream_receive(websocket, session))
+    processor = asyncio.create_task(_stream_process(websocket, session, deadline_ms))
+    try:
+        done, _ = await asyncio.wait({receiver, processor}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), (WebSocketDisconnect, RuntimeError)):
+                task.result()
+    except Exception as e:
+        logger.exception("stream session failed: %s", e)
+    finally:
+        receiver.cancel()
+        processor.cancel()
+
+
+@router.post("/recognize-batch", response_model=RecognizeBatchResponse)
+async def recognize_batch(req: RecognizeBatchRequest):
+    """Recognize several frames of one class in one call: one batched model pass, one GEMM per dim."""
+    if len(req.images_base64) > RECOGNIZE_BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"ส่งรูปได้สูงสุด {RECOGNIZE_BATCH_MAX_IMAGES} รูปต่อครั้ง",
+        )
+    no_match = RecognizeResponse(student_id=None, student_name=None, similarity=0, matched=False)
+    responses = [no_match] * len(req.images_base64)
+    extracted = await run_inference(get_embeddings_from_base64_batch, req.images_base64)
+
+    # Group normalized queries by dim so each dim is matched with a single matrix-matrix product
+    queries_by_dim: dict[int, list[tuple[int, np.ndarray]]] = {}
+    for i, result in enumerate(extracted):
+        if not result:
+            continue
+        query_normalized = _normalize_query(result[0])
+        if query_normalized is not None:
+            queries_by_dim.setdefault(len(result[0]), []).append((i, query_normalized))
+    if not queries_by_dim:
+        return RecognizeBatchResponse(results=responses)
+
+    class_gallery = await aget_class_gallery(req.user_id, req.class_id)
+    for dim, queries in queries_by_dim.items():
+        gallery = class_gallery.matrix(dim)
+        if gallery is None:
+            continue
+        scores = gallery.student_scores(
+            np.stack([q for _, q in queries]), min_embeddings=MIN_ENROLLMENTS_FOR_ATTENDANCE
+        )
+        for (i, q), row in zip(queries, scores):
+            responses[i] = _decide_match(*await _exact_best_two(req.user_id, req.class_id, gallery, q, row, dim), dim)
+    return RecognizeBatchResponse(results=responses)
+
+
+def _face_box(box: tuple[int, int, int, int]) -> FaceBox:
+    x, y, w, h = box
+    return FaceBox(x=x, y=y, width=w, height=h)
+
+
+@router.post("/recognize-group", response_model=RecognizeGroupResponse)
+async def recognize_group(req: RecognizeGroupRequest):
+    """Recognize every face of one classroom photo; identities are assigned jointly (one face per student)."""
+    faces = await run_inference(get_face_embeddings_from_base64, req.image_base64)
+    started = time.perf_counter()
+    matches: list[FaceMatch | None] = [None] * len(faces)
+
+    queries_by_dim: dict[int, list[tuple[int, np.ndarray]]] = {}
+    for i, (emb, _) in enumerate(faces):
+        query_normalized = _normalize_query(emb)
+        if query_normalized is not None:
+            queries_by_dim.setdefault(len(emb), []).append((i, query_normalized))
+
+    class_gallery = await aget_class_gallery(req.user_id, req.class_id) if queries_by_dim else None
+    for dim, queries in queries_by_dim.items():
+        gallery = class_gallery.matrix(dim)
+        if gallery is None:
+            continue
+        scores = gallery.student_scores(
+            np.stack([q for _, q in queries]), min_embeddings=MIN_ENROLLMENTS_FOR_ATTENDANCE
+        )
+        threshold = 0.4 if dim == 128 else SIMILARITY_THRESHOLD
+        if gallery.quantized:
+            # Re-score at full precision every student that could pass the threshold or, within the
+            # 0.20 margin window, compete with one that does (one storage query per photo)
+            queries_matrix = np.stack([q for _, q in queries])
+            reachable = np.any(scores + gallery.student_bounds() >= threshold - 0.20, axis=0)
+            candidates = np.flatnonzero(reachable)
+            if candidates.size:
+                metrics.inc("gallery_rerank_total", outcome="reranked")
+                scores = gallery.rerank(
+                    queries_matrix, scores, await _exact_rows(req.user_id, req.class_id, gallery, candidates)
+                )
+        # Joint assignment maximizing total similarity over pairs that pass the threshold,
+        # so two faces can never resolve to the same student
+        assigned = max_weight_assignment(np.where(scores >= threshold, scores, 0))
+        for row, (i, _) in enumerate(queries):
+            col = int(assigned[row])
+            if col < 0:
+                best = float(np.max(scores[row])) if scores.shape[1] else 0.0
+                decision = RecognizeResponse(
+                    student_id=None,
+                    student_name=None,
+                    similarity=embedding_to_similarity(best, dim) if best > 0 else 0,
+                    matched=False,
+                )
+            else:
+                # Margin is measured against students not already claimed by another face in the photo
+                competitors = scores[row].copy()
+                taken = assigned[(assigned >= 0) & (np.arange(len(assigned)) != row)]
+                competitors[taken] = -np.inf
+                competitors[col] = -np.inf
+                second = max(0.0, float(np.max(competitors))) if competitors.size > 1 else 0.0
+                decision = _decide_match(gallery.student_ids[col], float(scores[row, col]), second, dim)
+            matches[i] = FaceMatch(
+                student_id=decision.student_id,
+                similarity=decision.similarity,
+                matched=decision.matched,
+                box=_face_box(faces[i][1]),
+            )
+
+    response = RecognizeGroupResponse(faces=[
+        m if m is not None else FaceMatch(student_id=None, similarity=0, matched=False, box=_face_box(faces[i][1]))
+        for i, m in enumerate(matches)
+    ])
+    metrics.observe("match_seconds", time.perf_counter() - started, kind="group")
+    for face in response.faces:
+        metrics.inc("match_total", kind="group", outcome="matched" if face.matched else "unmatched")
+    return response
+
+
+async def _save_video_upload(request: Request) -> str:
+    """Stream a video upload (multipart field `video`, or the raw body) to a temp file, capped at VIDEO_MAX_BYTES.
+    OpenCV needs a path to decode from; the caller deletes the file."""
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("video")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="ต้องแนบไฟล์วิดีโอในฟิลด์ video")
+
+        async def chunks():
+            while chunk := await upload.read(1 << 20):
+                yield chunk
+        source = chunks()
+    else:
+        source = request.stream()
+
+    fd, path = tempfile.mkstemp(prefix="loginface-video-")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in source:
+                size += len(chunk)
+                if size > VIDEO_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="ไฟล์วิดีโอใหญ่เกินไป")
+                f.write(chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="ไม่มีข้อมูลวิดีโอ")
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+def _embed_on_inference_pool(crops: list[np.ndarray]) -> np.ndarray:
+    """One embedding batch of the video pipeline, run on the inference pool and awaited from its I/O thread."""
+    return submit_inference(embed_faces_batch, crops).result()
+
+
+@router.post("/recognize-video", response_model=RecognizeVideoResponse)
+async def recognize_video(request: Request, user_id: str, class_id: str):
+    """เช็คชื่อจากวิดีโอห้องเรียน: สุ่มเฟรม ตรวจจับและติดตามใบหน้า แล้วจับคู่ทีละ track
+    คืนรายชื่อนักเรียนที่พบพร้อมเวลาที่เห็นครั้งแรกในวิดีโอ"""
+    path = await _save_video_upload(request)
+    try:
+        # Decode/detect/track for the whole video runs on the I/O pool; only embedding batches take an
+        # inference worker, so a long video does not hold one away from /recognize and /enroll
+        video = await run_io(process_video, path, _embed_on_inference_pool)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="อ่านไฟล์วิดีโอไม่ได้")
+    finally:
+        os.unlink(path)
+
+    # A student whose track broke (occlusion, leaving the frame) matches several tracks: keep the earliest sighting
+    students: dict[str, VideoStudent] = {}
+    class_gallery = await aget_class_gallery(user_id, class_id) if video.tracks else None
+    for track in video.tracks:
+        decision = await _match_in_gallery(
+            user_id, class_id, class_gallery, (track.embedding.tolist(), 1.0), kind="video"
+        )
+        if not decision.matched:
+            continue
+        seen = students.get(decision.student_id)
+        if seen is None:
+            students[decision.student_id] = VideoStudent(
+                student_id=decision.student_id,
+                similarity=decision.similarity,
+                first_seen_seconds=round(track.first_seen, 2),
+            )
+        else:
+            seen.similarity = max(seen.similarity, decision.similarity)
+            seen.first_seen_seconds = min(seen.first_seen_seconds, round(track.first_seen, 2))
+    return RecognizeVideoResponse(
+        students=sorted(students.values(), key=lambda s: s.first_seen_seconds),
+        tracks=len(video.tracks),
+        frames_sampled=video.frames_sampled,
+        duration_seconds=round(video.duration_seconds, 2),
+    )
+
+
 @router.get("/count", response_model=CountResponse)
-def get_face_count(user_id: str, class_id: str, student_id: str):
-    return CountResponse(count=get_count(user_id, class_id, student_id))
+async def get_face_count(user_id: str, class_id: str, student_id: str):
+    return CountResponse(count=await run_io(get_count, user_id, class_id, student_id))
 
 
 @router.get("/enrolled", response_model=EnrolledStudentsResponse)
-def get_enrolled_students(user_id: str, class_id: str):
+async def get_enrolled_students(user_id: str, class_id: str):
     """Return student IDs that have at least 1 face enrollment (for dashboard count).
     Note: For attendance recognition, students need MIN_ENROLLMENTS_FOR_ATTENDANCE (5) images,
     but for dashboard "not enrolled" count, we check if they have ANY enrollment (>= 1)."""
-    counts = get_counts_for_class(user_id, class_id)
+    counts = await run_io(get_counts_for_class, user_id, class_id)
     # Return students with at least 1 enrollment (not 5) for dashboard count
     ids = [sid for sid, c in counts.items() if c >= 1]
     return EnrolledStudentsResponse(student_ids=ids)
 
 
 @router.get("/counts", response_model=FaceCountsResponse)
-def get_face_counts_for_class(user_id: str, class_id: str):
+async def get_face_counts_for_class(user_id: str, class_id: str):
     """Return face enrollment counts per student for a classroom.
 
     This is used by the dashboard to compute "not enrolled" reliably in one request.
     """
-    print(f"[get_face_counts_for_class] Request: user_id={user_id}, class_id={class_id}")
-    counts = get_counts_for_class(user_id, class_id)
-    print(f"[get_face_counts_for_class] Returning counts: {counts}")
+    counts = await run_io(get_counts_for_class, user_id, class_id)
     return FaceCountsResponse(counts=counts)
 
 
 @router.delete("/enroll")
-def delete_enrollment(user_id: str, class_id: str, student_id: str, index: int | None = None):
+async def delete_enrollment(user_id: str, class_id: str, student_id: str, index: int | None = None):
     if index is not None:
-        remove_by_index(user_id, class_id, student_id, index)
+        await run_io(remove_by_index, user_id, class_id, student_id, index)
     else:
-        remove_all(user_id, class_id, student_id)
+        await run_io(remove_all, user_id, class_id, student_id)
     return {"success": True}
 
 
 @router.get("/list")
-def list_enrollments(user_id: str, class_id: str, student_id: str):
-    records = get_embeddings(user_id, class_id, student_id)
+async def list_enrollments(user_id: str, class_id: str, student_id: str):
+    records = await run_io(get_embeddings, user_id, class_id, student_id)
     return {
         "count": len(records),
         "records": [{"enrolledAt": r.get("enrolledAt", ""), "confidence": r.get("confidence", 0)} for r in records],
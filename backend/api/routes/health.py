@@ -1,4 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import JSONResponse
+
+from core import metrics, tracing
+from services.face_service import readiness, extraction_stats
 
 router = APIRouter()
 
@@ -6,3 +10,37 @@ router = APIRouter()
 @router.get("/health")
 def health():
     return {"status": "ok", "service": "face-attendance-api", "message": "Backend ทำงานปกติ"}
+
+
+@router.get("/ready")
+def ready():
+    """Readiness probe: 200 only once the embedding model and detectors are warm, 503 before that."""
+    state = readiness()
+    if state["status"] != "ready":
+        return JSONResponse(status_code=503, content=state)
+    return state
+
+
+@router.get("/metrics")
+def get_metrics():
+    """In-process counters and gauges (detector pool size/reuse, ...) plus extraction cascade stats."""
+    return {**metrics.snapshot(), "extraction": extraction_stats()}
+
+
+@router.get("/traces")
+def list_traces(x_trace_token: str | None = Header(default=None)):
+    """Requests traced with `X-Trace` (newest first) still held in the in-memory trace ring."""
+    if not tracing.authorized(x_trace_token):
+        raise HTTPException(status_code=403, detail="ต้องส่ง X-Trace-Token")
+    return {"traces": tracing.recent()}
+
+
+@router.get("/traces/{trace_id}")
+def get_trace(trace_id: str, x_trace_token: str | None = Header(default=None)):
+    """Span tree (and cProfile output for `X-Trace: profile`) of one traced request."""
+    if not tracing.authorized(x_trace_token):
+        raise HTTPException(status_code=403, detail="ต้องส่ง X-Trace-Token")
+    trace = tracing.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="ไม่พบ trace (หมดอายุหรือไม่ได้เปิด X-Trace)")
+    return trace
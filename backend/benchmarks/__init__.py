@@ -0,0 +1,10 @@
+"""Microbenchmarks for the face pipeline and the embedding store.
+
+Run from backend/:
+
+    python -m benchmarks.run --out bench-results.json
+    python -m benchmarks.compare old.json new.json
+
+Storage is an in-memory Supabase stand-in (see fake_supabase) filled with synthetic galleries, so no
+network, credentials or real data are needed, and runs on two commits measure the same workload.
+"""
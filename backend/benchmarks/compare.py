@@ -0,0 +1,54 @@
+"""Compare two benchmark result files (e.g. from two commits).
+
+    python -m benchmarks.compare before.json after.json [--metric p50_ms] [--threshold 0.10] [--fail-on-regression]
+
+Prints one line per benchmark present in both files with the relative change; changes beyond
+`--threshold` are marked as faster/SLOWER.
+"""
+from __future__ import annotations
+import argparse
+import json
+import sys
+
+
+def _load(path: str) -> tuple[dict, dict[tuple[str, str], dict]]:
+    with open(path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    rows = {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in report["results"]}
+    return report.get("meta", {}), rows
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="p50_ms", help="p50_ms, p95_ms, mean_ms or min_ms")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a difference")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit 1 when anything got slower")
+    args = parser.parse_args(argv)
+
+    meta_before, before = _load(args.before)
+    meta_after, after = _load(args.after)
+    print(f"before: {meta_before.get('commit')}  after: {meta_after.get('commit')}  metric: {args.metric}")
+
+    regressions = 0
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key][args.metric], after[key][args.metric]
+        change = (new - old) / old if old > 0 else 0.0
+        if change > args.threshold:
+            verdict = "SLOWER"
+            regressions += 1
+        elif change < -args.threshold:
+            verdict = "faster"
+        else:
+            verdict = ""
+        params = " ".join(f"{k}={v}" for k, v in json.loads(key[1]).items())
+        print(f"{key[0]:<40} {params:<44} {old:>10.3f} -> {new:>10.3f} ms  {change:>+7.1%}  {verdict}")
+    for label, only in (("only in before", before.keys() - after.keys()), ("only in after", after.keys() - before.keys())):
+        for name, params in sorted(only):
+            print(f"{label}: {name} {params}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""In-memory stand-in for the sync Supabase client, covering what repositories.embedding_store uses.
+
+Supports `table(...).select/insert/delete` with eq/in_/order/range filters and the `enroll_face_embedding`
+RPC. Every `execute()` round-trips its result through JSON like PostgREST does, and can sleep
+`latency_ms` to model the network, so cold loads pay a realistic payload cost.
+"""
+from __future__ import annotations
+import itertools
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from repositories import embedding_codec
+
+
+@dataclass
+class _Response:
+    data: Any
+
+
+class FakeQuery:
+    def __init__(self, client: "FakeSupabase", table: str, action: str, payload: Any = None, columns: str = "*"):
+        self._client = client
+        self._table = table
+        self._action = action
+        self._payload = payload
+        self._columns = [c.strip() for c in columns.split(",")] if columns != "*" else None
+        self._filters: list = []
+        self._order: tuple[str, bool] | None = None
+        self._range: tuple[int, int] | None = None
+
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column: str, values: list) -> "FakeQuery":
+        allowed = set(values)
+        self._filters.append(lambda row: row.get(column) in allowed)
+        return self
+
+    def order(self, column: str, desc: bool = False) -> "FakeQuery":
+        self._order = (column, desc)
+        return self
+
+    def range(self, start: int, end: int) -> "FakeQuery":
+        self._range = (start, end)
+        return self
+
+    def _matching(self) -> list[dict]:
+        rows = [row for row in self._client.tables.setdefault(self._table, []) if all(f(row) for f in self._filters)]
+        if self._order is not None:
+            column, desc = self._order
+            rows.sort(key=lambda row: row.get(column) or "", reverse=desc)
+        if self._range is not None:
+            rows = rows[self._range[0]:self._range[1] + 1]
+        return rows
+
+    def execute(self) -> _Response:
+        self._client.round_trips += 1
+        rows = self._client.tables.setdefault(self._table, [])
+        if self._action == "select":
+            data = [
+                {c: row.get(c) for c in self._columns} if self._columns else dict(row)
+                for row in self._matching()
+            ]
+        elif self._action == "insert":
+            payloads = self._payload if isinstance(self._payload, list) else [self._payload]
+            data = [self._client.insert_row(self._table, p) for p in payloads]
+        elif self._action == "delete":
+            doomed = {id(row) for row in self._matching()}
+            data = [row for row in rows if id(row) in doomed]
+            rows[:] = [row for row in rows if id(row) not in doomed]
+        else:
+            raise ValueError(self._action)
+        return self._client.respond(data)
+
+
+class _Table:
+    def __init__(self, client: "FakeSupabase", name: str):
+        self._client = client
+        self._name = name
+
+    def select(self, columns: str = "*") -> FakeQuery:
+        return FakeQuery(self._client, self._name, "select", columns=columns)
+
+    def insert(self, payload: dict | list[dict]) -> FakeQuery:
+        return FakeQuery(self._client, self._name, "insert", payload)
+
+    def delete(self) -> FakeQuery:
+        return FakeQuery(self._client, self._name, "delete")
+
+
+class _Rpc:
+    def __init__(self, client: "FakeSupabase", name: str, params: dict):
+        self._client = client
+        self._name = name
+        self._params = params
+
+    def execute(self) -> _Response:
+        self._client.round_trips += 1
+        if self._name != "enroll_face_embedding":
+            raise Exception(f"Could not find the function public.{self._name}")
+        return self._client.respond(self._client.enroll(self._params))
+
+
+class FakeSupabase:
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.tables: dict[str, list[dict]] = {}
+        self.round_trips = 0
+        self._clock = itertools.count()
+
+    def table(self, name: str) -> _Table:
+        return _Table(self, name)
+
+    def rpc(self, name: str, params: dict) -> _Rpc:
+        return _Rpc(self, name, params)
+
+    def respond(self, data: Any) -> _Response:
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000)
+        return _Response(json.loads(json.dumps(data)))
+
+    def insert_row(self, table: str, payload: dict) -> dict:
+        row = {"id": str(uuid.uuid4()), "enrolled_at": f"{next(self._clock):012d}", **payload}
+        self.tables.setdefault(table, []).append(row)
+        return row
+
+    def seed_gallery(self, user_id: str, classroom_id: str, gallery: dict[str, np.ndarray]) -> int:
+        """Insert every row of a synthetic gallery with the binary columns; returns the row count."""
+        n = 0
+        for student_id, rows in gallery.items():
+            for vector in rows:
+                self.insert_row("face_embeddings", {
+                    "user_id": user_id,
+                    "classroom_id": classroom_id,
+                    "student_id": student_id,
+                    "confidence": 0.99,
+                    **embedding_codec.encode(vector),
+                })
+                n += 1
+        return n
+
+    def enroll(self, p: dict) -> list[dict]:
+        """The enroll_face_embedding RPC (scripts/migrate-face-embeddings-enroll-rpc.sql)."""
+        rows = self.tables.setdefault("face_embeddings", [])
+
+        def own(row: dict) -> bool:
+            return (row["user_id"], row["classroom_id"], row["student_id"]) == (
+                p["p_user_id"], p["p_classroom_id"], p["p_student_id"]
+            )
+
+        rows[:] = [row for row in rows if not own(row) or row.get("embedding_dim") == p["p_embedding_dim"]]
+        keep = sorted((row for row in rows if own(row)), key=lambda row: row["enrolled_at"], reverse=True)
+        evicted = {id(row) for row in keep[max(p["p_max_per_student"] - 1, 0):]}
+        rows[:] = [row for row in rows if id(row) not in evicted]
+        self.insert_row("face_embeddings", {
+            "user_id": p["p_user_id"],
+            "classroom_id": p["p_classroom_id"],
+            "student_id": p["p_student_id"],
+            "embedding": p["p_embedding"],
+            "embedding_f32": p["p_embedding_f32"],
+            "embedding_dim": p["p_embedding_dim"],
+            "embedding_norm": p["p_embedding_norm"],
+            "model_name": p["p_model_name"],
+            "confidence": p["p_confidence"],
+        })
+        return [
+            {"id": row["id"], "embedding_f32": row["embedding_f32"], "enrolled_at": row["enrolled_at"]}
+            for row in sorted((row for row in rows if own(row)), key=lambda row: row["enrolled_at"])
+        ]
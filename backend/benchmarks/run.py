@@ -0,0 +1,345 @@
+"""Run the microbenchmarks and write the results as JSON.
+
+    python -m benchmarks.run                          # all groups, default sizes
+    python -m benchmarks.run --quick                  # small sizes, few repeats (smoke test)
+    python -m benchmarks.run --only gallery,store --sizes 100,1000,5000 --out after.json
+
+Groups:
+  extraction  get_embedding_from_base64 end to end and per cascade stage (face crop / webcam frame / 1080p)
+  gallery     class gallery cold load / warm hit, get_normalized_embeddings_for_class, recognize matching,
+              the enroll duplicate check and enroll itself, over the fake Supabase at every size x dim
+  store       local file store (the no-Supabase fallback): legacy JSON import, cold open, counts,
+              vectors_by_suffix, records and add at every size
+
+Timings are wall-clock milliseconds (mean/p50/p95/min/max over `n` runs after one warm-up run).
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.fake_supabase import FakeSupabase
+
+BENCH_USER = "bench-user"
+BENCH_CLASS = "bench-class"
+DEFAULT_SIZES = (100, 1000)
+DEFAULT_DIMS = (128, 512, 4096)
+
+
+def measure(fn: Callable[[], object], repeat: int, warmup: int = 1, setup: Callable[[], object] | None = None) -> dict:
+    """Time `fn()` `repeat` times (after `warmup` untimed runs); `setup()` runs untimed before every call."""
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def summarize(samples_ms: list[float]) -> dict:
+    arr = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "n": int(arr.size),
+        "mean_ms": round(float(arr.mean()), 4),
+        "p50_ms": round(float(np.percentile(arr, 50)), 4),
+        "p95_ms": round(float(np.percentile(arr, 95)), 4),
+        "min_ms": round(float(arr.min()), 4),
+        "max_ms": round(float(arr.max()), 4),
+    }
+
+
+class Results:
+    def __init__(self) -> None:
+        self.rows: list[dict] = []
+
+    def add(self, name: str, params: dict, stats: dict, **extra: object) -> None:
+        row = {"name": name, "params": params, **stats, **extra}
+        self.rows.append(row)
+        label = " ".join(f"{k}={v}" for k, v in params.items())
+        print(f"  {name:<40} {label:<34} p50 {stats['p50_ms']:>10.3f} ms   p95 {stats['p95_ms']:>10.3f} ms", flush=True)
+
+
+# ---- extraction -----------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def _timed_stages():
+    """Wrap every stage of the extraction pipelines to record (milliseconds, success) per call."""
+    from services import face_service
+    from services.extraction_pipeline import Stage
+
+    pipelines = (face_service._PRELUDE_PIPELINE, face_service._FACE_CROP_PIPELINE, face_service._FRAME_PIPELINE)
+    samples: dict[tuple[str, str], list[tuple[float, bool]]] = {}
+    originals = [(p, list(p.stages), list(p._order)) for p in pipelines]
+
+    def timed(pipeline_name: str, stage: Stage) -> Stage:
+        def run(ctx):
+            start = time.perf_counter()
+            result = None
+            try:
+                result = stage.run(ctx)
+                return result
+            finally:
+                samples.setdefault((pipeline_name, stage.name), []).append(
+                    ((time.perf_counter() - start) * 1000, bool(result))
+                )
+        return Stage(stage.name, run)
+
+    for p in pipelines:
+        wrapped = {s.name: timed(p.name, s) for s in p.stages}
+        p.stages = [wrapped[s.name] for s in p.stages]
+        p._order = [wrapped[s.name] for s in p._order]
+    try:
+        yield samples
+    finally:
+        for p, stages, order in originals:
+            p.stages, p._order = stages, order
+
+
+def bench_extraction(results: Results, repeat: int) -> None:
+    from services import face_service
+
+    images = {
+        "face_crop_224": synthetic.face_image(224, 224),
+        "frame_640x480": synthetic.face_image(640, 480),
+        "frame_1920x1080": synthetic.face_image(1920, 1080),
+    }
+    cache = face_service._embedding_cache
+    cache_bytes, cache.max_bytes = cache.max_bytes, 0  # every call extracts
+    try:
+        for label, img in images.items():
+            image_base64 = synthetic.jpeg_base64(img)
+            found = face_service.get_embedding_from_base64(image_base64) is not None
+            with _timed_stages() as stages:
+                stats = measure(lambda: face_service.get_embedding_from_base64(image_base64), repeat, warmup=0)
+            results.add("extraction.get_embedding_from_base64", {"image": label}, stats, embedding=found)
+            for (pipeline, stage), runs in stages.items():
+                results.add(
+                    "extraction.stage",
+                    {"image": label, "pipeline": pipeline, "stage": stage},
+                    summarize([ms for ms, _ in runs]),
+                    success_rate=round(sum(ok for _, ok in runs) / len(runs), 4),
+                )
+    finally:
+        cache.max_bytes = cache_bytes
+
+
+# ---- gallery / matching over the fake Supabase ----------------------------------------------------
+
+def _use_fake_supabase(fake: FakeSupabase) -> None:
+    from repositories import embedding_store
+
+    async def no_async_client():
+        return None
+
+    # Sync client only: cold async loads go through the I/O pool like the local store does
+    embedding_store.supabase = fake
+    embedding_store.get_async_supabase = no_async_client
+
+
+def bench_gallery(results: Results, sizes: list[int], dims: list[int], repeat: int) -> None:
+    from api.routes.face import _find_duplicates, _match_in_gallery
+    from repositories import embedding_store, gallery_index
+
+    fake = FakeSupabase()
+    _use_fake_supabase(fake)
+    loop = asyncio.new_event_loop()
+    cold_repeat = max(3, repeat // 10)
+    try:
+        for dim in dims:
+            for n in sizes:
+                fake.tables.clear()
+                students = synthetic.gallery(n, dim, seed=dim + n)
+                rows = fake.seed_gallery(BENCH_USER, BENCH_CLASS, students)
+                params = {"students": n, "rows": rows, "dim": dim}
+
+                def cold():
+                    gallery_index.invalidate(BENCH_USER, BENCH_CLASS)
+                    return embedding_store.get_class_gallery(BENCH_USER, BENCH_CLASS)
+
+                results.add("gallery.load_cold", params, measure(cold, cold_repeat))
+                embedding_store.get_class_gallery(BENCH_USER, BENCH_CLASS)
+                results.add(
+                    "gallery.get_warm", params,
+                    measure(lambda: embedding_store.get_class_gallery(BENCH_USER, BENCH_CLASS), repeat),
+                )
+                results.add(
+                    "gallery.get_normalized_embeddings_for_class", params,
+                    measure(lambda: embedding_store.get_normalized_embeddings_for_class(BENCH_USER, BENCH_CLASS, 5), repeat),
+                )
+
+                ids = list(students)
+                target = ids[len(ids) // 2]
+                query = synthetic.probe(students[target])
+                gallery = embedding_store.get_class_gallery(BENCH_USER, BENCH_CLASS)
+                decision = loop.run_until_complete(_match_in_gallery(BENCH_USER, BENCH_CLASS, gallery, (query, 1.0)))
+                results.add(
+                    "recognize.match", params,
+                    measure(lambda: loop.run_until_complete(
+                        _match_in_gallery(BENCH_USER, BENCH_CLASS, gallery, (query, 1.0))
+                    ), repeat),
+                    correct=decision.student_id == target,
+                )
+                near_copy = students[target][0].tolist()
+                results.add(
+                    "enroll.duplicate_check", params,
+                    measure(lambda: loop.run_until_complete(
+                        _find_duplicates(BENCH_USER, BENCH_CLASS, gallery, near_copy, "")
+                    ), repeat),
+                )
+
+                counter = iter(range(10**9))
+                before = fake.round_trips
+                stats = measure(
+                    lambda: embedding_store.enroll_embedding(
+                        BENCH_USER, BENCH_CLASS, f"enrollee-{next(counter) % 20}", query, 0.99
+                    ),
+                    repeat,
+                )
+                results.add(
+                    "enroll.store", params, stats,
+                    round_trips_per_call=round((fake.round_trips - before) / (stats["n"] + 1), 2),
+                )
+    finally:
+        loop.close()
+        fake.tables.clear()
+        gallery_index.invalidate(BENCH_USER, BENCH_CLASS)
+
+
+# ---- local file store -----------------------------------------------------------------------------
+
+def bench_store(results: Results, sizes: list[int], repeat: int, dim: int = 512) -> None:
+    from repositories.local_store import LocalEmbeddingStore
+
+    for n in sizes:
+        with tempfile.TemporaryDirectory(prefix="loginface-bench-") as tmp:
+            students = synthetic.gallery(n, dim, seed=n)
+            legacy = {
+                f"{BENCH_USER}:{BENCH_CLASS}:{sid}": [
+                    {"embedding": v.tolist(), "confidence": 0.99, "enrolledAt": "2024-01-01T00:00:00.000Z"}
+                    for v in rows
+                ]
+                for sid, rows in students.items()
+            }
+            legacy_path = os.path.join(tmp, "embeddings.json")
+            with open(legacy_path, "w", encoding="utf-8") as f:
+                json.dump(legacy, f)
+            params = {"students": n, "rows": n * synthetic.EMBEDDINGS_PER_STUDENT, "dim": dim}
+
+            def open_store(import_json: bool = False) -> LocalEmbeddingStore:
+                return LocalEmbeddingStore(
+                    os.path.join(tmp, "embeddings.f32"),
+                    os.path.join(tmp, "embeddings.index.json"),
+                    legacy_json_path=legacy_path if import_json else None,
+                    journal_path=os.path.join(tmp, "embeddings.journal"),
+                )
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(sys.stderr):
+                store = open_store(import_json=True)
+            results.add("store.import_json", params, summarize([(time.perf_counter() - start) * 1000]))
+            results.add("store.open_cold", params, measure(open_store, max(3, repeat // 10)))
+
+            prefix = f"{BENCH_USER}:{BENCH_CLASS}:"
+            key = prefix + synthetic.student_id(n // 2)
+            results.add("store.counts", params, measure(lambda: store.counts(prefix), repeat))
+            results.add("store.vectors_by_suffix", params, measure(lambda: list(store.vectors_by_suffix(prefix)), repeat))
+            results.add("store.records", params, measure(lambda: store.records(key), repeat))
+            vector = students[synthetic.student_id(0)][0].tolist()
+            results.add(
+                "store.add", params,
+                measure(lambda: store.add(key, vector, 0.99, "2024-01-02T00:00:00.000Z"), repeat),
+            )
+
+
+# ---- entry point ----------------------------------------------------------------------------------
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        if out.returncode != 0:
+            return None
+        dirty = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True, timeout=30,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        return out.stdout.strip() + ("-dirty" if dirty else "")
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _meta(args: argparse.Namespace) -> dict:
+    import config
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": {"only": args.only, "sizes": args.sizes, "dims": args.dims, "repeat": args.repeat},
+        "config": {
+            "GALLERY_QUANTIZATION": config.GALLERY_QUANTIZATION,
+            "GALLERY_SHARED_DIR": bool(config.GALLERY_SHARED_DIR),
+            "EMBEDDING_ENGINE": getattr(config, "EMBEDDING_ENGINE", None),
+        },
+    }
+
+
+def _ints(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default="extraction,gallery,store", help="comma-separated groups to run")
+    parser.add_argument("--sizes", type=_ints, default=list(DEFAULT_SIZES), help="students per gallery/store")
+    parser.add_argument("--dims", type=_ints, default=list(DEFAULT_DIMS), help="embedding dims for the gallery group")
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per benchmark")
+    parser.add_argument("--extraction-repeat", type=int, default=5, help="timed runs per extraction benchmark")
+    parser.add_argument("--quick", action="store_true", help="sizes=100, repeat=5 (smoke test)")
+    parser.add_argument("--out", default="bench-results.json", help="output JSON file")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.sizes, args.repeat, args.extraction_repeat = [100], 5, 2
+    groups = {g.strip() for g in args.only.split(",") if g.strip()}
+
+    results = Results()
+    started = time.perf_counter()
+    if "extraction" in groups:
+        print("extraction", flush=True)
+        bench_extraction(results, args.extraction_repeat)
+    if "gallery" in groups:
+        print("gallery", flush=True)
+        bench_gallery(results, args.sizes, args.dims, args.repeat)
+    if "store" in groups:
+        print("store", flush=True)
+        bench_store(results, args.sizes, args.repeat)
+
+    report = {"meta": _meta(args), "elapsed_seconds": round(time.perf_counter() - started, 2), "results": results.rows}
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {len(results.rows)} results to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
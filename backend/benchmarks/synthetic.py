@@ -0,0 +1,55 @@
+"""Deterministic synthetic data: galleries of random unit vectors and test images."""
+from __future__ import annotations
+import base64
+
+import cv2
+import numpy as np
+
+EMBEDDINGS_PER_STUDENT = 5
+
+
+def student_id(i: int) -> str:
+    return f"student-{i:06d}"
+
+
+def gallery(n_students: int, dim: int, per_student: int = EMBEDDINGS_PER_STUDENT, seed: int = 0) -> dict[str, np.ndarray]:
+    """{student_id: (per_student, dim) float32} of random unit vectors.
+
+    Each student's vectors are a shared identity direction plus noise, so a student's own rows are far
+    more similar to each other than to anyone else's, as with real enrollments.
+    """
+    rng = np.random.default_rng(seed)
+    identities = rng.standard_normal((n_students, dim)).astype(np.float32)
+    noise = rng.standard_normal((n_students, per_student, dim)).astype(np.float32) * 0.35
+    rows = identities[:, None, :] + noise
+    rows /= np.linalg.norm(rows, axis=2, keepdims=True)
+    return {student_id(i): rows[i] for i in range(n_students)}
+
+
+def probe(rows: np.ndarray, seed: int = 1) -> list[float]:
+    """A new "capture" of a student: the mean of their rows plus fresh noise."""
+    rng = np.random.default_rng(seed)
+    dim = rows.shape[1]
+    query = rows.mean(axis=0)
+    query = query / np.linalg.norm(query) + rng.standard_normal(dim).astype(np.float32) * (0.3 / np.sqrt(dim))
+    return (query / np.linalg.norm(query)).astype(np.float32).tolist()
+
+
+def face_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """A BGR frame with a face-like drawing in the middle (skin ellipse, eyes, mouth) over textured noise."""
+    rng = np.random.default_rng(seed)
+    img = rng.integers(40, 90, (height, width, 3), dtype=np.uint8)
+    cx, cy = width // 2, height // 2
+    fw, fh = max(8, width // 6), max(10, height // 4)
+    cv2.ellipse(img, (cx, cy), (fw, fh), 0, 0, 360, (150, 180, 220), -1)
+    for ex in (cx - fw // 2, cx + fw // 2):
+        cv2.circle(img, (ex, cy - fh // 4), max(2, fw // 8), (40, 40, 40), -1)
+    cv2.ellipse(img, (cx, cy + fh // 2), (fw // 3, max(2, fh // 10)), 0, 0, 180, (60, 60, 150), -1)
+    return img
+
+
+def jpeg_base64(img: np.ndarray, quality: int = 90) -> str:
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("cv2.imencode failed")
+    return base64.b64encode(buf.tobytes()).decode("ascii")
@@ -15,7 +15,104 @@ HIGH_CONFIDENCE_THRESHOLD = float(os.getenv("HIGH_CONFIDENCE_THRESHOLD", "0.78")
 # จำนวนภาพใบหน้าที่ต้องลงทะเบียนครบก่อนถึงจะเช็คชื่อได้
 MIN_ENROLLMENTS_FOR_ATTENDANCE = int(os.getenv("MIN_ENROLLMENTS_FOR_ATTENDANCE", "5"))
 
+# จำนวนนักเรียนที่หน้าคล้ายกันสูงสุดที่ส่งกลับใน 409 ของ /enroll (ให้ครูเห็นทุกคนที่อาจซ้ำ)
+DUPLICATE_TOP_K = max(1, int(os.getenv("DUPLICATE_TOP_K", "3")))
+
+# จำนวนรูปสูงสุดต่อ request ของ /recognize-batch
+RECOGNIZE_BATCH_MAX_IMAGES = int(os.getenv("RECOGNIZE_BATCH_MAX_IMAGES", "16"))
+
+# รูปหมู่ทั้งห้อง (/recognize-group): ย่อด้านยาวไม่เกินค่านี้ก่อนตรวจจับ เพื่อให้ใบหน้าเล็กด้านหลังห้องยังตรวจเจอ
+GROUP_PHOTO_MAX_SIDE = int(os.getenv("GROUP_PHOTO_MAX_SIDE", "1920"))
+
+# วิดีโอห้องเรียน (/recognize-video): สุ่มเฟรมกี่เฟรมต่อวินาที, embed ใบหน้าแต่ละ track กี่ครั้ง,
+# ความยาวและขนาดไฟล์สูงสุดที่ประมวลผล
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", "5"))
+VIDEO_EMBEDS_PER_TRACK = max(1, int(os.getenv("VIDEO_EMBEDS_PER_TRACK", "3")))
+VIDEO_MAX_SECONDS = float(os.getenv("VIDEO_MAX_SECONDS", "300"))
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# เก็บ gallery ในหน่วยความจำแบบย่อขนาด: "none" (float32), "float16" (2x เล็กลง) หรือ "int8" (4x เล็กลง)
+# ผลตัดสิน match/no-match ไม่เปลี่ยน: กรณีคะแนนก้ำกึ่ง จะคำนวณใหม่ด้วย embedding ความละเอียดเต็มจาก storage
+GALLERY_QUANTIZATION = os.getenv("GALLERY_QUANTIZATION", "none").strip().lower()
+if GALLERY_QUANTIZATION not in ("none", "float16", "int8"):
+    GALLERY_QUANTIZATION = "none"
+# หลาย uvicorn worker: ตั้งเป็น directory บน tmpfs (เช่น /dev/shm/loginface-galleries) เพื่อให้ทุก worker
+# map gallery ชุดเดียวกันแบบ read-only แทนการเก็บสำเนาแยกต่อ worker (ว่าง = ปิด, ใช้ cache ใน process)
+GALLERY_SHARED_DIR = os.getenv("GALLERY_SHARED_DIR", "").strip()
+if GALLERY_SHARED_DIR:
+    os.makedirs(GALLERY_SHARED_DIR, exist_ok=True)
+# In-process class gallery index: how long a loaded class stays warm before it is re-read from storage
+# (bounds staleness of writes made outside this backend). 0 = never expire.
+# Deploy ปัจจุบันเป็น uvicorn worker เดียว: ทุกการเขียนผ่าน worker นี้และอัปเดต cache ทันที
+# หลาย worker ต้องตั้ง GALLERY_SHARED_DIR — ไม่งั้น worker อื่นจะเห็นการลบ/ลงทะเบียนใหม่หลัง cache หมดอายุเท่านั้น
+GALLERY_CACHE_TTL_SECONDS = float(os.getenv("GALLERY_CACHE_TTL_SECONDS", "300"))
+
+# งบเวลาต่อการ extract embedding หนึ่งรูป (ms): หยุดไล่ cascade เมื่อเกินเวลา (0 = ไม่จำกัด, ค่า default)
+# ปิดไว้เป็นค่าเริ่มต้นเพราะบน CPU ช้า รูปที่มีใบหน้าจะถูกตอบว่า "ไม่พบใบหน้า" ก่อนถึง stage ที่หาเจอ
+# RecognizeRequest.deadline_ms ใช้แทนค่านี้ได้ต่อ request (เช่น kiosk ที่ยอมข้ามเฟรมแย่ๆ เพื่อความเร็ว)
+EXTRACTION_DEADLINE_MS = int(os.getenv("EXTRACTION_DEADLINE_MS", "0"))
+
+# จำนวน detector (Haar / MediaPipe) สูงสุดที่สร้างค้างไว้ใช้ซ้ำต่อ process — request ที่เกินจะรอคิว
+DETECTOR_POOL_SIZE = int(os.getenv("DETECTOR_POOL_SIZE", "8"))
+
+# Thread pools ของ async routes: งาน inference (CPU) กับงาน storage I/O (Supabase) แยกกันปรับขนาดได้อิสระ
+# INFERENCE_QUEUE_SIZE = จำนวน request ที่รอคิว inference ได้ เกินนี้ตอบ 503 ทันที
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", str(min(4, os.cpu_count() or 1))))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "32"))
+STORAGE_IO_WORKERS = int(os.getenv("STORAGE_IO_WORKERS", "16"))
+
+# Micro-batching: รวม face crop จากหลาย request ที่เข้ามาพร้อมกันเป็น batch เดียวก่อนส่งเข้าโมเดล
+# รอได้ไม่เกิน EMBED_BATCH_MAX_WAIT_MS หรือจนครบ EMBED_BATCH_MAX_SIZE รูป (EMBED_BATCH_MAX_SIZE=1 = ปิด, ค่า default)
+# เปิดเมื่อต้องการ throughput (เช่น 16): input ของโมเดลสร้างแบบเดียวกับ DeepFace.represent (tests/test_embedding_parity.py)
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "1"))
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5"))
+EMBED_BATCH_MAX_QUEUE = int(os.getenv("EMBED_BATCH_MAX_QUEUE", "256"))
+
+# โหลดโมเดล/ตัวตรวจจับใบหน้าตอน startup (background) แทนการโหลดตอน request แรก
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1").lower() not in ("0", "false", "no")
+
 # Data directory
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 os.makedirs(DATA_DIR, exist_ok=True)
-EMBEDDINGS_DB = os.path.join(DATA_DIR, "embeddings.json")
+EMBEDDINGS_DB = os.path.join(DATA_DIR, "embeddings.json")  # รูปแบบเดิม: นำเข้าครั้งเดียวตอนเริ่มใช้ local store
+# Local store (ไม่มี Supabase): vector float32 แบบ memory-mapped + index เล็กๆ (key → offset)
+EMBEDDINGS_VECTORS = os.getenv("EMBEDDINGS_VECTORS", os.path.join(DATA_DIR, "embeddings.f32"))
+EMBEDDINGS_INDEX = os.getenv("EMBEDDINGS_INDEX", os.path.join(DATA_DIR, "embeddings.index.json"))
+# การเขียนต่อท้ายลง journal (ใช้ร่วมกันได้หลาย worker) และรวมเข้า index เมื่อยาวเกินจำนวนบรรทัดนี้
+EMBEDDINGS_JOURNAL = os.getenv("EMBEDDINGS_JOURNAL", os.path.join(DATA_DIR, "embeddings.journal"))
+EMBEDDINGS_JOURNAL_COMPACT_ENTRIES = int(os.getenv("EMBEDDINGS_JOURNAL_COMPACT_ENTRIES", "1000"))
+
+# /identify (ทั้งโรงเรียน ไม่จำกัดห้อง): IVF index ต่อ user เก็บไว้ที่ ANN_INDEX_DIR
+# ค้นเฉพาะ ANN_NPROBE กลุ่มที่ใกล้ที่สุด; index ที่มีน้อยกว่า ANN_MIN_ROWS แถวจะค้นทุกแถว (exact)
+ANN_INDEX_DIR = os.getenv("ANN_INDEX_DIR", os.path.join(DATA_DIR, "ann"))
+os.makedirs(ANN_INDEX_DIR, exist_ok=True)
+ANN_NPROBE = max(1, int(os.getenv("ANN_NPROBE", "16")))
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "2048"))
+
+# face_embeddings ใน Supabase: อ่าน/เขียน embedding แบบ binary (คอลัมน์ embedding_f32, ดู supabase-schema.sql)
+# ระหว่าง migrate ให้เขียนคอลัมน์ JSONB `embedding` ควบคู่ไปด้วย (ปิดได้หลัง backfill ครบแล้ว)
+EMBEDDING_WRITE_JSONB = os.getenv("EMBEDDING_WRITE_JSONB", "1").lower() not in ("0", "false", "no")
+
+# Cache ผลการ extract ตาม hash ของไฟล์ภาพ (frontend retry ด้วยภาพเดิมจะไม่ต้องรันโมเดลซ้ำ)
+# EMBEDDING_CACHE_MAX_BYTES = หน่วยความจำสูงสุด (0 = ปิด), เก็บแต่ละรายการไม่เกิน EMBEDDING_CACHE_TTL_SECONDS
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "120"))
+
+# Embedding engine สำหรับ Facenet512: "deepface" (Keras ผ่าน DeepFace) หรือ "onnx" (ONNX Runtime บน CPU)
+# สร้างไฟล์ .onnx ด้วย: python -m services.embedding_engine export data/facenet512.onnx
+EMBEDDING_ENGINE = os.getenv("EMBEDDING_ENGINE", "deepface").strip().lower()
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", os.path.join(DATA_DIR, "facenet512.onnx"))
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))  # 0 = ค่า default ของ ONNX Runtime
+ONNX_INTER_OP_THREADS = int(os.getenv("ONNX_INTER_OP_THREADS", "1"))
+
+# Logging: LOG_FORMAT=json = หนึ่ง JSON ต่อบรรทัด (structured), อื่นๆ = ข้อความปกติ
+# LOG_SAMPLE_RATE = สัดส่วนของ event ที่เกิดบ่อยบน hot path (เช่น stage ของ extraction ล้มเหลว) ที่ถูก log จริง
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_SAMPLE_RATE = min(1.0, max(0.0, float(os.getenv("LOG_SAMPLE_RATE", "0.01"))))
+
+# Trace ราย request (ส่ง header X-Trace: 1 หรือ X-Trace: profile): เก็บ trace ล่าสุดไว้ในหน่วยความจำ TRACE_STORE_SIZE รายการ (0 = ปิด)
+# ต้องตั้ง TRACE_TOKEN และส่ง header X-Trace-Token ให้ตรง (ไม่ตั้ง = ปิด trace และ /api/traces); TRACE_PROFILE_TOP = จำนวนฟังก์ชันที่แสดงใน cProfile
+TRACE_STORE_SIZE = int(os.getenv("TRACE_STORE_SIZE", "100"))
+TRACE_TOKEN = os.getenv("TRACE_TOKEN", "").strip()
+TRACE_PROFILE_TOP = int(os.getenv("TRACE_PROFILE_TOP", "40"))
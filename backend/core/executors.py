@@ -0,0 +1,65 @@
+"""Dedicated thread pools for async routes: storage I/O and model inference are sized independently.
+
+Routes are `async def` and hand blocking work to one of two executors instead of Starlette's shared
+threadpool, so slow Supabase calls can no longer occupy the threads inference needs (and vice versa).
+Inference admission is bounded: once INFERENCE_WORKERS jobs are running and INFERENCE_QUEUE_SIZE more are
+waiting, new requests fail fast with `InferenceBusy` (HTTP 503) instead of queueing without limit.
+"""
+from __future__ import annotations
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+from config import INFERENCE_QUEUE_SIZE, INFERENCE_WORKERS, STORAGE_IO_WORKERS
+from core import metrics, tracing
+
+
+class InferenceBusy(RuntimeError):
+    """The inference queue is full; the request should be retried later."""
+
+
+_io_executor = ThreadPoolExecutor(max_workers=STORAGE_IO_WORKERS, thread_name_prefix="storage-io")
+_inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+_inference_lock = threading.Lock()
+_inference_pending = 0  # running + queued inference jobs
+
+
+async def run_io(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run blocking storage I/O (Supabase HTTP, local store) on the I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(_io_executor, partial(tracing.bind(fn), *args, **kwargs))
+
+
+def _release_inference(_future=None) -> None:
+    global _inference_pending
+    with _inference_lock:
+        _inference_pending -= 1
+        metrics.set_gauge("inference_pending", _inference_pending)
+
+
+def submit_inference(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+    """Admit one job to the inference pool from a worker thread (e.g. a pipeline running on the I/O pool
+    that only needs the pool for its model calls) and return its Future.
+
+    Raises InferenceBusy when INFERENCE_WORKERS + INFERENCE_QUEUE_SIZE jobs are already admitted.
+    """
+    global _inference_pending
+    with _inference_lock:
+        if _inference_pending >= INFERENCE_WORKERS + INFERENCE_QUEUE_SIZE:
+            metrics.inc("inference_rejected_total")
+            raise InferenceBusy("inference queue is full")
+        _inference_pending += 1
+        metrics.set_gauge("inference_pending", _inference_pending)
+    future = _inference_executor.submit(tracing.bind(fn), *args, **kwargs)
+    # Released when the job finishes or is cancelled before it starts, even if the request went away
+    future.add_done_callback(_release_inference)
+    return future
+
+
+async def run_inference(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run CPU-bound model work (decode, detection, embedding) on the inference pool.
+
+    Raises InferenceBusy when INFERENCE_WORKERS + INFERENCE_QUEUE_SIZE jobs are already admitted.
+    """
+    return await asyncio.wrap_future(submit_inference(fn, *args, **kwargs))
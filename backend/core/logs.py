@@ -0,0 +1,87 @@
+"""Logging setup and structured, sampled events for hot paths.
+
+`event()` replaces per-request print()/warning calls: fields are passed as data (rendered `key=value`, or
+as JSON keys with LOG_FORMAT=json), frequent events are sampled with LOG_SAMPLE_RATE, and nothing is
+formatted when the level is disabled. A traced request (see core.tracing) records every event on its
+current span regardless of sampling.
+"""
+from __future__ import annotations
+import json
+import logging
+import random
+import time
+from typing import Any
+
+from config import LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATE
+from core import tracing
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, the event's fields and any exception."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out: dict[str, Any] = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            out.update(fields)
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+def configure() -> None:
+    """Root logging for the app (called once from main)."""
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO), handlers=[handler], force=True)
+
+
+def event(
+    logger: logging.Logger,
+    name: str,
+    *,
+    level: int = logging.INFO,
+    sample: float = 1.0,
+    **fields: Any,
+) -> None:
+    """Log event `name` with structured `fields`, keeping only a `sample` fraction of them
+    (e.g. sample=LOG_SAMPLE_RATE for something that can happen on every request)."""
+    traced = tracing.event(name, **fields)
+    if not logger.isEnabledFor(level):
+        return
+    if not traced and sample < 1.0 and random.random() >= sample:
+        return
+    if sample < 1.0:
+        fields["sample_rate"] = sample
+    logger.log(
+        level,
+        "%s %s",
+        name,
+        _KeyValues(fields),
+        extra={"fields": {"event": name, **fields}},
+    )
+
+
+class _KeyValues:
+    """`key=value ...` rendered only if the record is actually formatted."""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: dict[str, Any]):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(f"{k}={v}" for k, v in self.fields.items())
+
+
+def sampled(logger: logging.Logger, name: str, *, level: int = logging.WARNING, **fields: Any) -> None:
+    """`event()` at the configured LOG_SAMPLE_RATE, for failures that can repeat on every request."""
+    event(logger, name, level=level, sample=LOG_SAMPLE_RATE, **fields)
@@ -0,0 +1,147 @@
+"""In-process metrics registry: labelled counters, gauges and latency histograms.
+
+Kept dependency-free; `snapshot()` is served as JSON by `GET /api/metrics` and `render_prometheus()`
+as the Prometheus text format by `GET /metrics`. Every `timer()` block is also a span of the request's
+trace when it is traced (see core.tracing).
+"""
+from __future__ import annotations
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from core import tracing
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_gauges: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_histograms: dict[tuple[str, tuple[tuple[str, str], ...]], "_Histogram"] = {}
+
+# Upper bounds in seconds: sub-millisecond gallery matching up to multi-second extraction cascades
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot = above every bound (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """[(le, observations <= le)] including "+Inf", as Prometheus exposes buckets."""
+        out, running = [], 0
+        for bound, n in zip((*self.bounds, math.inf), self.counts):
+            running += n
+            out.append(("+Inf" if bound == math.inf else repr(bound), running))
+        return out
+
+
+def _key(name: str, labels: dict[str, object]) -> tuple[str, tuple[tuple[str, str], ...]]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels: object) -> None:
+    """Add `value` to a counter, e.g. inc("detector_pool_acquire_total", detector="haar", outcome="reused")."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels: object) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = float(value)
+
+
+def observe(name: str, value: float, **labels: object) -> None:
+    """Record one observation (seconds for *_seconds histograms), e.g. observe("match_seconds", 0.0004, kind="single")."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram(DEFAULT_BUCKETS)
+        histogram.observe(value)
+
+
+@contextmanager
+def timer(name: str, **labels: object) -> Iterator[dict[str, object]]:
+    """Observe the wall time of a block into histogram `name`. Yields the label dict, so labels known
+    only at the end (an outcome) can be filled in by the block: `with timer("x") as l: l["outcome"] = "hit"`."""
+    started = time.perf_counter()
+    try:
+        with tracing.span(name.removesuffix("_seconds"), **labels) as span:
+            if isinstance(span, tracing.Span):
+                labels = span.attrs  # same dict the block updates, so the span shows the final labels
+            yield labels
+    finally:
+        observe(name, time.perf_counter() - started, **{k: v for k, v in labels.items() if k != "error"})
+
+
+def _format(key: tuple[str, tuple[tuple[str, str], ...]]) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def snapshot() -> dict[str, dict]:
+    """{"counters": {'name{label="v"}': value}, "gauges": {...}, "histograms": {...: {count, sum, buckets}}}."""
+    with _lock:
+        return {
+            "counters": {_format(k): v for k, v in sorted(_counters.items())},
+            "gauges": {_format(k): v for k, v in sorted(_gauges.items())},
+            "histograms": {
+                _format(k): {"count": h.count, "sum": round(h.sum, 6), "buckets": dict(h.cumulative())}
+                for k, h in sorted(_histograms.items())
+            },
+        }
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: tuple[tuple[str, str], ...], extra: tuple[str, str] | None = None) -> str:
+    pairs = [*labels, extra] if extra else list(labels)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render_prometheus() -> str:
+    """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = [(k, h.count, h.sum, h.cumulative()) for k, h in sorted(_histograms.items())]
+    lines: list[str] = []
+    typed: set[str] = set()
+
+    def declare(name: str, kind: str) -> None:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value!r}")
+    for (name, labels), value in gauges:
+        declare(name, "gauge")
+        lines.append(f"{name}{_labels(labels)} {value!r}")
+    for (name, labels), count, total, buckets in histograms:
+        declare(name, "histogram")
+        for le, n in buckets:
+            lines.append(f"{name}_bucket{_labels(labels, ('le', le))} {n}")
+        lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,238 @@
+"""Opt-in per-request tracing: a span tree of cascade stages, model calls, store calls and matching.
+
+A request is traced when it sends `X-Trace: 1` (or `?trace=1`); `X-Trace: profile` (or `?trace=profile`)
+also runs a cProfile over the work the request hands to the executor pools. Tracing is off unless
+TRACE_TOKEN is set, and the request must send that token in `X-Trace-Token`. The finished trace is kept
+in an in-memory ring of the last TRACE_STORE_SIZE traces, its id is returned in the `X-Trace-Id` response
+header, and it is served by `GET /api/traces/{trace_id}` (which requires the same token).
+
+Untraced requests pay one ContextVar lookup per span. Spans cross into executor threads through
+`bind()`, which `core.executors` applies only while a trace is active.
+"""
+from __future__ import annotations
+import contextvars
+import cProfile
+import hmac
+import io
+import pstats
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from config import TRACE_PROFILE_TOP, TRACE_STORE_SIZE, TRACE_TOKEN
+
+_current_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("trace_span", default=None)
+
+# cProfile can only be attached to one thread's work at a time safely; a second profiled job runs unprofiled
+_profile_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "end", "children", "events", "thread")
+
+    def __init__(self, name: str, attrs: dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.children: list[Span] = []
+        self.events: list[tuple[float, str, dict[str, Any]]] = []
+        self.thread = threading.current_thread().name
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def as_dict(self, origin: float) -> dict:
+        out: dict[str, Any] = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(((self.end or time.perf_counter()) - self.start) * 1000, 3),
+            "thread": self.thread,
+        }
+        if self.attrs:
+            out["attrs"] = {k: v if isinstance(v, (int, float, bool)) or v is None else str(v) for k, v in self.attrs.items()}
+        if self.events:
+            out["events"] = [
+                {"at_ms": round((t - origin) * 1000, 3), "name": name, **fields} for t, name, fields in self.events
+            ]
+        if self.children:
+            out["children"] = [child.as_dict(origin) for child in list(self.children)]
+        return out
+
+
+class _NullSpan:
+    """Returned by `span()` when nothing is being traced."""
+
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    def __init__(self, name: str, profile: bool = False):
+        self.id = uuid.uuid4().hex[:16]
+        self.profile = profile
+        self.root = Span(name, {})
+        self.started_at = time.time()
+        self._stats: pstats.Stats | None = None
+        self._stats_lock = threading.Lock()
+        self._tokens: tuple = ()
+
+    def add_profile(self, profiler: cProfile.Profile) -> None:
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def as_dict(self) -> dict:
+        out = {
+            "trace_id": self.id,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+            "span": self.root.as_dict(self.root.start),
+        }
+        if self.profile:
+            with self._stats_lock:
+                if self._stats is None:
+                    out["profile"] = None
+                else:
+                    buf = io.StringIO()
+                    self._stats.stream = buf
+                    self._stats.sort_stats("cumulative").print_stats(TRACE_PROFILE_TOP)
+                    out["profile"] = buf.getvalue()
+        return out
+
+
+_store: OrderedDict[str, Trace] = OrderedDict()
+_store_lock = threading.Lock()
+
+
+def authorized(token: str | None) -> bool:
+    """Whether an `X-Trace-Token` value may start traces and read stored ones (never without TRACE_TOKEN:
+    traces hold other users' class and student ids, and profiling costs inference time)."""
+    return bool(TRACE_TOKEN) and token is not None and hmac.compare_digest(token.encode(), TRACE_TOKEN.encode())
+
+
+def requested(flag: str | None, token: str | None = None) -> str | None:
+    """Trace mode asked for by an `X-Trace` header / `trace` query value: None, "trace" or "profile"."""
+    if not flag or TRACE_STORE_SIZE <= 0 or not authorized(token):
+        return None
+    flag = flag.strip().lower()
+    if flag == "profile":
+        return "profile"
+    return "trace" if flag in ("1", "true", "yes", "trace") else None
+
+
+def start(name: str, profile: bool = False) -> Trace:
+    """Start a trace in the current context (the request's middleware)."""
+    trace = Trace(name, profile=profile)
+    trace._tokens = (_current_trace.set(trace), _current_span.set(trace.root))
+    return trace
+
+
+def finish(trace: Trace, **attrs: Any) -> None:
+    """End the trace started by `start()` in this context and keep it in the ring."""
+    trace.root.end = time.perf_counter()
+    trace.root.set(**attrs)
+    trace_token, span_token = trace._tokens
+    _current_span.reset(span_token)
+    _current_trace.reset(trace_token)
+    with _store_lock:
+        _store[trace.id] = trace
+        while len(_store) > TRACE_STORE_SIZE:
+            _store.popitem(last=False)
+
+
+def get(trace_id: str) -> dict | None:
+    with _store_lock:
+        trace = _store.get(trace_id)
+    return trace.as_dict() if trace is not None else None
+
+
+def recent() -> list[dict]:
+    """Newest first: id, request and duration of every stored trace."""
+    with _store_lock:
+        traces = list(_store.values())
+    return [
+        {
+            "trace_id": t.id,
+            "name": t.root.name,
+            "duration_ms": round(((t.root.end or time.perf_counter()) - t.root.start) * 1000, 3),
+            "status": t.root.attrs.get("status"),
+        }
+        for t in reversed(traces)
+    ]
+
+
+def active() -> bool:
+    return _current_span.get() is not None
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Span | _NullSpan]:
+    """Child span of the current one; a no-op object when the request is not traced.
+
+    `attrs` is kept by reference, so a caller can pass a dict it fills in later (see `metrics.timer`).
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield _NULL_SPAN
+        return
+    current = Span(name, attrs)
+    parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def event(name: str, **fields: Any) -> bool:
+    """Attach a point-in-time event to the current span. Returns False when the request is not traced."""
+    current = _current_span.get()
+    if current is None:
+        return False
+    current.events.append((time.perf_counter(), name, fields))
+    return True
+
+
+def bind(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap `fn` to run in a copy of the caller's context (so its spans join the trace) and, for a
+    profiled trace, under cProfile. Returns `fn` unchanged when nothing is traced."""
+    trace = _current_trace.get()
+    if trace is None or _current_span.get() is None:
+        return fn
+    context = contextvars.copy_context()
+    if not trace.profile:
+        return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+    def profiled(*args: Any, **kwargs: Any) -> Any:
+        if not _profile_lock.acquire(blocking=False):
+            trace.root.set(profile="partial: another profiled job was running")
+            return context.run(fn, *args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler (e.g. a debugger) owns the hook
+            _profile_lock.release()
+            return context.run(fn, *args, **kwargs)
+        try:
+            return context.run(fn, *args, **kwargs)
+        finally:
+            profiler.disable()
+            _profile_lock.release()
+            trace.add_profile(profiler)
+
+    return profiled
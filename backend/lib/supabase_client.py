@@ -26,3 +26,20 @@ except Exception as e:
     print(f"WARNING: Error initializing Supabase client: {e}")
     print("  Face embeddings will not be saved to Supabase.")
     supabase = None
+
+
+# Async client for async routes (supabase>=2 `acreate_client`); created on first use inside the event loop
+try:
+    from supabase import acreate_client
+except ImportError:
+    acreate_client = None
+
+_async_supabase = None
+
+
+async def get_async_supabase():
+    """Return the async Supabase client, or None when Supabase (or its async client) is unavailable."""
+    global _async_supabase
+    if _async_supabase is None and supabase is not None and acreate_client is not None:
+        _async_supabase = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    return _async_supabase
@@ -3,18 +3,36 @@ Face Attendance API - PyTorch, RetinaFace, InsightFace
 """
 import logging
 import os
-from fastapi import FastAPI
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 
-logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+from core import logs
+
+logs.configure()
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 
 from api.routes import face, health
+from config import WARMUP_ON_STARTUP
+from core import metrics, tracing
+from core.executors import InferenceBusy
+from services.face_service import warm_up
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # โหลดโมเดลล่วงหน้าใน background — /api/ready ตอบ 503 จนกว่าจะพร้อม
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=warm_up, name="model-warmup", daemon=True).start()
+    yield
+
 
 app = FastAPI(
     title="Face Attendance API",
     description="Face detection (RetinaFace) + recognition (DeepFace/Facenet512)",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS Configuration - อ่าน Frontend URLs จาก Environment Variable
@@ -37,12 +55,45 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
 
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    # X-Trace: 1 / ?trace=1 เก็บ span tree ของ request นี้ (profile = แนบ cProfile ด้วย) ดูได้ที่ /api/traces/{id}
+    mode = tracing.requested(
+        request.headers.get("x-trace") or request.query_params.get("trace"),
+        request.headers.get("x-trace-token"),
+    )
+    if mode is None:
+        return await call_next(request)
+    trace = tracing.start(f"{request.method} {request.url.path}", profile=mode == "profile")
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        tracing.finish(trace, status=status)
+    response.headers["X-Trace-Id"] = trace.id
+    return response
+
+@app.exception_handler(InferenceBusy)
+async def inference_busy(request, exc: InferenceBusy):
+    # คิว inference เต็ม: ให้ client ลองใหม่แทนการรอคิวยาวจน timeout
+    return JSONResponse(status_code=503, content={"detail": "ระบบกำลังประมวลผลเต็ม กรุณาลองใหม่อีกครั้ง"}, headers={"Retry-After": "1"})
+
+
 app.include_router(health.router, prefix="/api", tags=["health"])
 app.include_router(face.router, prefix="/api/face", tags=["face"])
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def prometheus_metrics():
+    # สำหรับ Prometheus scrape: counters, gauges และ latency histograms (JSON แบบเดิมอยู่ที่ /api/metrics)
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/", response_class=HTMLResponse)
 def root():
     html = (
@@ -50,7 +101,8 @@ def root():
         "<body style='font-family:sans-serif;max-width:600px;margin:2rem auto;padding:1rem'>"
         "<h1>Face Attendance API</h1><p>Backend ทำงานอยู่</p>"
         "<ul><li><a href='/docs'>/docs</a> — เอกสาร API</li>"
-        "<li><a href='/api/health'>/api/health</a> — ตรวจสอบสถานะ</li></ul>"
+        "<li><a href='/api/health'>/api/health</a> — ตรวจสอบสถานะ</li>"
+        "<li><a href='/api/ready'>/api/ready</a> — โมเดลพร้อมใช้งานหรือยัง</li></ul>"
         "</body></html>"
     )
     return html
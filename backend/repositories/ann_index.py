@@ -0,0 +1,550 @@
+"""Tenant-wide approximate nearest-neighbour index (IVF) for identifying a face across all classrooms.
+
+One inverted-file index per (user_id, embedding dim): rows are L2-normalized embeddings tagged with their
+(classroom_id, student_id). K-means centroids split the rows into `nlist` lists; a query is compared with
+the centroids, then only with the rows of its `nprobe` closest lists, so a 2,000-student school is searched
+by scoring a few hundred rows instead of all of them. Small indexes (< ANN_MIN_ROWS) are scanned exactly.
+
+Files (in ANN_INDEX_DIR):
+- `<user>.<dim>.npz`: snapshot of the live rows, their list numbers, the centroids and a generation.
+- `<user>.<dim>.delta`: append-only log of student updates on top of the snapshot. The first line is
+  {"generation": g}; a delta whose generation differs from the snapshot's is already folded in.
+
+Enroll/delete append one delta line under a file lock and patch the in-memory index in place: new rows
+join the end of their nearest centroid's list and replaced rows are masked out, so an update costs the
+student's own rows. Other workers replay delta lines they have not seen on their next search. A background
+thread folds the delta into a new snapshot, dropping dead rows and retraining the centroids when the index
+doubled, halved or crossed ANN_MIN_ROWS, so the enroll path never rewrites or retrains the index.
+Users whose index was never built are skipped by updates; the first identify builds it from storage.
+"""
+from __future__ import annotations
+import base64
+import json
+import logging
+import os
+import threading
+from typing import Callable, Iterable
+from urllib.parse import quote
+
+import numpy as np
+
+from config import ANN_INDEX_DIR, ANN_MIN_ROWS, ANN_NPROBE
+from core import metrics
+from core.file_lock import file_lock
+from repositories.gallery_index import normalize_rows
+
+logger = logging.getLogger("ann_index")
+
+_KMEANS_ITERATIONS = 10
+_KMEANS_SAMPLE = 65536
+# Fold the delta into a new snapshot after this many lines, so replaying it on startup stays cheap
+_DELTA_COMPACT_ENTRIES = 1000
+
+
+def _nlist_for(rows: int) -> int:
+    # ~4·sqrt(N) lists keeps each list a few dozen rows at school scale
+    return int(max(1, min(rows // 8, round(4 * np.sqrt(rows)))))
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on normalized rows (a sample of them for very large indexes)."""
+    rng = np.random.default_rng(seed)
+    if vectors.shape[0] > _KMEANS_SAMPLE:
+        vectors = vectors[rng.choice(vectors.shape[0], _KMEANS_SAMPLE, replace=False)]
+    nlist = min(nlist, vectors.shape[0])
+    centroids = vectors[rng.choice(vectors.shape[0], nlist, replace=False)].copy()
+    for _ in range(_KMEANS_ITERATIONS):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        moved = norms > 0
+        # Empty lists keep their old centroid
+        centroids[moved] = sums[moved] / norms[moved, None]
+    return centroids
+
+
+class IVFIndex:
+    """Rows of one embedding dim for one user, bucketed by nearest centroid.
+
+    Rows live in capacity-doubling arrays and are only ever appended; `set_student` masks the student's
+    old rows out (`alive`) after appending the new ones. Rows indexed at the last compaction are grouped
+    into contiguous inverted lists; rows appended since keep their list number and are picked up from the
+    tail at search time. A concurrent search reads the row count first, so it never sees a half-written row.
+    """
+
+    def __init__(self, dim: int, centroids: np.ndarray | None = None, trained_rows: int = 0):
+        self.dim = dim
+        self.centroids = centroids
+        self.trained_rows = trained_rows
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._classroom_ids: list[str] = []
+        self._student_ids: list[str] = []
+        self._rows_by_key: dict[tuple[str, str], list[int]] = {}
+        self._size = 0
+        self._live = 0
+        self._index_lists()
+
+    def __len__(self) -> int:
+        """Live rows."""
+        return self._live
+
+    @property
+    def dead_rows(self) -> int:
+        return self._size - self._live
+
+    @classmethod
+    def build(cls, dim: int, items: Iterable[tuple[str, str, np.ndarray]]) -> "IVFIndex":
+        """Build from [(classroom_id, student_id, normalized (n, dim) rows), ...]."""
+        index = cls(dim)
+        for classroom_id, student_id, rows in items:
+            index.set_student(classroom_id, student_id, rows)
+        index.retrain()
+        return index
+
+    def student_count(self, classroom_id: str, student_id: str) -> int:
+        return len(self._rows_by_key.get((classroom_id, student_id), ()))
+
+    def _append(
+        self,
+        classroom_ids: list[str],
+        student_ids: list[str],
+        rows: np.ndarray,
+        lists: np.ndarray | None = None,
+    ) -> None:
+        n, m = self._size, rows.shape[0]
+        if n + m > self._vectors.shape[0]:
+            capacity = max(64, 2 * (n + m))
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            vectors[:n] = self._vectors[:n]
+            row_lists = np.zeros(capacity, dtype=np.int32)
+            row_lists[:n] = self._lists[:n]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:n] = self._alive[:n]
+            self._vectors, self._lists, self._alive = vectors, row_lists, alive
+        if lists is None:
+            lists = np.argmax(rows @ self.centroids.T, axis=1) if self.centroids is not None else 0
+        self._vectors[n:n + m] = rows
+        self._lists[n:n + m] = lists
+        self._alive[n:n + m] = True
+        self._classroom_ids.extend(classroom_ids)
+        self._student_ids.extend(student_ids)
+        for i, key in enumerate(zip(classroom_ids, student_ids)):
+            self._rows_by_key.setdefault(key, []).append(n + i)
+        self._live += m
+        # Published last: searches only look at rows below _size
+        self._size = n + m
+
+    def set_student(self, classroom_id: str, student_id: str, rows: np.ndarray | None) -> None:
+        """Replace one (classroom, student)'s rows in place; None or no rows removes them."""
+        key = (classroom_id, student_id)
+        old = self._rows_by_key.pop(key, [])
+        if rows is not None and rows.shape[0] and rows.shape[1] == self.dim:
+            m = rows.shape[0]
+            self._append([classroom_id] * m, [student_id] * m, rows.astype(np.float32, copy=False))
+        # Masked after the append, so a concurrent search sees the old rows or the new ones, never neither
+        self._alive[old] = False
+        self._live -= len(old)
+
+    def _index_lists(self) -> None:
+        """Group live rows by list: rows of list i are order[offsets[i]:offsets[i + 1]]."""
+        live = np.flatnonzero(self._alive[:self._size])
+        if self.centroids is None:
+            order, offsets = live, np.array([0, live.size], dtype=np.int64)
+        else:
+            lists = self._lists[live]
+            sort = np.argsort(lists, kind="stable")
+            order = live[sort]
+            offsets = np.searchsorted(lists[sort], np.arange(self.centroids.shape[0] + 1))
+        # One tuple so a search never pairs lists with another compaction's offsets
+        self._inverted = (order, offsets, self._size)
+
+    def needs_retrain(self) -> bool:
+        return (
+            (self.centroids is not None) != (self._live >= ANN_MIN_ROWS)
+            or self._live > 2 * max(1, self.trained_rows)
+            or self._live < self.trained_rows // 2
+        )
+
+    def needs_compaction(self) -> bool:
+        """True when the centroids are stale, dead rows dominate, or the unindexed tail got long."""
+        tail = self._size - self._inverted[2]
+        return self.needs_retrain() or self.dead_rows > self._live or tail > max(256, self._inverted[2] // 4)
+
+    def retrain(self) -> None:
+        live = np.flatnonzero(self._alive[:self._size])
+        if live.size < ANN_MIN_ROWS:
+            self.centroids = None
+            self._lists[:self._size] = 0
+        else:
+            self.centroids = train_centroids(self._vectors[live], _nlist_for(live.size))
+            self._lists[live] = np.argmax(self._vectors[live] @ self.centroids.T, axis=1)
+        self.trained_rows = int(live.size)
+        self._index_lists()
+
+    def compacted(self) -> "IVFIndex":
+        """New index with the live rows only, retrained when needed and fully indexed."""
+        live = np.flatnonzero(self._alive[:self._size])
+        index = IVFIndex(self.dim, self.centroids, self.trained_rows)
+        index._append(
+            [self._classroom_ids[i] for i in live],
+            [self._student_ids[i] for i in live],
+            self._vectors[live],
+            self._lists[live],
+        )
+        if index.needs_retrain():
+            index.retrain()
+        else:
+            index._index_lists()
+        return index
+
+    def candidates(self, query: np.ndarray, nprobe: int = ANN_NPROBE) -> np.ndarray:
+        """Live row numbers in the `nprobe` lists closest to `query` (every live row when untrained)."""
+        size = self._size
+        order, offsets, indexed = self._inverted
+        alive = self._alive
+        tail = np.arange(indexed, size)
+        if self.centroids is None:
+            rows = np.concatenate([order, tail])
+        else:
+            nprobe = min(nprobe, self.centroids.shape[0])
+            probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.concatenate(
+                [order[offsets[i]:offsets[i + 1]] for i in probe] + [tail[np.isin(self._lists[indexed:size], probe)]]
+            )
+        return rows[alive[rows]]
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int = 2,
+        nprobe: int = ANN_NPROBE,
+        min_embeddings: int | None = None,
+    ) -> list[tuple[str, str, float]]:
+        """Top-k students for one normalized query: [(student_id, classroom_id, similarity)], best first.
+
+        A student enrolled in several classrooms counts once, with its best-matching row. Students with
+        fewer than `min_embeddings` rows in a classroom are skipped there, like the class gallery does.
+        """
+        rows = self.candidates(query, nprobe)
+        if not rows.size:
+            return []
+        scores = self._vectors[rows] @ query
+        order = np.argsort(-scores, kind="stable")
+        results: list[tuple[str, str, float]] = []
+        seen: set[str] = set()
+        for i in order:
+            row = int(rows[i])
+            student_id, classroom_id = self._student_ids[row], self._classroom_ids[row]
+            if student_id in seen:
+                continue
+            if min_embeddings is not None and self.student_count(classroom_id, student_id) < min_embeddings:
+                continue
+            seen.add(student_id)
+            results.append((student_id, classroom_id, float(scores[i])))
+            if len(results) == k:
+                break
+        return results
+
+    def save(self, path: str, generation: int) -> None:
+        live = np.flatnonzero(self._alive[:self._size])
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            vectors=self._vectors[live],
+            lists=self._lists[live],
+            classroom_ids=np.array([self._classroom_ids[i] for i in live], dtype=str),
+            student_ids=np.array([self._student_ids[i] for i in live], dtype=str),
+            centroids=self.centroids if self.centroids is not None else np.zeros((0, self.dim), dtype=np.float32),
+            trained_rows=np.array(self.trained_rows),
+            generation=np.array(generation),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, dim: int) -> tuple["IVFIndex", int]:
+        """(index, generation) from a snapshot written by `save()`."""
+        with np.load(path, allow_pickle=False) as data:
+            centroids = data["centroids"]
+            index = cls(dim, centroids if centroids.shape[0] else None, int(data["trained_rows"]))
+            # Snapshots from before the delta log have no list numbers or generation
+            lists = data["lists"] if "lists" in data.files else None
+            index._append(data["classroom_ids"].tolist(), data["student_ids"].tolist(), data["vectors"], lists)
+            generation = int(data["generation"]) if "generation" in data.files else 0
+        index._index_lists()
+        return index, generation
+
+
+class _Loaded:
+    """This worker's copy of one index and how far it has read the files behind it."""
+
+    __slots__ = ("index", "generation", "snapshot_signature", "delta_pos", "delta_entries", "delta_signature")
+
+    def __init__(self, index: IVFIndex, generation: int, snapshot_signature: tuple | None):
+        self.index = index
+        self.generation = generation
+        self.snapshot_signature = snapshot_signature
+        self.delta_pos = 0
+        self.delta_entries = 0
+        self.delta_signature: tuple | None = None
+
+
+# {(user_id, dim): _Loaded}
+_indexes: dict[tuple[str, int], _Loaded] = {}
+_lock = threading.Lock()
+_compact_wanted = threading.Event()
+_compact_pending: set[tuple[str, int]] = set()
+_compactor_thread: threading.Thread | None = None
+
+
+def _path(user_id: str, dim: int) -> str:
+    return os.path.join(ANN_INDEX_DIR, f"{quote(user_id, safe='')}.{dim}.npz")
+
+
+def _delta_path(path: str) -> str:
+    return f"{path[:-4]}.delta"
+
+
+def _signature(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _encode_update(classroom_id: str, student_id: str, rows: np.ndarray | None) -> bytes:
+    record = {"c": classroom_id, "s": student_id}
+    if rows is not None and rows.shape[0]:
+        record["rows"] = base64.b64encode(np.ascontiguousarray(rows, dtype="<f4").tobytes()).decode("ascii")
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _apply_update(index: IVFIndex, line: bytes) -> None:
+    record = json.loads(line)
+    rows = None
+    if record.get("rows"):
+        rows = np.frombuffer(base64.b64decode(record["rows"]), dtype="<f4").reshape(-1, index.dim)
+    index.set_student(record["c"], record["s"], rows)
+
+
+def _reset_delta(path: str, generation: int) -> int:
+    """Start an empty delta for `generation`; returns the header length."""
+    header = (json.dumps({"generation": generation}) + "\n").encode("utf-8")
+    tmp = f"{_delta_path(path)}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(header)
+    os.replace(tmp, _delta_path(path))
+    return len(header)
+
+
+def _refresh_locked(user_id: str, dim: int) -> _Loaded | None:
+    """Load the snapshot if it changed and replay unseen delta lines (caller holds the file lock)."""
+    key = (user_id, dim)
+    path = _path(user_id, dim)
+    snapshot_signature = _signature(path)
+    with _lock:
+        loaded = _indexes.get(key)
+    if snapshot_signature is None:
+        with _lock:
+            _indexes.pop(key, None)
+        return None
+    if loaded is None or loaded.snapshot_signature != snapshot_signature:
+        index, generation = IVFIndex.load(path, dim)
+        loaded = _Loaded(index, generation, snapshot_signature)
+
+    delta = _delta_path(path)
+    try:
+        with open(delta, "rb") as f:
+            header = f.readline()
+            try:
+                generation = json.loads(header)["generation"]
+            except (ValueError, KeyError):
+                generation = None
+            if generation == loaded.generation:
+                f.seek(max(loaded.delta_pos, len(header)))
+                tail = f.read()
+    except FileNotFoundError:
+        generation = None
+    if generation != loaded.generation:
+        # Missing, torn or left over from before the last compaction: start a fresh delta
+        loaded.delta_pos = _reset_delta(path, loaded.generation)
+        loaded.delta_entries = 0
+    else:
+        loaded.delta_pos = max(loaded.delta_pos, len(header))
+        complete = tail.rfind(b"\n") + 1
+        for line in tail[:complete].splitlines():
+            if line:
+                _apply_update(loaded.index, line)
+                loaded.delta_entries += 1
+        if complete < len(tail):
+            # Torn line from a worker that crashed mid-append; we hold the lock, so drop it
+            with open(delta, "r+b") as f:
+                f.truncate(loaded.delta_pos + complete)
+        loaded.delta_pos += complete
+    loaded.delta_signature = _signature(delta)
+    with _lock:
+        _indexes[key] = loaded
+    return loaded
+
+
+def _current(user_id: str, dim: int) -> IVFIndex | None:
+    """This worker's copy, caught up with updates other workers wrote (two stat() calls when unchanged)."""
+    path = _path(user_id, dim)
+    with _lock:
+        loaded = _indexes.get((user_id, dim))
+    if (
+        loaded is not None
+        and loaded.snapshot_signature == _signature(path)
+        and loaded.delta_signature == _signature(_delta_path(path))
+    ):
+        return loaded.index
+    if not os.path.exists(path):
+        return None
+    with file_lock(f"{path}.lock"):
+        loaded = _refresh_locked(user_id, dim)
+    return loaded.index if loaded is not None else None
+
+
+def _publish(user_id: str, dim: int, index: IVFIndex, generation: int) -> None:
+    """Write `index` as the snapshot for `generation` with an empty delta (caller holds the file lock)."""
+    path = _path(user_id, dim)
+    # The snapshot is the commit point; a crash before the delta reset just ignores the old delta
+    index.save(path, generation)
+    loaded = _Loaded(index, generation, _signature(path))
+    loaded.delta_pos = _reset_delta(path, generation)
+    loaded.delta_signature = _signature(_delta_path(path))
+    metrics.set_gauge("ann_index_rows", len(index), dim=dim)
+    with _lock:
+        _indexes[(user_id, dim)] = loaded
+
+
+def get_or_build(
+    user_id: str,
+    dim: int,
+    load_rows: Callable[[str], Iterable[tuple[str, str, list]]],
+) -> IVFIndex:
+    """The user's index for `dim`, built from `load_rows(user_id)` ([(classroom_id, student_id, vectors)])
+    when no worker has built it yet."""
+    index = _current(user_id, dim)
+    if index is not None:
+        return index
+    path = _path(user_id, dim)
+    with file_lock(f"{path}.lock"):
+        index = _current(user_id, dim)
+        if index is not None:
+            return index
+        by_dim: dict[int, list[tuple[str, str, np.ndarray]]] = {}
+        for classroom_id, student_id, vectors in load_rows(user_id):
+            rows = normalize_rows([v for v in vectors if len(v)])
+            if rows.shape[0]:
+                by_dim.setdefault(rows.shape[1], []).append((classroom_id, student_id, rows))
+        metrics.inc("ann_index_builds_total")
+        index = IVFIndex.build(dim, by_dim.pop(dim, []))
+        _publish(user_id, dim, index, 0)
+    # Every dim is built from the same load so other models' indexes exist too (one lock at a time)
+    for other_dim, items in by_dim.items():
+        other_path = _path(user_id, other_dim)
+        with file_lock(f"{other_path}.lock"):
+            if not os.path.exists(other_path):
+                _publish(user_id, other_dim, IVFIndex.build(other_dim, items), 0)
+    return index
+
+
+def _dims_on_disk(user_id: str) -> list[int]:
+    prefix = f"{quote(user_id, safe='')}."
+    try:
+        names = os.listdir(ANN_INDEX_DIR)
+    except FileNotFoundError:
+        return []
+    dims = []
+    for name in names:
+        if name.startswith(prefix) and name.endswith(".npz") and name[len(prefix):-4].isdigit():
+            dims.append(int(name[len(prefix):-4]))
+    return dims
+
+
+def set_student(user_id: str, classroom_id: str, student_id: str, embeddings: list) -> None:
+    """Replace one student's rows in the user's built indexes (no-op for users without an index).
+
+    Appends one delta line per index and patches the cached copy in place; compaction and retraining
+    happen on a background thread.
+    """
+    rows = normalize_rows([e for e in embeddings if len(e)]) if len(embeddings) else None
+    new_dim = rows.shape[1] if rows is not None and rows.shape[0] else None
+    for dim in _dims_on_disk(user_id):
+        path = _path(user_id, dim)
+        student_rows = rows if dim == new_dim else None
+        with file_lock(f"{path}.lock"):
+            loaded = _refresh_locked(user_id, dim)
+            if loaded is None or (student_rows is None and not loaded.index.student_count(classroom_id, student_id)):
+                continue
+            line = _encode_update(classroom_id, student_id, student_rows)
+            # Derived data (rebuilt from storage when lost), so no fsync
+            with open(_delta_path(path), "ab") as f:
+                f.write(line)
+            loaded.index.set_student(classroom_id, student_id, student_rows)
+            loaded.delta_pos += len(line)
+            loaded.delta_entries += 1
+            loaded.delta_signature = _signature(_delta_path(path))
+            if loaded.delta_entries >= _DELTA_COMPACT_ENTRIES or loaded.index.needs_compaction():
+                _request_compaction(user_id, dim)
+    # A new model's rows wait for that dim's index to be built by identify
+
+
+def _request_compaction(user_id: str, dim: int) -> None:
+    global _compactor_thread
+    with _lock:
+        _compact_pending.add((user_id, dim))
+        if _compactor_thread is None:
+            _compactor_thread = threading.Thread(target=_compactor, name="ann-index-compactor", daemon=True)
+            _compactor_thread.start()
+    _compact_wanted.set()
+
+
+def _compactor() -> None:
+    while True:
+        _compact_wanted.wait()
+        _compact_wanted.clear()
+        with _lock:
+            keys = list(_compact_pending)
+            _compact_pending.clear()
+        for user_id, dim in keys:
+            try:
+                compact(user_id, dim)
+            except Exception as e:
+                logger.warning("ANN index compaction failed for user=%s dim=%s: %s", user_id, dim, e)
+
+
+def compact(user_id: str, dim: int) -> None:
+    """Fold the delta into a new snapshot without dead rows, retraining the centroids when needed."""
+    path = _path(user_id, dim)
+    with file_lock(f"{path}.lock"):
+        loaded = _refresh_locked(user_id, dim)
+        if loaded is None:
+            return
+        # Searches keep using the old copy until the compacted one is swapped in
+        _publish(user_id, dim, loaded.index.compacted(), loaded.generation + 1)
+    metrics.inc("ann_index_compactions_total")
+
+
+def invalidate(user_id: str | None = None) -> None:
+    """Delete persisted indexes (rebuilt from storage on the next identify)."""
+    with _lock:
+        for key in [k for k in _indexes if user_id is None or k[0] == user_id]:
+            del _indexes[key]
+    if user_id is not None:
+        paths = [_path(user_id, dim) for dim in _dims_on_disk(user_id)]
+    else:
+        try:
+            paths = [os.path.join(ANN_INDEX_DIR, n) for n in os.listdir(ANN_INDEX_DIR) if n.endswith(".npz")]
+        except FileNotFoundError:
+            return
+    for path in paths:
+        for name in (path, _delta_path(path)):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
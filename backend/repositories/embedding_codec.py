@@ -0,0 +1,34 @@
+"""Binary wire format for face embeddings stored in `face_embeddings.embedding_f32`.
+
+An embedding is stored as base64 of its big-endian float32 bytes (the byte order Postgres' `float4send`
+produces, so the SQL backfill and Python agree). Compared to a JSONB array of decimal numbers this is
+~3x smaller on the wire and decodes with one `np.frombuffer` instead of parsing 512 floats.
+"""
+from __future__ import annotations
+import base64
+from typing import Sequence
+
+import numpy as np
+
+WIRE_DTYPE = np.dtype(">f4")
+
+# Model that produces each embedding size (see services.face_service.model_order_for_dim)
+MODEL_BY_DIM = {512: "Facenet512", 128: "Facenet", 4096: "VGG-Face"}
+
+
+def encode(embedding: Sequence[float] | np.ndarray) -> dict:
+    """Return the binary columns for one embedding: embedding_f32, embedding_dim, embedding_norm, model_name."""
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    return {
+        "embedding_f32": base64.b64encode(vector.astype(WIRE_DTYPE).tobytes()).decode("ascii"),
+        "embedding_dim": int(vector.size),
+        "embedding_norm": float(np.linalg.norm(vector)),
+        "model_name": MODEL_BY_DIM.get(int(vector.size)),
+    }
+
+
+def decode(encoded: str) -> np.ndarray:
+    """Decode one `embedding_f32` value into a native float32 vector."""
+    # Postgres' encode(..., 'base64') wraps lines every 76 chars; b64decode skips the newlines
+    return np.frombuffer(base64.b64decode(encoded), dtype=WIRE_DTYPE).astype(np.float32)
+
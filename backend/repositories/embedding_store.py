@@ -1,59 +1,206 @@
-"""Persistent storage for face embeddings using Supabase or JSON fallback."""
+"""Persistent storage for face embeddings using Supabase or a local file fallback."""
 from __future__ import annotations
-import json
-import os
+import logging
+import threading
 import time
-import uuid
-from pathlib import Path
 import numpy as np
 from typing import Optional, Any
 
 try:
-    from lib.supabase_client import supabase
+    from lib.supabase_client import supabase, get_async_supabase
 except Exception as e:
     print(f"WARNING: Could not import Supabase client: {e}")
     supabase = None
 
-# JSON fallback when Supabase not configured
-from config import EMBEDDINGS_DB
+    async def get_async_supabase():
+        return None
+
+# Local fallback when Supabase not configured (memory-mapped vectors + write journal; see local_store)
+from config import (
+    EMBEDDINGS_DB,
+    EMBEDDINGS_INDEX,
+    EMBEDDINGS_JOURNAL,
+    EMBEDDINGS_JOURNAL_COMPACT_ENTRIES,
+    EMBEDDINGS_VECTORS,
+    EMBEDDING_WRITE_JSONB,
+)
+from repositories import ann_index, embedding_codec, gallery_index
+from repositories.local_store import LocalEmbeddingStore
+from core import logs, metrics
+from core.executors import run_io
+
+logger = logging.getLogger("embedding_store")
+
+_local_store: LocalEmbeddingStore | None = None
+_local_store_lock = threading.Lock()
+
+
+def _local() -> LocalEmbeddingStore:
+    global _local_store
+    if _local_store is None:
+        with _local_store_lock:
+            if _local_store is None:
+                _local_store = LocalEmbeddingStore(
+                    EMBEDDINGS_VECTORS,
+                    EMBEDDINGS_INDEX,
+                    legacy_json_path=EMBEDDINGS_DB,
+                    journal_path=EMBEDDINGS_JOURNAL,
+                    compact_entries=EMBEDDINGS_JOURNAL_COMPACT_ENTRIES,
+                )
+    return _local_store
+
 
 def _json_key(user_id: str, classroom_id: str, student_id: str) -> str:
     return f"{user_id}:{classroom_id}:{student_id}"
 
-def _json_load() -> dict:
-    if not os.path.exists(EMBEDDINGS_DB):
-        return {}
-    try:
-        with open(EMBEDDINGS_DB, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def _json_save(data: dict) -> None:
-    Path(EMBEDDINGS_DB).parent.mkdir(parents=True, exist_ok=True)
-    with open(EMBEDDINGS_DB, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=0)
-
 if supabase is None:
     print("=" * 60)
     print("WARNING: Supabase client not initialized!")
-    print("Using JSON file fallback (embeddings.json)")
+    print("Using local file fallback (data/embeddings.f32)")
     print("To enable Supabase:")
     print("1. Create backend/.env file")
     print("2. Add: SUPABASE_URL=https://your-project.supabase.co")
     print("3. Add: SUPABASE_SERVICE_ROLE_KEY=your-service-role-key")
     print("=" * 60)
 
-# Pre-computed normalized embeddings cache: {user_id: {classroom_id: {dim: [(student_id, normalized_emb_matrix, student_indices), ...]}}}}
-_normalized_cache: dict[str, dict[str, dict[int, list[tuple[str, Any, list[int]]]]]] = {}
-_normalized_cache_timestamp: float = 0
+# False once we learn the binary columns do not exist yet (migration not run): fall back to JSONB only
+_binary_columns = True
+
+
+def _execute(op: str, query):
+    """`query.execute()`, timed into supabase_request_seconds{op, outcome}."""
+    with metrics.timer("supabase_request_seconds", op=op, outcome="error") as labels:
+        response = query.execute()
+        labels["outcome"] = "ok"
+    return response
+
+
+async def _aexecute(op: str, query):
+    """Async `_execute()` for queries built on the async client."""
+    with metrics.timer("supabase_request_seconds", op=op, outcome="error") as labels:
+        response = await query.execute()
+        labels["outcome"] = "ok"
+    return response
+
+
+def _missing_binary_columns(error: Exception) -> bool:
+    return "embedding_f32" in str(error) or "embedding_dim" in str(error)
+
+
+def _disable_binary_columns(error: Exception) -> None:
+    global _binary_columns
+    _binary_columns = False
+    print(f"WARNING: face_embeddings has no binary embedding columns ({error}); using JSONB `embedding`.")
+    print("Run scripts/migrate-face-embeddings-binary.sql to cut class load payload and parse time.")
+
+
+def _attach_vectors(rows: list[dict]) -> list[dict]:
+    """Decode `embedding_f32` into a float32 `vector` on every row.
+
+    Rows written before the migration was backfilled have no binary value; their JSONB embedding is fetched
+    with one extra query by id.
+    """
+    legacy_ids = [row["id"] for row in rows if not row.get("embedding_f32")]
+    legacy: dict[str, list[float]] = {}
+    if legacy_ids:
+        response = _execute("select_legacy", supabase.table("face_embeddings").select("id, embedding").in_("id", legacy_ids))
+        legacy = {row["id"]: row["embedding"] for row in response.data}
+    return _decode_vectors(rows, legacy)
+
+
+def _decode_vectors(rows: list[dict], legacy: dict[str, list[float]]) -> list[dict]:
+    for row in rows:
+        encoded = row.pop("embedding_f32", None)
+        if encoded:
+            row["vector"] = embedding_codec.decode(encoded)
+        else:
+            row["vector"] = np.asarray(legacy.get(row["id"]) or [], dtype=np.float32)
+    return rows
+
+
+def _select_with_vectors(columns: str, apply_filters, op: str) -> list[dict]:
+    """Select face_embeddings rows (`columns` plus id) with each embedding decoded into `row["vector"]`.
+
+    `apply_filters(query)` adds the eq/in/order clauses. Binary columns are read when present; only
+    the JSONB column is read when the table has not been migrated yet.
+    """
+    if _binary_columns:
+        try:
+            query = supabase.table("face_embeddings").select(f"id, {columns}, embedding_f32")
+            return _attach_vectors(_execute(op, apply_filters(query)).data)
+        except Exception as e:
+            if not _missing_binary_columns(e):
+                raise
+            _disable_binary_columns(e)
+    query = supabase.table("face_embeddings").select(f"id, {columns}, embedding")
+    return _decode_jsonb(_execute(op, apply_filters(query)).data)
+
+
+def _decode_jsonb(rows: list[dict]) -> list[dict]:
+    for row in rows:
+        row["vector"] = np.asarray(row.pop("embedding") or [], dtype=np.float32)
+    return rows
+
+
+async def _aselect_with_vectors(client, columns: str, apply_filters, op: str) -> list[dict]:
+    """`_select_with_vectors()` over the async Supabase client (no thread held while waiting on HTTP)."""
+    if _binary_columns:
+        try:
+            query = client.table("face_embeddings").select(f"id, {columns}, embedding_f32")
+            rows = (await _aexecute(op, apply_filters(query))).data
+            legacy_ids = [row["id"] for row in rows if not row.get("embedding_f32")]
+            legacy: dict[str, list[float]] = {}
+            if legacy_ids:
+                response = await _aexecute(
+                    "select_legacy", client.table("face_embeddings").select("id, embedding").in_("id", legacy_ids)
+                )
+                legacy = {row["id"]: row["embedding"] for row in response.data}
+            return _decode_vectors(rows, legacy)
+        except Exception as e:
+            if not _missing_binary_columns(e):
+                raise
+            _disable_binary_columns(e)
+    query = client.table("face_embeddings").select(f"id, {columns}, embedding")
+    return _decode_jsonb((await _aexecute(op, apply_filters(query))).data)
+
+
+def _insert_embedding(row: dict, embedding: list[float]) -> None:
+    """Insert one face_embeddings row, writing the binary columns (and JSONB while migrating)."""
+    if _binary_columns:
+        payload = {**row, **embedding_codec.encode(embedding)}
+        if EMBEDDING_WRITE_JSONB:
+            payload["embedding"] = embedding
+        try:
+            _execute("insert", supabase.table("face_embeddings").insert(payload))
+            return
+        except Exception as e:
+            if not _missing_binary_columns(e):
+                raise
+            _disable_binary_columns(e)
+    _execute("insert", supabase.table("face_embeddings").insert({**row, "embedding": embedding}))
 
 
-def invalidate_cache() -> None:
-    """Force cache invalidation - call after external modifications."""
-    global _normalized_cache, _normalized_cache_timestamp
-    _normalized_cache = {}
-    _normalized_cache_timestamp = 0
+def invalidate_cache(user_id: str | None = None, classroom_id: str | None = None) -> None:
+    """Force cache invalidation - call after external modifications.
+
+    With no arguments every cached class gallery is dropped; pass user_id/classroom_id to scope it.
+    """
+    gallery_index.invalidate(user_id, classroom_id)
+    ann_index.invalidate(user_id)
+
+
+def _student_changed(user_id: str, classroom_id: str, student_id: str, embeddings: list) -> None:
+    """Propagate a student's new rows (empty = removed) to the class gallery cache and the tenant ANN index."""
+    if len(embeddings):
+        gallery_index.patch_student(user_id, classroom_id, student_id, embeddings)
+    else:
+        gallery_index.drop_student(user_id, classroom_id, student_id)
+    try:
+        ann_index.set_student(user_id, classroom_id, student_id, embeddings)
+    except Exception as e:
+        # The write already succeeded; rebuild the index from storage on the next identify instead
+        logger.warning("ANN index update failed for user=%s: %s", user_id, e)
+        ann_index.invalidate(user_id)
 
 
 def add_embedding(
@@ -66,41 +213,119 @@ def add_embedding(
     """Add embedding. Max 5 per (user, classroom, student). Returns new count."""
     if supabase is not None:
         try:
-            existing = get_embeddings(user_id, classroom_id, student_id)
+            existing = _select_with_vectors(
+                "enrolled_at",
+                lambda q: q.eq("user_id", user_id)
+                .eq("classroom_id", classroom_id)
+                .eq("student_id", student_id)
+                .order("enrolled_at", desc=False),
+                op="load_student",
+            )
             if len(existing) >= 5:
                 oldest = existing[0]
-                supabase.table("face_embeddings").delete().eq("id", oldest["id"]).execute()
-
-            supabase.table("face_embeddings").insert({
-                "user_id": user_id,
-                "classroom_id": classroom_id,
-                "student_id": student_id,
-                "embedding": embedding,
-                "confidence": confidence,
-            }).execute()
-            invalidate_cache()
+                _execute("delete_one", supabase.table("face_embeddings").delete().eq("id", oldest["id"]))
+                existing = existing[1:]
+
+            _insert_embedding(
+                {
+                    "user_id": user_id,
+                    "classroom_id": classroom_id,
+                    "student_id": student_id,
+                    "confidence": confidence,
+                },
+                embedding,
+            )
+            _student_changed(
+                user_id, classroom_id, student_id, [r["vector"] for r in existing] + [embedding]
+            )
             return len(existing) + 1
         except Exception as e:
-            print(f"Error adding embedding: {e}")
+            logger.warning("Error adding embedding: %s", e)
             raise
 
-    # JSON fallback
-    key = _json_key(user_id, classroom_id, student_id)
-    data = _json_load()
-    if key not in data:
-        data[key] = []
-    arr = data[key]
-    if len(arr) >= 5:
-        arr.pop(0)
-    arr.append({
-        "id": str(uuid.uuid4()),
-        "embedding": embedding,
-        "confidence": confidence,
-        "enrolledAt": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
-    })
-    _json_save(data)
-    invalidate_cache()
-    return len(arr)
+    # Local fallback
+    records = _local().add(
+        _json_key(user_id, classroom_id, student_id),
+        embedding,
+        confidence,
+        time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+    )
+    _student_changed(user_id, classroom_id, student_id, [r["embedding"] for r in records])
+    return len(records)
+
+
+# False once we learn the enroll_face_embedding function does not exist (migration not run)
+_enroll_rpc = True
+
+
+def _missing_enroll_rpc(error: Exception) -> bool:
+    return "enroll_face_embedding" in str(error)
+
+
+def enroll_embedding(
+    user_id: str,
+    classroom_id: str,
+    student_id: str,
+    embedding: list[float],
+    confidence: float,
+    max_per_student: int = 5,
+) -> int:
+    """Store one enrolled embedding in a single atomic write. Returns the student's new count.
+
+    Rows from another model (different dim) are replaced, and the oldest rows beyond `max_per_student`
+    are evicted, in the same transaction as the insert: one `enroll_face_embedding` RPC round trip on
+    Supabase (scripts/migrate-face-embeddings-enroll-rpc.sql), one journal write locally.
+    """
+    global _enroll_rpc
+    if supabase is not None:
+        if _enroll_rpc and _binary_columns:
+            encoded = embedding_codec.encode(embedding)
+            params = {
+                "p_user_id": user_id,
+                "p_classroom_id": classroom_id,
+                "p_student_id": student_id,
+                "p_embedding_f32": encoded["embedding_f32"],
+                "p_embedding_dim": encoded["embedding_dim"],
+                "p_embedding_norm": encoded["embedding_norm"],
+                "p_model_name": encoded["model_name"],
+                "p_confidence": confidence,
+                "p_embedding": embedding if EMBEDDING_WRITE_JSONB else None,
+                "p_max_per_student": max_per_student,
+            }
+            try:
+                rows = _execute("rpc_enroll", supabase.rpc("enroll_face_embedding", params)).data or []
+            except Exception as e:
+                if not _missing_enroll_rpc(e):
+                    logger.warning("Error enrolling embedding: %s", e)
+                    raise
+                _enroll_rpc = False
+                print(f"WARNING: enroll_face_embedding RPC not available ({e}); enroll uses separate queries.")
+                print("Run scripts/migrate-face-embeddings-enroll-rpc.sql to make enroll one round trip.")
+            else:
+                vectors = [row["vector"] for row in _attach_vectors(rows)]
+                _student_changed(user_id, classroom_id, student_id, vectors)
+                return len(vectors)
+
+        # Not atomic: clear rows of another model, then the usual evict + insert
+        existing = _select_with_vectors(
+            "student_id",
+            lambda q: q.eq("user_id", user_id).eq("classroom_id", classroom_id).eq("student_id", student_id),
+            op="load_student",
+        )
+        if any(r["vector"].shape[0] != len(embedding) for r in existing):
+            remove_all(user_id, classroom_id, student_id)
+        return add_embedding(user_id, classroom_id, student_id, embedding, confidence)
+
+    records = _local().add(
+        _json_key(user_id, classroom_id, student_id),
+        embedding,
+        confidence,
+        time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        max_per_key=max_per_student,
+        replace_other_dims=True,
+    )
+    _student_changed(user_id, classroom_id, student_id, [r["embedding"] for r in records])
+    return len(records)
 
 
 def get_embeddings(
@@ -111,27 +336,24 @@ def get_embeddings(
     """Get all embeddings for (user, classroom, student)."""
     if supabase is not None:
         try:
-            response = (
-                supabase.table("face_embeddings")
-                .select("*")
-                .eq("user_id", user_id)
+            rows = _select_with_vectors(
+                "confidence, enrolled_at",
+                lambda q: q.eq("user_id", user_id)
                 .eq("classroom_id", classroom_id)
                 .eq("student_id", student_id)
-                .order("enrolled_at", desc=False)
-                .execute()
+                .order("enrolled_at", desc=False),
+                op="load_student",
             )
             return [
-                {"id": row["id"], "embedding": row["embedding"], "confidence": row["confidence"], "enrolledAt": row["enrolled_at"]}
-                for row in response.data
+                {"id": row["id"], "embedding": row["vector"].tolist(), "confidence": row["confidence"], "enrolledAt": row["enrolled_at"]}
+                for row in rows
             ]
         except Exception as e:
-            print(f"Error getting embeddings: {e}")
+            logger.warning("Error getting embeddings: %s", e)
             return []
 
-    key = _json_key(user_id, classroom_id, student_id)
-    data = _json_load()
-    arr = data.get(key, [])
-    return [{"id": r["id"], "embedding": r["embedding"], "confidence": r["confidence"], "enrolledAt": r["enrolledAt"]} for r in arr]
+    records = _local().records(_json_key(user_id, classroom_id, student_id))
+    return [{"id": r["id"], "embedding": r["embedding"].tolist(), "confidence": r["confidence"], "enrolledAt": r["enrolledAt"]} for r in records]
 
 
 def get_count(
@@ -140,6 +362,8 @@ def get_count(
     student_id: str,
 ) -> int:
     """Get count of embeddings for (user, classroom, student)."""
+    if supabase is None:
+        return _local().count(_json_key(user_id, classroom_id, student_id))
     return len(get_embeddings(user_id, classroom_id, student_id))
 
 
@@ -151,19 +375,18 @@ def remove_all(
     """Remove all embeddings for (user, classroom, student)."""
     if supabase is not None:
         try:
-            supabase.table("face_embeddings").delete().eq("user_id", user_id).eq("classroom_id", classroom_id).eq("student_id", student_id).execute()
-            invalidate_cache()
+            _execute(
+                "delete_student",
+                supabase.table("face_embeddings").delete().eq("user_id", user_id).eq("classroom_id", classroom_id).eq("student_id", student_id),
+            )
+            _student_changed(user_id, classroom_id, student_id, [])
             return
         except Exception as e:
-            print(f"Error removing embeddings: {e}")
+            logger.warning("Error removing embeddings: %s", e)
             raise
 
-    key = _json_key(user_id, classroom_id, student_id)
-    data = _json_load()
-    if key in data:
-        del data[key]
-        _json_save(data)
-    invalidate_cache()
+    _local().remove(_json_key(user_id, classroom_id, student_id))
+    _student_changed(user_id, classroom_id, student_id, [])
 
 
 def remove_by_index(
@@ -177,25 +400,21 @@ def remove_by_index(
         try:
             embeddings = get_embeddings(user_id, classroom_id, student_id)
             if 0 <= index < len(embeddings):
-                supabase.table("face_embeddings").delete().eq("id", embeddings[index]["id"]).execute()
-                invalidate_cache()
+                _execute("delete_one", supabase.table("face_embeddings").delete().eq("id", embeddings[index]["id"]))
+                remaining = embeddings[:index] + embeddings[index + 1:]
+                _student_changed(user_id, classroom_id, student_id, [r["embedding"] for r in remaining])
             return len(embeddings) - (1 if 0 <= index < len(embeddings) else 0)
         except Exception as e:
-            print(f"Error removing embedding by index: {e}")
+            logger.warning("Error removing embedding by index: %s", e)
             return len(get_embeddings(user_id, classroom_id, student_id))
 
+    store = _local()
     key = _json_key(user_id, classroom_id, student_id)
-    data = _json_load()
-    arr = list(data.get(key, []))
-    if 0 <= index < len(arr):
-        arr.pop(index)
-        if arr:
-            data[key] = arr
-        elif key in data:
-            del data[key]
-        _json_save(data)
-        invalidate_cache()
-    return len(arr)
+    before = store.count(key)
+    remaining = store.remove_at(key, index)
+    if len(remaining) != before:
+        _student_changed(user_id, classroom_id, student_id, [r["embedding"] for r in remaining])
+    return len(remaining)
 
 
 def get_all_for_class(
@@ -203,37 +422,99 @@ def get_all_for_class(
     classroom_id: str,
 ) -> list[tuple[str, list[list[float]]]]:
     """Returns [(student_id, [emb1, emb2, ...]), ...] for classroom."""
+    try:
+        return [
+            (sid, [e.tolist() if isinstance(e, np.ndarray) else e for e in embs])
+            for sid, embs in _load_all_for_class(user_id, classroom_id)
+        ]
+    except Exception as e:
+        logger.warning("Error getting embeddings for class: %s", e)
+        return []
+
+
+def _load_all_for_class(
+    user_id: str,
+    classroom_id: str,
+) -> list[tuple[str, list]]:
+    """Same as `get_all_for_class()` but lets storage errors propagate (so failures are never cached).
+
+    Supabase rows come back as float32 NumPy vectors decoded from the binary column, not Python lists.
+    """
+    if supabase is not None:
+        return _group_by_student(_select_with_vectors("student_id", _class_filter(user_id, classroom_id), op="load_class"))
+
+    return list(_local().vectors_by_suffix(f"{user_id}:{classroom_id}:"))
+
+
+def _class_filter(user_id: str, classroom_id: str):
+    return lambda q: q.eq("user_id", user_id).eq("classroom_id", classroom_id).order("enrolled_at", desc=False)
+
+
+def _group_by_student(rows: list[dict]) -> list[tuple[str, list]]:
+    by_student: dict[str, list] = {}
+    for row in rows:
+        sid = row["student_id"]
+        if sid not in by_student:
+            by_student[sid] = []
+        by_student[sid].append(row["vector"])
+    return [(sid, embs) for sid, embs in by_student.items() if embs]
+
+
+def get_embeddings_for_students(
+    user_id: str,
+    classroom_id: str,
+    student_ids: list[str],
+) -> dict[str, list]:
+    """Full-precision embeddings of a few students in a class: {student_id: [emb, ...]}.
+
+    Used to re-rank ambiguous hits from a quantized gallery; one query regardless of how many students.
+    """
+    if not student_ids:
+        return {}
+    by_student: dict[str, list[list[float]]] = {}
     if supabase is not None:
         try:
-            response = (
-                supabase.table("face_embeddings")
-                .select("*")
-                .eq("user_id", user_id)
-                .eq("classroom_id", classroom_id)
-                .order("enrolled_at", desc=False)
-                .execute()
-            )
-            by_student: dict[str, list[list[float]]] = {}
-            for row in response.data:
-                sid = row["student_id"]
-                if sid not in by_student:
-                    by_student[sid] = []
-                by_student[sid].append(row["embedding"])
-            return [(sid, embs) for sid, embs in by_student.items() if embs]
+            rows = _select_with_vectors("student_id", _students_filter(user_id, classroom_id, student_ids), op="load_students")
+            for row in rows:
+                by_student.setdefault(row["student_id"], []).append(row["vector"])
         except Exception as e:
-            print(f"Error getting embeddings for class: {e}")
-            return []
+            logger.warning("Error getting embeddings for students: %s", e)
+        return by_student
+
+    store = _local()
+    for sid in student_ids:
+        records = store.records(_json_key(user_id, classroom_id, sid))
+        if records:
+            by_student[sid] = [r["embedding"] for r in records]
+    return by_student
+
+
+def _students_filter(user_id: str, classroom_id: str, student_ids: list[str]):
+    return lambda q: (
+        q.eq("user_id", user_id)
+        .eq("classroom_id", classroom_id)
+        .in_("student_id", list(student_ids))
+        .order("enrolled_at", desc=False)
+    )
 
-    prefix = f"{user_id}:{classroom_id}:"
-    data = _json_load()
-    by_student: dict[str, list[list[float]]] = {}
-    for k, arr in data.items():
-        if k.startswith(prefix):
-            student_id = k[len(prefix):]
-            embs = [r["embedding"] for r in arr]
-            if embs:
-                by_student[student_id] = embs
-    return [(sid, embs) for sid, embs in by_student.items() if embs]
+
+async def aget_embeddings_for_students(
+    user_id: str,
+    classroom_id: str,
+    student_ids: list[str],
+) -> dict[str, list]:
+    """Async `get_embeddings_for_students()`: async Supabase client when available, else the I/O pool."""
+    client = await get_async_supabase() if supabase is not None and student_ids else None
+    if client is None:
+        return await run_io(get_embeddings_for_students, user_id, classroom_id, student_ids)
+    by_student: dict[str, list] = {}
+    try:
+        filters = _students_filter(user_id, classroom_id, student_ids)
+        for row in await _aselect_with_vectors(client, "student_id", filters, op="load_students"):
+            by_student.setdefault(row["student_id"], []).append(row["vector"])
+    except Exception as e:
+        logger.warning("Error getting embeddings for students: %s", e)
+    return by_student
 
 
 def get_counts_for_class(
@@ -247,40 +528,31 @@ def get_counts_for_class(
     if supabase is not None:
         try:
             # Only fetch student_id (embedding is large); count in Python.
-            print(f"[get_counts_for_class] Querying for user_id={user_id}, classroom_id={classroom_id}")
-            response = (
+            response = _execute(
+                "count_class",
                 supabase.table("face_embeddings")
                 .select("student_id")
                 .eq("user_id", user_id)
-                .eq("classroom_id", classroom_id)
-                .execute()
+                .eq("classroom_id", classroom_id),
             )
             counts: dict[str, int] = {}
-            print(f"[get_counts_for_class] Response data rows: {len(response.data)}")
+            missing = 0
             for row in response.data:
                 sid = row.get("student_id")
                 if not sid:
-                    print(f"[get_counts_for_class] WARNING: Row missing student_id: {row}")
+                    missing += 1
                     continue
                 counts[sid] = counts.get(sid, 0) + 1
-            print(f"[get_counts_for_class] Found {len(counts)} students with enrollments: {list(counts.keys())}")
-            print(f"[get_counts_for_class] Counts detail: {counts}")
+            if missing:
+                logs.sampled(logger, "rows_without_student_id", op="count_class", classroom_id=classroom_id, rows=missing)
+            logs.event(logger, "counts_for_class", level=logging.DEBUG, classroom_id=classroom_id, rows=len(response.data), students=len(counts))
             return counts
-        except Exception as e:
-            print(f"[get_counts_for_class] Error getting counts for class: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("get_counts_for_class failed: user=%s class=%s", user_id, classroom_id)
             return {}
 
-    # JSON fallback
-    prefix = f"{user_id}:{classroom_id}:"
-    data = _json_load()
-    counts: dict[str, int] = {}
-    for k, arr in data.items():
-        if k.startswith(prefix):
-            student_id = k[len(prefix):]
-            counts[student_id] = len(arr or [])
-    return counts
+    # Local fallback: counts come from the index, vectors are never read
+    return _local().counts(f"{user_id}:{classroom_id}:")
 
 
 def get_normalized_embeddings_for_class(
@@ -292,46 +564,93 @@ def get_normalized_embeddings_for_class(
     Returns: {dim: [(student_id, normalized_emb_matrix, original_indices), ...]}
     where normalized_emb_matrix is (n_embeddings, dim) array, original_indices maps to original embedding list.
     When min_embeddings is set, only include students with at least that many embeddings (e.g. 5 for attendance).
+
+    Served from the in-process class gallery index; storage is only read when the class is not warm.
     """
-    global _normalized_cache, _normalized_cache_timestamp
-
-    current_time = time.time()
-
-    # Check cache
-    cache_key = f"{user_id}:{classroom_id}"
-    if cache_key not in _normalized_cache:
-        _normalized_cache[cache_key] = {}
-
-    class_cache = _normalized_cache[cache_key]
-    candidates = get_all_for_class(user_id, classroom_id)
-    if min_embeddings is not None:
-        candidates = [(sid, embs) for sid, embs in candidates if len(embs) >= min_embeddings]
-
-    # Group by dimension
-    by_dim: dict[int, list[tuple[str, list[list[float]]]]] = {}
-    for student_id, embs in candidates:
-        if not embs:
-            continue
-        dim = len(embs[0])
-        if dim not in by_dim:
-            by_dim[dim] = []
-        by_dim[dim].append((student_id, embs))
-
-    # Pre-compute normalized matrices for each dimension
-    result: dict[int, list[tuple[str, Any, list[int]]]] = {}
-    for dim, students_embs in by_dim.items():
-        if dim not in class_cache:
-            normalized_list = []
-            for student_id, embs in students_embs:
-                # Convert to numpy and normalize
-                emb_matrix = np.array(embs, dtype=np.float32)
-                norms = np.linalg.norm(emb_matrix, axis=1, keepdims=True)
-                norms[norms == 0] = 1  # Avoid division by zero
-                normalized = emb_matrix / norms
-                # Store original indices (0, 1, 2, ...) for mapping back
-                normalized_list.append((student_id, normalized, list(range(len(embs)))))
-            class_cache[dim] = normalized_list
-        result[dim] = class_cache[dim]
-
-    _normalized_cache_timestamp = current_time
-    return result
+    return get_class_gallery(user_id, classroom_id).by_dim(min_embeddings)
+
+
+def get_class_gallery(user_id: str, classroom_id: str) -> gallery_index.ClassGallery:
+    """Return the warm gallery for a class, loading it from storage once on a miss."""
+    started = time.perf_counter()
+    gallery = gallery_index.get(user_id, classroom_id)
+    if gallery is not None:
+        metrics.observe("gallery_load_seconds", time.perf_counter() - started, outcome="hit")
+        return gallery
+    loaded_version = gallery_index.version(user_id, classroom_id)
+    try:
+        rows = _load_all_for_class(user_id, classroom_id)
+    except Exception as e:
+        # Serve an empty (uncached) gallery like before; the next request retries the load.
+        logger.warning("Error getting embeddings for class: %s", e)
+        metrics.observe("gallery_load_seconds", time.perf_counter() - started, outcome="error")
+        return gallery_index.ClassGallery()
+    gallery = _cache_gallery(user_id, classroom_id, rows, loaded_version)
+    metrics.observe("gallery_load_seconds", time.perf_counter() - started, outcome="miss")
+    return gallery
+
+
+def _cache_gallery(user_id: str, classroom_id: str, rows: list, loaded_version: tuple) -> gallery_index.ClassGallery:
+    gallery = gallery_index.ClassGallery(dict(rows))
+    gallery_index.put(user_id, classroom_id, gallery, loaded_version)
+    return gallery
+
+
+async def aget_class_gallery(user_id: str, classroom_id: str) -> gallery_index.ClassGallery:
+    """Async `get_class_gallery()`: a warm class never leaves the event loop; a cold one is read with the
+    async Supabase client (or on the I/O pool for the local store) and built on the I/O pool."""
+    started = time.perf_counter()
+    gallery = gallery_index.get(user_id, classroom_id)
+    if gallery is not None:
+        metrics.observe("gallery_load_seconds", time.perf_counter() - started, outcome="hit")
+        return gallery
+    client = await get_async_supabase() if supabase is not None else None
+    if client is None:
+        # get_class_gallery() records the load itself
+        return await run_io(get_class_gallery, user_id, classroom_id)
+    loaded_version = gallery_index.version(user_id, classroom_id)
+    try:
+        rows = _group_by_student(
+            await _aselect_with_vectors(client, "student_id", _class_filter(user_id, classroom_id), op="load_class")
+        )
+    except Exception as e:
+        logger.warning("Error getting embeddings for class: %s", e)
+        metrics.observe("gallery_load_seconds", time.perf_counter() - started, outcome="error")
+        return gallery_index.ClassGallery()
+    gallery = await run_io(_cache_gallery, user_id, classroom_id, rows, loaded_version)
+    metrics.observe("gallery_load_seconds", time.perf_counter() - started, outcome="miss")
+    return gallery
+
+
+_USER_PAGE_ROWS = 1000  # PostgREST returns at most this many rows per request by default
+
+
+def _load_all_for_user(user_id: str) -> list[tuple[str, str, list]]:
+    """[(classroom_id, student_id, vectors)] across every classroom of a user (storage errors propagate)."""
+    if supabase is not None:
+        rows: list[dict] = []
+        while True:
+            start = len(rows)
+            page = _select_with_vectors(
+                "classroom_id, student_id",
+                lambda q: q.eq("user_id", user_id).order("id").range(start, start + _USER_PAGE_ROWS - 1),
+                op="load_user_page",
+            )
+            rows.extend(page)
+            if len(page) < _USER_PAGE_ROWS:
+                break
+        by_key: dict[tuple[str, str], list] = {}
+        for row in rows:
+            by_key.setdefault((row["classroom_id"], row["student_id"]), []).append(row["vector"])
+        return [(classroom_id, student_id, vectors) for (classroom_id, student_id), vectors in by_key.items()]
+
+    items = []
+    for suffix, vectors in _local().vectors_by_suffix(f"{user_id}:"):
+        classroom_id, _, student_id = suffix.partition(":")
+        items.append((classroom_id, student_id, vectors))
+    return items
+
+
+def get_user_index(user_id: str, dim: int) -> ann_index.IVFIndex:
+    """The tenant-wide ANN index of a user for one embedding dim, built from storage on first use."""
+    return ann_index.get_or_build(user_id, dim, _load_all_for_user)
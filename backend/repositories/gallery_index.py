@@ -0,0 +1,491 @@
+"""In-process class gallery index used by recognition.
+
+One `ClassGallery` per (user_id, classroom_id) holds the L2-normalized embeddings of every
+enrolled student. A warm gallery serves `/recognize` without any database round trip; enroll
+and delete patch only the affected student's rows instead of dropping every tenant's cache.
+
+With GALLERY_SHARED_DIR set, galleries are published as memory-mapped segments (see
+`shared_gallery`) that every worker process maps, instead of one private copy per worker.
+"""
+from __future__ import annotations
+import threading
+import time
+from typing import Any, Sequence
+
+import numpy as np
+
+from config import GALLERY_CACHE_TTL_SECONDS, GALLERY_QUANTIZATION, GALLERY_SHARED_DIR
+from core.file_lock import file_lock
+from repositories import shared_gallery
+
+
+def normalize_rows(embeddings: Sequence[Sequence[float]] | np.ndarray) -> np.ndarray:
+    """Return a float32 (n, dim) matrix with unit-length rows (zero rows stay zero)."""
+    matrix = np.array(embeddings, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1  # Avoid division by zero
+    return matrix / norms
+
+
+def quantize_rows(rows: np.ndarray, quantization: str) -> tuple[np.ndarray, np.ndarray | None, np.ndarray]:
+    """Encode normalized float32 rows for the scan matrix.
+
+    Returns (codes, scales, residuals):
+    - "none":    codes = float32 rows, scales None, residuals 0
+    - "float16": codes = float16 rows, scales None
+    - "int8":    codes = round(row / scale) with a per-row scale = max|row| / 127
+    `residuals[i]` is ||row_i - decode(codes_i)||_2, so for a unit query |exact - approx| <= residuals[i].
+    """
+    rows = np.asarray(rows, dtype=np.float32)
+    if quantization == "int8":
+        scales = np.abs(rows).max(axis=1) / 127.0
+        scales[scales == 0] = 1
+        codes = np.clip(np.rint(rows / scales[:, None]), -127, 127).astype(np.int8)
+        decoded = codes.astype(np.float32) * scales[:, None]
+        return codes, scales.astype(np.float32), np.linalg.norm(rows - decoded, axis=1).astype(np.float32)
+    if quantization == "float16":
+        codes = rows.astype(np.float16)
+        return codes, None, np.linalg.norm(rows - codes.astype(np.float32), axis=1).astype(np.float32)
+    return np.ascontiguousarray(rows), None, np.zeros(rows.shape[0], dtype=np.float32)
+
+
+class GalleryMatrix:
+    """All rows of one embedding dim as a single contiguous (N, dim) scan matrix.
+
+    Rows of `student_ids[i]` are `codes[offsets[i]:offsets[i + 1]]`. With GALLERY_QUANTIZATION="none"
+    the codes are the normalized float32 rows; "float16" / "int8" (per-row scale) keep 2x / 4x less in
+    memory and score approximately, with a per-row error bound used to decide when to re-rank exactly.
+    Instances are immutable; patches return a new matrix so readers never see a half-built gallery.
+    """
+
+    __slots__ = ("dim", "student_ids", "codes", "scales", "residuals", "offsets", "counts", "quantization")
+
+    # Rows dequantized per block while scoring, so the float32 temporary stays small on big galleries
+    _SCORE_BLOCK_ROWS = 4096
+
+    def __init__(
+        self,
+        dim: int,
+        student_ids: list[str],
+        codes: np.ndarray,
+        offsets: np.ndarray,
+        scales: np.ndarray | None = None,
+        residuals: np.ndarray | None = None,
+        quantization: str = "none",
+    ):
+        self.dim = dim
+        self.student_ids = student_ids
+        self.codes = codes
+        self.scales = scales
+        self.residuals = residuals if residuals is not None else np.zeros(codes.shape[0], dtype=np.float32)
+        self.offsets = offsets
+        self.counts = np.diff(offsets)
+        self.quantization = quantization
+
+    @classmethod
+    def build(
+        cls,
+        dim: int,
+        items: list[tuple[str, np.ndarray]],
+        quantization: str | None = None,
+    ) -> "GalleryMatrix":
+        """Build from [(student_id, normalized (n, dim) float32 rows), ...]; students with no rows are skipped."""
+        quantization = quantization or GALLERY_QUANTIZATION
+        items = [(sid, rows) for sid, rows in items if rows.shape[0] > 0]
+        rows = (
+            np.concatenate([r for _, r in items]).astype(np.float32, copy=False)
+            if items else np.zeros((0, dim), dtype=np.float32)
+        )
+        codes, scales, residuals = quantize_rows(rows, quantization)
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        if items:
+            offsets[1:] = np.cumsum([r.shape[0] for _, r in items])
+        return cls(dim, [sid for sid, _ in items], codes, offsets, scales, residuals, quantization)
+
+    @property
+    def quantized(self) -> bool:
+        return self.quantization != "none"
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Float32 (N, dim) rows (a decoded copy when quantized)."""
+        return self._decode(0, self.codes.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        extra = self.scales.nbytes if self.scales is not None else 0
+        return int(self.codes.nbytes + extra + self.residuals.nbytes + self.offsets.nbytes)
+
+    def _decode(self, start: int, end: int) -> np.ndarray:
+        block = self.codes[start:end]
+        if not self.quantized:
+            return block
+        block = block.astype(np.float32)
+        if self.scales is not None:
+            block *= self.scales[start:end, None]
+        return block
+
+    def __len__(self) -> int:
+        return len(self.student_ids)
+
+    def rows(self, i: int) -> np.ndarray:
+        return self._decode(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def items(self) -> list[tuple[str, np.ndarray]]:
+        return [(sid, self.rows(i)) for i, sid in enumerate(self.student_ids)]
+
+    def replace_student(self, student_id: str, rows: np.ndarray | None) -> "GalleryMatrix":
+        """Return a copy with one student's rows replaced (None removes the student).
+
+        Other students' encoded rows are copied as-is (never re-quantized); only `rows` is encoded.
+        """
+        keep = [i for i, sid in enumerate(self.student_ids) if sid != student_id]
+        segments = [(int(self.offsets[i]), int(self.offsets[i + 1])) for i in keep]
+        student_ids = [self.student_ids[i] for i in keep]
+        codes = [self.codes[a:b] for a, b in segments]
+        scales = [self.scales[a:b] for a, b in segments] if self.scales is not None else None
+        residuals = [self.residuals[a:b] for a, b in segments]
+        if rows is not None and rows.shape[0] > 0:
+            new_codes, new_scales, new_residuals = quantize_rows(rows, self.quantization)
+            student_ids.append(student_id)
+            codes.append(new_codes)
+            if scales is not None:
+                scales.append(new_scales)
+            residuals.append(new_residuals)
+        counts = [c.shape[0] for c in codes]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        if not codes:
+            return GalleryMatrix.build(self.dim, [], self.quantization)
+        return GalleryMatrix(
+            self.dim,
+            student_ids,
+            np.ascontiguousarray(np.concatenate(codes)),
+            offsets,
+            np.concatenate(scales) if scales is not None else None,
+            np.concatenate(residuals),
+            self.quantization,
+        )
+
+    def student_scores(self, queries: np.ndarray, min_embeddings: int | None = None) -> np.ndarray:
+        """Best cosine similarity per student for each normalized query.
+
+        queries: (dim,) or (n_queries, dim). Returns (n_queries, n_students); students with fewer than
+        `min_embeddings` rows score -inf. One GEMV/GEMM plus one segmented max, no per-student Python loop.
+        Approximate (within `student_bounds()`) when the gallery is quantized.
+        """
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if not self.student_ids:
+            return np.zeros((q.shape[0], 0), dtype=np.float32)
+        if not self.quantized:
+            sims = q @ self.codes.T
+        else:
+            n = self.codes.shape[0]
+            sims = np.empty((q.shape[0], n), dtype=np.float32)
+            for start in range(0, n, self._SCORE_BLOCK_ROWS):
+                end = min(n, start + self._SCORE_BLOCK_ROWS)
+                sims[:, start:end] = q @ self._decode(start, end).T
+        scores = np.maximum.reduceat(sims, self.offsets[:-1], axis=1)
+        if min_embeddings is not None:
+            scores[:, self.counts < min_embeddings] = -np.inf
+        return scores
+
+    def student_bounds(self) -> np.ndarray:
+        """Per-student max |exact - approx| score error for unit queries (all zeros when not quantized)."""
+        if not self.student_ids:
+            return np.zeros(0, dtype=np.float32)
+        return np.maximum.reduceat(self.residuals, self.offsets[:-1])
+
+    def ambiguous_students(self, scores: np.ndarray) -> np.ndarray:
+        """Indices of students whose exact score could place them in the top two for one query."""
+        bounds = self.student_bounds()
+        finite = np.isfinite(scores)
+        if finite.sum() <= 2:
+            return np.flatnonzero(finite)
+        lower = np.where(finite, scores - bounds, -np.inf)
+        second_lower = np.partition(lower, -2)[-2]
+        return np.flatnonzero(finite & (scores + bounds >= second_lower))
+
+    def rerank(self, query: np.ndarray, scores: np.ndarray, exact_rows: dict[str, np.ndarray]) -> np.ndarray:
+        """Copy of `scores` with full-precision scores for the students in `exact_rows`.
+
+        Works on one query (dim,) with a score row (S,), or a query matrix (nq, dim) with (nq, S) scores.
+        """
+        refined = scores.copy()
+        index = {sid: i for i, sid in enumerate(self.student_ids)}
+        for student_id, rows in exact_rows.items():
+            i = index.get(student_id)
+            if i is None or not rows.shape[0] or rows.shape[1] != self.dim:
+                continue
+            exact = np.max(query @ rows.T, axis=-1)
+            # Students filtered out by min_embeddings stay at -inf
+            refined[..., i] = np.where(np.isfinite(refined[..., i]), exact, refined[..., i])
+        return refined
+
+    def best_two(self, query: np.ndarray, min_embeddings: int | None = None) -> tuple[str | None, float, float]:
+        """Return (best_student_id, best_similarity, second_best_similarity) for one normalized query.
+
+        Like the old per-student loop, only positive similarities count: best_student_id is None when no
+        student scores above 0, and second_best_similarity is 0 when there is no positive runner-up.
+        """
+        return best_two_from_scores(self.student_ids, self.student_scores(query, min_embeddings)[0])
+
+
+def best_two_from_scores(student_ids: list[str], scores: np.ndarray) -> tuple[str | None, float, float]:
+    """Pick best and second-best students from one row of `GalleryMatrix.student_scores()`."""
+    if scores.size == 0:
+        return None, 0.0, 0.0
+    best = int(np.argmax(scores))
+    best_sim = float(scores[best])
+    if not best_sim > 0:
+        return None, 0.0, 0.0
+    second_sim = 0.0
+    if scores.size > 1:
+        rest = scores.copy()
+        rest[best] = -np.inf
+        second_sim = max(0.0, float(np.max(rest)))
+    return student_ids[best], best_sim, second_sim
+
+
+class ClassGallery:
+    """Normalized embeddings for one classroom: one `GalleryMatrix` per embedding dim.
+
+    Updates are copy-on-write (matrices are rebuilt and the dict swapped, never mutated), so readers can
+    use a snapshot without holding a lock while enroll/delete patch the gallery.
+    """
+
+    def __init__(self, rows_by_student: dict[str, list[list[float]]] | None = None):
+        grouped: dict[int, list[tuple[str, np.ndarray]]] = {}
+        student_dim: dict[str, int] = {}
+        for student_id, embs in (rows_by_student or {}).items():
+            matrix = self._build(embs)
+            if matrix is not None:
+                grouped.setdefault(matrix.shape[1], []).append((student_id, matrix))
+                student_dim[student_id] = matrix.shape[1]
+        self._matrices = {dim: GalleryMatrix.build(dim, items) for dim, items in grouped.items()}
+        self._student_dim = student_dim
+        self.loaded_at = time.monotonic()
+        self.segment_signature: tuple | None = None
+
+    @classmethod
+    def from_matrices(cls, matrices: dict[int, GalleryMatrix], loaded_at: float | None = None) -> "ClassGallery":
+        """Wrap existing matrices (e.g. views into a shared segment) without copying them."""
+        gallery = cls()
+        gallery._matrices = {dim: m for dim, m in matrices.items() if len(m)}
+        gallery._student_dim = {sid: dim for dim, m in gallery._matrices.items() for sid in m.student_ids}
+        if loaded_at is not None:
+            gallery.loaded_at = loaded_at
+        return gallery
+
+    @property
+    def matrices(self) -> dict[int, GalleryMatrix]:
+        return self._matrices
+
+    @staticmethod
+    def _build(embeddings: list[list[float]]) -> np.ndarray | None:
+        if not embeddings:
+            return None
+        # A student's rows always share one model; keep the dim of the first row like the old cache did.
+        dim = len(embeddings[0])
+        rows = [e for e in embeddings if len(e) == dim]
+        return normalize_rows(rows) if rows and dim else None
+
+    def set_student(self, student_id: str, embeddings: list[list[float]]) -> None:
+        """Replace one student's rows (empty list removes the student)."""
+        rows = self._build(embeddings)
+        matrices = dict(self._matrices)
+        student_dim = dict(self._student_dim)
+        old_dim = student_dim.pop(student_id, None)
+        if old_dim is not None and old_dim in matrices:
+            matrices[old_dim] = matrices[old_dim].replace_student(student_id, None)
+        if rows is not None:
+            dim = rows.shape[1]
+            current = matrices.get(dim) or GalleryMatrix.build(dim, [])
+            matrices[dim] = current.replace_student(student_id, rows)
+            student_dim[student_id] = dim
+        self._matrices = {dim: m for dim, m in matrices.items() if len(m)}
+        self._student_dim = student_dim
+
+    def drop_student(self, student_id: str) -> None:
+        if student_id in self._student_dim:
+            self.set_student(student_id, [])
+
+    def matrix(self, dim: int) -> GalleryMatrix | None:
+        return self._matrices.get(dim)
+
+    def student_dim(self, student_id: str) -> int | None:
+        """Embedding dim (model) a student is enrolled with, or None when not enrolled."""
+        return self._student_dim.get(student_id)
+
+    def student_count(self, student_id: str) -> int:
+        dim = self._student_dim.get(student_id)
+        if dim is None:
+            return 0
+        m = self._matrices[dim]
+        return int(m.counts[m.student_ids.index(student_id)])
+
+    def dims(self) -> set[int]:
+        return set(self._matrices)
+
+    def counts(self) -> dict[str, int]:
+        return {
+            sid: int(c)
+            for m in self._matrices.values()
+            for sid, c in zip(m.student_ids, m.counts)
+        }
+
+    def by_dim(self, min_embeddings: int | None = None) -> dict[int, list[tuple[str, Any, list[int]]]]:
+        """Group students by embedding dim: {dim: [(student_id, normalized_matrix, indices), ...]}.
+
+        The per-student matrices are views into the contiguous gallery matrix.
+        """
+        result: dict[int, list[tuple[str, Any, list[int]]]] = {}
+        for dim, m in self._matrices.items():
+            for i, student_id in enumerate(m.student_ids):
+                n = int(m.counts[i])
+                if min_embeddings is not None and n < min_embeddings:
+                    continue
+                result.setdefault(dim, []).append((student_id, m.rows(i), list(range(n))))
+        return result
+
+
+# {(user_id, classroom_id): ClassGallery}
+_galleries: dict[tuple[str, str], ClassGallery] = {}
+# Bumped on every patch/invalidate so a load that raced with a write is not cached.
+_versions: dict[tuple[str, str], int] = {}
+_lock = threading.Lock()
+
+
+def _segment(key: tuple[str, str]) -> str:
+    return shared_gallery.segment_path(GALLERY_SHARED_DIR, *key)
+
+
+def _map_segment(key: tuple[str, str]) -> ClassGallery | None:
+    """Map the class's shared segment and make it this worker's cached gallery (None when invalid/missing)."""
+    path = _segment(key)
+    signature = shared_gallery.signature(path)
+    mapped = shared_gallery.read(path)
+    if mapped is None:
+        with _lock:
+            _galleries.pop(key, None)
+        return None
+    _, published_at, matrices = mapped
+    # TTL counts from when the segment was published, whichever worker did it
+    gallery = ClassGallery.from_matrices(matrices, time.monotonic() - max(0.0, time.time() - published_at))
+    gallery.segment_signature = signature
+    with _lock:
+        _galleries[key] = gallery
+    return gallery
+
+
+def version(user_id: str, classroom_id: str) -> tuple[int, int]:
+    """Current write version of a class; pass it back to `put()` after loading.
+
+    Opaque token: this worker's write counter plus, with shared segments, the segment generation.
+    """
+    key = (user_id, classroom_id)
+    with _lock:
+        local = _versions.get(key, 0)
+    generation = shared_gallery.read_generation(_segment(key))[0] if GALLERY_SHARED_DIR else 0
+    return local, generation
+
+
+def get(user_id: str, classroom_id: str) -> ClassGallery | None:
+    """Return the cached gallery, or None when missing or older than GALLERY_CACHE_TTL_SECONDS."""
+    key = (user_id, classroom_id)
+    gallery = _galleries.get(key)
+    if GALLERY_SHARED_DIR:
+        # One stat() tells whether another worker published or patched a newer generation
+        if gallery is None or gallery.segment_signature != shared_gallery.signature(_segment(key)):
+            gallery = _map_segment(key)
+    if gallery is None:
+        return None
+    if GALLERY_CACHE_TTL_SECONDS > 0 and time.monotonic() - gallery.loaded_at > GALLERY_CACHE_TTL_SECONDS:
+        with _lock:
+            if _galleries.get(key) is gallery:
+                del _galleries[key]
+        return None
+    return gallery
+
+
+def put(user_id: str, classroom_id: str, gallery: ClassGallery, loaded_version: tuple[int, int]) -> bool:
+    """Cache a freshly loaded gallery unless a write happened since `loaded_version` was read.
+
+    With shared segments the gallery is published for every worker, and this worker switches to the
+    mapped copy so it does not keep a private one.
+    """
+    key = (user_id, classroom_id)
+    local, loaded_generation = loaded_version
+    with _lock:
+        if _versions.get(key, 0) != local:
+            return False
+        if not GALLERY_SHARED_DIR:
+            _galleries[key] = gallery
+            return True
+    path = _segment(key)
+    with file_lock(shared_gallery.lock_path(path)):
+        generation, _ = shared_gallery.read_generation(path)
+        # Another worker published or a write marked the class stale while we were loading
+        published = generation == loaded_generation
+        if published:
+            shared_gallery.write(path, generation + 1, gallery.matrices)
+    _map_segment(key)
+    return published
+
+
+def _patch_segment(key: tuple[str, str], student_id: str, embeddings: list[list[float]]) -> None:
+    """Read-modify-write the shared segment under its lock; without one, just bump the generation so
+    loads that started before this write are not published."""
+    path = _segment(key)
+    with file_lock(shared_gallery.lock_path(path)):
+        generation, valid = shared_gallery.read_generation(path)
+        mapped = shared_gallery.read(path) if valid else None
+        if mapped is None:
+            shared_gallery.write(path, generation + 1, None)
+        else:
+            gallery = ClassGallery.from_matrices(mapped[2])
+            gallery.set_student(student_id, embeddings)
+            shared_gallery.write(path, generation + 1, gallery.matrices)
+    with _lock:
+        _galleries.pop(key, None)  # remapped on the next get()
+
+
+def patch_student(user_id: str, classroom_id: str, student_id: str, embeddings: list[list[float]]) -> None:
+    """Set one student's rows in the cached gallery (no-op for classes that are not cached)."""
+    key = (user_id, classroom_id)
+    with _lock:
+        _versions[key] = _versions.get(key, 0) + 1
+        gallery = _galleries.get(key)
+        if gallery is not None and not GALLERY_SHARED_DIR:
+            gallery.set_student(student_id, embeddings)
+    if GALLERY_SHARED_DIR:
+        _patch_segment(key, student_id, embeddings)
+
+
+def drop_student(user_id: str, classroom_id: str, student_id: str) -> None:
+    key = (user_id, classroom_id)
+    with _lock:
+        _versions[key] = _versions.get(key, 0) + 1
+        gallery = _galleries.get(key)
+        if gallery is not None and not GALLERY_SHARED_DIR:
+            gallery.drop_student(student_id)
+    if GALLERY_SHARED_DIR:
+        _patch_segment(key, student_id, [])
+
+
+def invalidate(user_id: str | None = None, classroom_id: str | None = None) -> None:
+    """Drop cached galleries: one class, every class of a user, or everything."""
+    with _lock:
+        keys = [
+            k for k in list(_galleries) + list(_versions)
+            if (user_id is None or k[0] == user_id) and (classroom_id is None or k[1] == classroom_id)
+        ]
+        for key in keys:
+            _galleries.pop(key, None)
+            _versions[key] = _versions.get(key, 0) + 1
+    if GALLERY_SHARED_DIR:
+        for key in shared_gallery.list_segments(GALLERY_SHARED_DIR):
+            if (user_id is None or key[0] == user_id) and (classroom_id is None or key[1] == classroom_id):
+                path = _segment(key)
+                with file_lock(shared_gallery.lock_path(path)):
+                    shared_gallery.write(path, shared_gallery.read_generation(path)[0] + 1, None)
@@ -0,0 +1,462 @@
+"""Local (no Supabase) embedding storage: memory-mapped float32 vectors, a snapshot and a write journal.
+
+Files (all in the data directory):
+- `embeddings.f32`: raw little-endian float32 vectors, append-only. Compaction writes a new
+  `embeddings.<generation>.f32` holding live rows only.
+- `embeddings.index.json`: snapshot {"generation", "vectors", "index"} where index is
+  {key: [{"id", "offset", "dim", "confidence", "enrolledAt"}, ...]} and offset/dim locate the vector
+  (in floats). Metadata only, so counts never touch vector data.
+- `embeddings.journal`: append-only JSON lines applied on top of the snapshot. The first line is
+  {"generation": g}; a journal whose generation differs from the snapshot's is already folded in.
+- `embeddings.journal.lock`: cross-process lock (flock / msvcrt) held while appending or compacting.
+
+Writes are group-committed: concurrent callers queue their operations and one of them (the leader)
+appends every queued vector and journal line with a single write + fsync per file. A background thread
+folds the journal into a new snapshot once it grows past `compact_entries` lines. Other processes pick
+up journal lines on their next read, so several uvicorn workers can share one store.
+
+Reads return zero-copy views into the memory map. The old `embeddings.json` is imported once when no
+snapshot exists yet.
+"""
+from __future__ import annotations
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from core.file_lock import file_lock
+
+_FLOAT_BYTES = 4
+
+
+def _fsync_write(path: str, data: bytes, mode: str = "ab") -> None:
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class _Pending:
+    __slots__ = ("op", "done", "result", "error")
+
+    def __init__(self, op: tuple):
+        self.op = op
+        self.done = False
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class LocalEmbeddingStore:
+    def __init__(
+        self,
+        vectors_path: str,
+        index_path: str,
+        legacy_json_path: str | None = None,
+        journal_path: str | None = None,
+        compact_entries: int = 1000,
+    ):
+        self.vectors_path = vectors_path
+        self.index_path = index_path
+        self.journal_path = journal_path or os.path.splitext(index_path)[0] + ".journal"
+        self.lock_path = f"{self.journal_path}.lock"
+        self.legacy_json_path = legacy_json_path
+        self.compact_entries = compact_entries
+
+        self._lock = threading.RLock()  # in-memory state
+        self._cond = threading.Condition()  # write queue / leadership
+        self._queue: list[_Pending] = []
+        self._leader_active = False
+
+        self._generation = 0
+        self._vectors_name = os.path.basename(vectors_path)
+        self._index: dict[str, list[dict]] = {}
+        self._journal_pos = 0
+        self._journal_stat: tuple | None = None
+        self._journal_entries = 0
+        self._mm: np.memmap | None = None
+
+        Path(index_path).parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.lock_path), self._lock:
+            self._reload_locked()
+
+        self._compact_wanted = threading.Event()
+        threading.Thread(target=self._compactor, name="embedding-store-compactor", daemon=True).start()
+
+    # ---- snapshot / journal (callers hold the file lock) --------------------------------------------
+
+    def _vectors_file(self) -> str:
+        return os.path.join(os.path.dirname(self.vectors_path), self._vectors_name)
+
+    def _reload_locked(self) -> None:
+        """Load the snapshot and replay the journal on top of it."""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if "generation" not in snapshot:  # plain {key: entries} index from before the journal
+                snapshot = {"generation": 0, "vectors": os.path.basename(self.vectors_path), "index": snapshot}
+        elif self.legacy_json_path and os.path.exists(self.legacy_json_path):
+            snapshot = self._import_json(self.legacy_json_path)
+        else:
+            open(self.vectors_path, "ab").close()
+            snapshot = {"generation": 0, "vectors": os.path.basename(self.vectors_path), "index": {}}
+            self._write_snapshot(snapshot)
+        self._generation = snapshot["generation"]
+        self._vectors_name = snapshot["vectors"]
+        self._index = snapshot["index"]
+        self._mm = None
+        self._journal_pos = 0
+        self._journal_entries = 0
+
+        header = None
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as f:
+                header = f.readline()
+        try:
+            generation = json.loads(header)["generation"] if header else None
+        except (ValueError, KeyError):
+            generation = None
+        if generation != self._generation:
+            # Missing, torn or already folded into the snapshot: start a fresh journal
+            self._reset_journal()
+        else:
+            self._journal_pos = len(header)
+            self._catch_up_locked()
+
+    def _import_json(self, path: str) -> dict:
+        """One-time import of the old embeddings.json (the file itself is left untouched)."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"WARNING: could not import {path}: {e}")
+            data = {}
+        index: dict[str, list[dict]] = {}
+        offset = 0
+        chunks = []
+        for key, records in data.items():
+            entries = []
+            for r in records or []:
+                vector = np.asarray(r.get("embedding") or [], dtype="<f4")
+                chunks.append(vector.tobytes())
+                entries.append({
+                    "id": r.get("id") or str(uuid.uuid4()),
+                    "offset": offset,
+                    "dim": int(vector.size),
+                    "confidence": r.get("confidence", 0),
+                    "enrolledAt": r.get("enrolledAt", ""),
+                })
+                offset += int(vector.size)
+            if entries:
+                index[key] = entries
+        _fsync_write(self.vectors_path, b"".join(chunks), "wb")
+        snapshot = {"generation": 0, "vectors": os.path.basename(self.vectors_path), "index": index}
+        self._write_snapshot(snapshot)
+        print(f"Imported {sum(len(v) for v in index.values())} embeddings from {path} into {self.vectors_path}")
+        return snapshot
+
+    def _write_snapshot(self, snapshot: dict) -> None:
+        tmp = f"{self.index_path}.tmp"
+        _fsync_write(tmp, json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), "wb")
+        os.replace(tmp, self.index_path)
+
+    def _reset_journal(self) -> None:
+        header = (json.dumps({"generation": self._generation}) + "\n").encode("utf-8")
+        tmp = f"{self.journal_path}.tmp"
+        _fsync_write(tmp, header, "wb")
+        os.replace(tmp, self.journal_path)
+        self._journal_pos = len(header)
+        self._journal_entries = 0
+        self._journal_stat = self._stat_journal()
+
+    def _stat_journal(self) -> tuple | None:
+        try:
+            st = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _catch_up_locked(self) -> None:
+        """Apply journal lines appended since our last read (by this or another process)."""
+        with open(self.journal_path, "rb") as f:
+            header = f.readline()
+            try:
+                generation = json.loads(header)["generation"]
+            except (ValueError, KeyError):
+                generation = None
+            size = os.fstat(f.fileno()).st_size
+            if generation != self._generation or size < self._journal_pos:
+                # Another process compacted: reload the new snapshot
+                return self._reload_locked()
+            f.seek(self._journal_pos)
+            tail = f.read()
+        complete = tail.rfind(b"\n") + 1
+        for line in tail[:complete].splitlines():
+            if line:
+                self._apply(json.loads(line))
+                self._journal_entries += 1
+        if complete < len(tail):
+            # Torn line from a writer that crashed mid-append; we hold the lock, so drop it
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(self._journal_pos + complete)
+        self._journal_pos += complete
+        self._journal_stat = self._stat_journal()
+
+    def _apply(self, record: dict) -> None:
+        key = record["key"]
+        op = record["op"]
+        if op == "add":
+            evict = set(record.get("evict", ()))
+            self._index[key] = [e for e in self._index.get(key, []) if e["id"] not in evict] + [record["entry"]]
+        elif op == "remove":
+            self._index.pop(key, None)
+        elif op == "remove_id":
+            entries = [e for e in self._index.get(key, []) if e["id"] != record["id"]]
+            if entries:
+                self._index[key] = entries
+            else:
+                self._index.pop(key, None)
+
+    def _refresh(self) -> None:
+        """Pick up writes from other processes (cheap stat when nothing changed)."""
+        if self._stat_journal() == self._journal_stat:
+            return
+        with file_lock(self.lock_path), self._lock:
+            self._catch_up_locked()
+
+    def _vectors(self) -> np.ndarray:
+        """Memory map of the whole vector file, remapped when appends have grown it."""
+        path = self._vectors_file()
+        size = os.path.getsize(path) // _FLOAT_BYTES
+        if self._mm is None or self._mm.filename != os.path.abspath(path) or self._mm.shape[0] != size:
+            if size == 0:
+                return np.empty(0, dtype="<f4")
+            self._mm = np.memmap(path, dtype="<f4", mode="r", shape=(size,))
+        return self._mm
+
+    # ---- group commit ------------------------------------------------------------------------------
+
+    @contextmanager
+    def _leadership(self):
+        """Become the only in-process writer (queued writes keep accumulating meanwhile)."""
+        with self._cond:
+            while self._leader_active:
+                self._cond.wait()
+            self._leader_active = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._leader_active = False
+                self._cond.notify_all()
+
+    def _submit(self, op: tuple):
+        pending = _Pending(op)
+        with self._cond:
+            self._queue.append(pending)
+            while not pending.done and self._leader_active:
+                self._cond.wait()
+            if pending.done:
+                batch = None
+            else:
+                self._leader_active = True
+                batch, self._queue = self._queue, []
+        if batch is not None:
+            try:
+                self._commit(batch)
+            except BaseException as e:
+                for p in batch:
+                    if not p.done:
+                        p.error, p.done = e, True
+            finally:
+                with self._cond:
+                    self._leader_active = False
+                    self._cond.notify_all()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _commit(self, batch: list[_Pending]) -> None:
+        """Append a batch of operations: one vector write + fsync, one journal write + fsync."""
+        with file_lock(self.lock_path):
+            with self._lock:
+                self._catch_up_locked()
+                vectors_file = self._vectors_file()
+                size = os.path.getsize(vectors_file)
+                if size % _FLOAT_BYTES:
+                    # Partial vector from a crashed writer; nothing references it
+                    with open(vectors_file, "r+b") as f:
+                        f.truncate(size - size % _FLOAT_BYTES)
+                    size -= size % _FLOAT_BYTES
+                offset = size // _FLOAT_BYTES
+                chunks: list[bytes] = []
+                lines: list[bytes] = []
+                for p in batch:
+                    record, vector = self._plan(p.op, offset)
+                    if vector is not None:
+                        chunks.append(vector)
+                        offset += len(vector) // _FLOAT_BYTES
+                    if record is not None:
+                        self._apply(record)
+                        lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+                    p.result = [dict(e) for e in self._index.get(p.op[1], [])]
+            try:
+                if chunks:
+                    _fsync_write(vectors_file, b"".join(chunks))
+                if lines:
+                    data = b"".join(lines)
+                    _fsync_write(self.journal_path, data)
+                    with self._lock:
+                        self._journal_pos += len(data)
+                        self._journal_entries += len(lines)
+                        self._journal_stat = self._stat_journal()
+            except BaseException:
+                # Memory is ahead of disk; rebuild it from what was actually persisted
+                with self._lock:
+                    self._reload_locked()
+                raise
+        for p in batch:
+            p.done = True
+        if self._journal_entries >= self.compact_entries:
+            self._compact_wanted.set()
+
+    def _plan(self, op: tuple, offset: int) -> tuple[dict | None, bytes | None]:
+        """Turn a queued operation into a journal record (and vector bytes) against current state."""
+        kind, key = op[0], op[1]
+        entries = self._index.get(key, [])
+        if kind == "add":
+            _, _, vector, confidence, enrolled_at, max_per_key, replace_other_dims = op
+            data = np.asarray(vector, dtype="<f4").ravel().tobytes()
+            dim = len(data) // _FLOAT_BYTES
+            evict = [e["id"] for e in entries if replace_other_dims and e["dim"] != dim]
+            kept = [e for e in entries if e["id"] not in evict]
+            evict += [e["id"] for e in kept[: max(0, len(kept) - max_per_key + 1)]]
+            entry = {
+                "id": str(uuid.uuid4()),
+                "offset": offset,
+                "dim": dim,
+                "confidence": confidence,
+                "enrolledAt": enrolled_at,
+            }
+            return {"op": "add", "key": key, "entry": entry, "evict": evict}, data
+        if kind == "remove":
+            return ({"op": "remove", "key": key} if entries else None), None
+        if kind == "remove_at":
+            index = op[2]
+            if 0 <= index < len(entries):
+                return {"op": "remove_id", "key": key, "id": entries[index]["id"]}, None
+            return None, None
+        raise ValueError(f"unknown operation {kind!r}")
+
+    # ---- compaction --------------------------------------------------------------------------------
+
+    def _compactor(self) -> None:
+        while True:
+            self._compact_wanted.wait(timeout=60)
+            self._compact_wanted.clear()
+            try:
+                if self._journal_entries >= self.compact_entries:
+                    self.compact()
+            except Exception as e:
+                print(f"WARNING: embedding store compaction failed: {e}")
+
+    def compact(self) -> None:
+        """Fold the journal into a new snapshot; rewrite the vector file when dead rows dominate it."""
+        with self._leadership(), file_lock(self.lock_path), self._lock:
+            self._catch_up_locked()
+            old_vectors_file = self._vectors_file()
+            total = os.path.getsize(old_vectors_file) // _FLOAT_BYTES
+            live = sum(e["dim"] for entries in self._index.values() for e in entries)
+            generation = self._generation + 1
+            vectors_name = self._vectors_name
+            index = self._index
+            if total >= 4096 and live * 2 <= total:
+                root, ext = os.path.splitext(os.path.basename(self.vectors_path))
+                vectors_name = f"{root}.{generation}{ext}"
+                vectors = self._vectors()
+                chunks = []
+                offset = 0
+                index = {}
+                for key, entries in self._index.items():
+                    moved = []
+                    for e in entries:
+                        chunks.append(np.asarray(vectors[e["offset"]:e["offset"] + e["dim"]]).tobytes())
+                        moved.append({**e, "offset": offset})
+                        offset += e["dim"]
+                    index[key] = moved
+                _fsync_write(os.path.join(os.path.dirname(self.vectors_path), vectors_name), b"".join(chunks), "wb")
+            # The snapshot is the commit point; a crash before the journal reset just ignores the old journal
+            self._write_snapshot({"generation": generation, "vectors": vectors_name, "index": index})
+            self._generation = generation
+            self._vectors_name = vectors_name
+            self._index = index
+            self._reset_journal()
+            if vectors_name != os.path.basename(old_vectors_file):
+                self._mm = None
+                try:
+                    os.remove(old_vectors_file)
+                except OSError:
+                    pass  # still mapped by another process on Windows
+
+    # ---- API ---------------------------------------------------------------------------------------
+
+    def add(
+        self,
+        key: str,
+        embedding,
+        confidence: float,
+        enrolled_at: str,
+        max_per_key: int = 5,
+        replace_other_dims: bool = False,
+    ) -> list[dict]:
+        """Append one embedding under `key`, evicting the oldest beyond `max_per_key`. Returns the key's records.
+
+        With `replace_other_dims`, records of another dim (an older model) are evicted in the same write.
+        """
+        self._submit(("add", key, embedding, confidence, enrolled_at, max_per_key, replace_other_dims))
+        return self.records(key)
+
+    def remove(self, key: str) -> None:
+        self._submit(("remove", key))
+
+    def remove_at(self, key: str, index: int) -> list[dict]:
+        """Remove the `index`-th record of `key` (ignored when out of range). Returns the remaining records."""
+        self._submit(("remove_at", key, index))
+        return self.records(key)
+
+    def count(self, key: str) -> int:
+        self._refresh()
+        with self._lock:
+            return len(self._index.get(key, ()))
+
+    def counts(self, prefix: str) -> dict[str, int]:
+        """{key suffix: count} for keys starting with `prefix` (index only)."""
+        self._refresh()
+        with self._lock:
+            return {k[len(prefix):]: len(v) for k, v in self._index.items() if k.startswith(prefix)}
+
+    def records(self, key: str) -> list[dict]:
+        """Records of one key, each with `embedding` as a read-only view into the memory map."""
+        self._refresh()
+        with self._lock:
+            entries = self._index.get(key, [])
+            if not entries:
+                return []
+            vectors = self._vectors()
+            return [{**e, "embedding": vectors[e["offset"]:e["offset"] + e["dim"]]} for e in entries]
+
+    def vectors_by_suffix(self, prefix: str) -> Iterator[tuple[str, list[np.ndarray]]]:
+        """(key suffix, [vector views]) for every key starting with `prefix`."""
+        self._refresh()
+        with self._lock:
+            vectors = self._vectors()
+            items = [
+                (k[len(prefix):], [vectors[e["offset"]:e["offset"] + e["dim"]] for e in entries])
+                for k, entries in self._index.items()
+                if k.startswith(prefix) and entries
+            ]
+        return iter(items)
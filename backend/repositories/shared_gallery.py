@@ -0,0 +1,153 @@
+"""Class galleries shared by every worker process through memory-mapped segment files.
+
+With GALLERY_SHARED_DIR set (ideally on tmpfs, e.g. /dev/shm), a class gallery is written once to
+`<dir>/<user>__<class>.gal` and every uvicorn worker maps that file read-only, so gallery RAM lives in
+the shared page cache instead of once per worker, and a class warmed by one worker is warm for all.
+
+Segment layout (little-endian):
+    magic (8s) | generation (Q) | flags (Q) | meta length (Q) | published_at (d) | meta JSON | arrays
+Arrays start on 64-byte boundaries of the data section that follows meta; meta lists each matrix's dim,
+quantization, student ids and the (offset, dtype, shape) of its codes/offsets/scales/residuals.
+
+Segments are never modified in place: a new generation is written to a temp file and swapped in with
+os.replace, so a reader maps either the old or the new file, never a mix. The generation (kept even by
+an "invalid" segment that only marks the class as stale) lets a worker detect that the class changed
+between starting a storage load and publishing it, and lets readers notice updates with one stat().
+"""
+from __future__ import annotations
+import json
+import mmap
+import os
+import struct
+import time
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+_MAGIC = b"LFGAL001"
+_HEADER = struct.Struct("<8sQQQd")
+_FLAG_VALID = 1
+_ALIGN = 64
+
+
+def _aligned(position: int) -> int:
+    return -(-position // _ALIGN) * _ALIGN
+
+
+def segment_path(directory: str, user_id: str, classroom_id: str) -> str:
+    return os.path.join(directory, f"{quote(user_id, safe='')}__{quote(classroom_id, safe='')}.gal")
+
+
+def list_segments(directory: str) -> list[tuple[str, str]]:
+    """(user_id, classroom_id) of every segment in `directory`."""
+    keys = []
+    for name in os.listdir(directory):
+        if name.endswith(".gal") and "__" in name:
+            user, classroom = name[:-4].split("__", 1)
+            keys.append((unquote(user), unquote(classroom)))
+    return keys
+
+
+def lock_path(path: str) -> str:
+    return f"{path}.lock"
+
+
+def signature(path: str) -> tuple | None:
+    """Changes whenever a new generation is swapped in; None when there is no segment."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def read_generation(path: str) -> tuple[int, bool]:
+    """(generation, valid) from the fixed header; (0, False) when there is no segment."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read(_HEADER.size)
+    except FileNotFoundError:
+        return 0, False
+    if len(raw) < _HEADER.size:
+        return 0, False
+    magic, generation, flags, _, _ = _HEADER.unpack(raw)
+    if magic != _MAGIC:
+        return 0, False
+    return generation, bool(flags & _FLAG_VALID)
+
+
+def write(path: str, generation: int, matrices: dict | None) -> None:
+    """Publish `matrices` ({dim: GalleryMatrix}) as `generation`; None writes an invalid (stale) marker."""
+    arrays: list[np.ndarray] = []
+    meta_matrices = []
+    for dim, m in (matrices or {}).items():
+        entry = {"dim": int(dim), "quantization": m.quantization, "student_ids": list(m.student_ids), "arrays": {}}
+        for name in ("codes", "offsets", "scales", "residuals"):
+            value = getattr(m, name)
+            if value is not None:
+                entry["arrays"][name] = len(arrays)
+                arrays.append(np.ascontiguousarray(value))
+        meta_matrices.append(entry)
+
+    # Array offsets are relative to the data section, which starts at the first aligned byte after meta
+    relative, position = [], 0
+    for a in arrays:
+        position = _aligned(position)
+        relative.append(position)
+        position += a.nbytes
+    meta = json.dumps({"matrices": [
+        {**e, "arrays": {
+            name: [relative[i], arrays[i].dtype.str, list(arrays[i].shape)] for name, i in e["arrays"].items()
+        }}
+        for e in meta_matrices
+    ]}, separators=(",", ":")).encode("utf-8")
+    data_start = _aligned(_HEADER.size + len(meta))
+
+    flags = _FLAG_VALID if matrices is not None else 0
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, generation, flags, len(meta), time.time()))
+        f.write(meta)
+        for offset, a in zip(relative, arrays):
+            f.seek(data_start + offset)
+            f.write(a.tobytes())
+    os.replace(tmp, path)
+
+
+def read(path: str):
+    """Map a segment read-only. Returns (generation, published_at, {dim: GalleryMatrix}) or None when the
+    segment is missing or invalid. The matrices' arrays are views into the shared mapping."""
+    from repositories.gallery_index import GalleryMatrix
+
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                return None
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    magic, generation, flags, meta_len, published_at = _HEADER.unpack_from(buffer, 0)
+    if magic != _MAGIC or not flags & _FLAG_VALID:
+        return None
+    meta = json.loads(bytes(buffer[_HEADER.size:_HEADER.size + meta_len]))
+    data_start = _aligned(_HEADER.size + meta_len)
+    matrices = {}
+    for entry in meta["matrices"]:
+        views = {}
+        for name, (offset, dtype, shape) in entry["arrays"].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape)) if shape else 1
+            if count == 0:
+                views[name] = np.empty(shape, dtype=dtype)
+                continue
+            views[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+        matrices[entry["dim"]] = GalleryMatrix(
+            entry["dim"],
+            entry["student_ids"],
+            views["codes"],
+            views["offsets"],
+            views.get("scales"),
+            views.get("residuals"),
+            entry["quantization"],
+        )
+    return generation, published_at, matrices
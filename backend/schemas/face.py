@@ -20,6 +20,7 @@ class RecognizeRequest(BaseModel):
     user_id: str  # Supabase user UUID
     class_id: str  # Supabase classroom UUID
     image_base64: str
+    deadline_ms: int | None = None  # งบเวลา extract embedding (ms); None = EXTRACTION_DEADLINE_MS
 
 
 class RecognizeResponse(BaseModel):
@@ -29,6 +30,67 @@ class RecognizeResponse(BaseModel):
     matched: bool
 
 
+class IdentifyRequest(BaseModel):
+    user_id: str  # Supabase user UUID; every classroom of this user is searched
+    image_base64: str
+    deadline_ms: int | None = None  # งบเวลา extract embedding (ms); None = EXTRACTION_DEADLINE_MS
+
+
+class IdentifyResponse(BaseModel):
+    student_id: str | None
+    classroom_id: str | None  # Classroom of the best-matching enrollment (a student may be in several)
+    student_name: str | None  # Frontend provides; we only return student_id
+    similarity: float
+    matched: bool
+
+
+class RecognizeBatchRequest(BaseModel):
+    user_id: str  # Supabase user UUID
+    class_id: str  # Supabase classroom UUID
+    images_base64: list[str]  # Several frames of one kiosk, matched against the same class
+
+
+class RecognizeBatchResponse(BaseModel):
+    results: list[RecognizeResponse]  # One per image, same order as images_base64
+
+
+class RecognizeGroupRequest(BaseModel):
+    user_id: str  # Supabase user UUID
+    class_id: str  # Supabase classroom UUID
+    image_base64: str  # Wide classroom photo with many faces
+
+
+class FaceBox(BaseModel):
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class FaceMatch(BaseModel):
+    student_id: str | None
+    similarity: float
+    matched: bool
+    box: FaceBox  # Pixel box in the uploaded image
+
+
+class RecognizeGroupResponse(BaseModel):
+    faces: list[FaceMatch]  # Every detected face; a student appears at most once
+
+
+class VideoStudent(BaseModel):
+    student_id: str
+    similarity: float  # Best similarity over the tracks matched to this student
+    first_seen_seconds: float  # Offset into the video of the first frame the student was seen
+
+
+class RecognizeVideoResponse(BaseModel):
+    students: list[VideoStudent]  # Recognized students, ordered by first_seen_seconds
+    tracks: int  # Face tracks that were embedded (matched or not)
+    frames_sampled: int
+    duration_seconds: float
+
+
 class CountResponse(BaseModel):
     count: int
 
@@ -0,0 +1,60 @@
+"""Joint face → student assignment for group photos (no SciPy dependency)."""
+from __future__ import annotations
+import numpy as np
+
+
+def max_weight_assignment(weights: np.ndarray) -> np.ndarray:
+    """Assign rows to distinct columns maximizing the total weight (Hungarian / Kuhn-Munkres, O(n^3)).
+
+    weights: (n_rows, n_cols). Returns int array of length n_rows holding the chosen column for each
+    row, or -1 when the row is left unassigned (more rows than columns, or only zero-weight options).
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n_rows, n_cols = weights.shape
+    result = np.full(n_rows, -1, dtype=np.int64)
+    if n_rows == 0 or n_cols == 0:
+        return result
+    n = max(n_rows, n_cols)
+    # Square minimization problem; padding rows/cols cost 0 (= weight 0, "unassigned").
+    cost = np.zeros((n, n), dtype=np.float64)
+    cost[:n_rows, :n_cols] = -weights
+
+    # Shortest augmenting path with potentials (1-indexed, index 0 is the virtual start).
+    u = np.zeros(n + 1)
+    v = np.zeros(n + 1)
+    p = np.zeros(n + 1, dtype=np.int64)  # p[j] = row matched to column j
+    way = np.zeros(n + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(n + 1, np.inf)
+        used = np.zeros(n + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(masked)) + 1
+            delta = masked[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+
+    for j in range(1, n + 1):
+        i = p[j] - 1
+        if i < n_rows and j - 1 < n_cols and weights[i, j - 1] > 0:
+            result[i] = j - 1
+    return result
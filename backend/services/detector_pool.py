@@ -0,0 +1,69 @@
+"""Bounded pools of long-lived face detector instances.
+
+`cv2.CascadeClassifier` and MediaPipe `FaceDetection` are expensive to build (XML parse / graph setup)
+and not safe to share between threads, so each call checks one out exclusively and returns it afterwards.
+"""
+from __future__ import annotations
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from core import metrics
+
+
+class DetectorPool:
+    """At most `max_size` instances built by `factory`; idle ones are reused, callers wait when all are busy."""
+
+    def __init__(self, name: str, factory: Callable[[], Any], max_size: int):
+        self.name = name
+        self._factory = factory
+        self._max_size = max(1, max_size)
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._created = 0
+        self._in_use = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._created
+
+    def _checkout(self) -> Any:
+        try:
+            detector = self._idle.get_nowait()
+            metrics.inc("detector_pool_acquire_total", detector=self.name, outcome="reused")
+            return detector
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self._max_size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                detector = self._factory()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                raise
+            metrics.inc("detector_pool_acquire_total", detector=self.name, outcome="created")
+            metrics.set_gauge("detector_pool_size", self._created, detector=self.name)
+            return detector
+        metrics.inc("detector_pool_acquire_total", detector=self.name, outcome="waited")
+        return self._idle.get()
+
+    @contextmanager
+    def acquire(self) -> Iterator[Any]:
+        """Exclusive use of one detector for the duration of the `with` block."""
+        detector = self._checkout()
+        self._track_in_use(1)
+        try:
+            yield detector
+        finally:
+            self._track_in_use(-1)
+            self._idle.put(detector)
+
+    def _track_in_use(self, delta: int) -> None:
+        with self._lock:
+            self._in_use += delta
+            metrics.set_gauge("detector_pool_in_use", self._in_use, detector=self.name)
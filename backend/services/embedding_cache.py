@@ -0,0 +1,113 @@
+"""Bounded LRU/TTL cache of extraction results, keyed by a hash of the decoded image bytes.
+
+The frontend retries `/recognize` and `/enroll` on timeouts and usually resends the same JPEG. A retry of
+an image that was already embedded is answered from the cache, and a retry that arrives while the first
+request is still extracting waits for that result instead of running the cascade a second time.
+Only successful extractions are cached; "no face" is recomputed so a retry with more time can succeed.
+"""
+from __future__ import annotations
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable
+
+import numpy as np
+
+from core import metrics
+
+# Per-entry bookkeeping on top of the vector itself (key, tuple, OrderedDict node)
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+def content_key(raw: bytes, *variant: object) -> tuple:
+    """Cache key: 128-bit BLAKE2b of the image bytes plus anything else the result depends on."""
+    return (hashlib.blake2b(raw, digest_size=16).digest(), *variant)
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int, ttl_seconds: float, name: str = "embedding"):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.name = name
+        # key -> (expires_at, embedding float32, confidence)
+        self._entries: OrderedDict[tuple, tuple[float, np.ndarray, float]] = OrderedDict()
+        self._inflight: dict[tuple, Future] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get_or_compute(
+        self,
+        key: tuple,
+        compute: Callable[[], tuple[list[float], float] | None],
+    ) -> tuple[list[float], float] | None:
+        """Cached (embedding, confidence) for `key`, else `compute()` once even with concurrent callers."""
+        if not self.enabled:
+            return compute()
+        with self._lock:
+            hit = self._lookup_locked(key)
+            if hit is None:
+                waiting = self._inflight.get(key)
+                if waiting is None:
+                    future: Future = Future()
+                    self._inflight[key] = future
+        if hit is not None:
+            metrics.inc("embedding_cache_total", cache=self.name, outcome="hit")
+            return hit[0].tolist(), hit[1]
+        if waiting is not None:
+            metrics.inc("embedding_cache_total", cache=self.name, outcome="coalesced")
+            return waiting.result()
+
+        metrics.inc("embedding_cache_total", cache=self.name, outcome="miss")
+        try:
+            result = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        if result is not None:
+            # Stored as float32 (what storage keeps anyway); the first caller gets the same values as a hit
+            embedding = np.asarray(result[0], dtype=np.float32)
+            result = (embedding.tolist(), float(result[1]))
+        with self._lock:
+            del self._inflight[key]
+            if result is not None:
+                self._store_locked(key, embedding, result[1])
+        future.set_result(result)
+        return result
+
+    def _lookup_locked(self, key: tuple) -> tuple[np.ndarray, float] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, embedding, confidence = entry
+        if expires_at < time.monotonic():
+            self._drop_locked(key)
+            return None
+        self._entries.move_to_end(key)
+        return embedding, confidence
+
+    def _store_locked(self, key: tuple, embedding: np.ndarray, confidence: float) -> None:
+        size = embedding.nbytes + _ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop_locked(key)
+        self._entries[key] = (time.monotonic() + self.ttl, embedding, confidence)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop_locked(oldest)
+            metrics.inc("embedding_cache_evictions_total", cache=self.name)
+        metrics.set_gauge("embedding_cache_bytes", self._bytes, cache=self.name)
+        metrics.set_gauge("embedding_cache_entries", len(self._entries), cache=self.name)
+
+    def _drop_locked(self, key: tuple) -> None:
+        _, embedding, _ = self._entries.pop(key)
+        self._bytes -= embedding.nbytes + _ENTRY_OVERHEAD_BYTES
@@ -0,0 +1,146 @@
+"""Facenet512 embedding engines behind `face_service`.
+
+EMBEDDING_ENGINE=deepface (default) runs the Keras model DeepFace builds. EMBEDDING_ENGINE=onnx runs an
+exported Facenet512 graph through ONNX Runtime on CPU, skipping DeepFace.represent's per-call
+preprocessing/validation and returning float32 arrays directly.
+
+Both engines take a float32 batch of shape (N, 160, 160, 3) built by `to_model_input`, which reproduces
+what `DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)` feeds the
+model (deepface 0.0.93, default detector_backend="opencv"): OpenCV Haar detection on the RGB image, crop of
+the first face (the whole image when none is found), RGB channel order, [0, 1] scale and the aspect-preserving
+resize padded with black. Embeddings from the engines are therefore comparable with every enrollment stored by
+the DeepFace.represent path; tests/test_embedding_parity.py checks this numerically against deepface.
+
+Export the ONNX model once (needs deepface + tf2onnx):
+    python -m services.embedding_engine export data/facenet512.onnx
+"""
+from __future__ import annotations
+import logging
+import os
+import sys
+import threading
+
+import cv2
+import numpy as np
+
+from config import EMBEDDING_ENGINE, ONNX_MODEL_PATH, ONNX_INTRA_OP_THREADS, ONNX_INTER_OP_THREADS
+from core import metrics
+
+logger = logging.getLogger("embedding_engine")
+
+INPUT_SIZE = 160
+
+
+def to_model_input(face_rgb: np.ndarray, cascade: "cv2.CascadeClassifier") -> np.ndarray:
+    """(160, 160, 3) float32 model input for one uint8 RGB face crop, exactly as DeepFace.represent builds it.
+
+    `cascade` is a haarcascade_frontalface_default classifier; DeepFace runs it on the array it was given
+    (RGB here) with scaleFactor=1.1, minNeighbors=10 and keeps the first detection.
+    """
+    try:
+        faces, _, _ = cascade.detectMultiScale3(face_rgb, 1.1, 10, outputRejectLevels=True)
+    except cv2.error:
+        faces = ()
+    face = face_rgb
+    if len(faces) > 0:
+        x, y, w, h = (int(v) for v in faces[0])
+        crop = face_rgb[y : y + h, x : x + w]
+        if crop.shape[0] > 0 and crop.shape[1] > 0:
+            face = crop
+    # DeepFace scales to [0, 1] before resizing, so the resize runs in float64 like theirs
+    face = face / 255
+    factor = min(INPUT_SIZE / face.shape[0], INPUT_SIZE / face.shape[1])
+    face = cv2.resize(face, (int(face.shape[1] * factor), int(face.shape[0] * factor)))
+    if face.ndim == 2:
+        face = face[:, :, None]
+    diff_h, diff_w = INPUT_SIZE - face.shape[0], INPUT_SIZE - face.shape[1]
+    face = np.pad(face, ((diff_h // 2, diff_h - diff_h // 2), (diff_w // 2, diff_w - diff_w // 2), (0, 0)), "constant")
+    if face.shape[:2] != (INPUT_SIZE, INPUT_SIZE):
+        face = cv2.resize(face, (INPUT_SIZE, INPUT_SIZE))
+    return face.astype(np.float32)
+
+
+class DeepFaceEngine:
+    """Batched forward pass through DeepFace's Keras Facenet512 model."""
+
+    name = "deepface"
+
+    def __init__(self) -> None:
+        from deepface import DeepFace
+        self._model = DeepFace.build_model("Facenet512")
+
+    def embed_batch(self, inputs: np.ndarray) -> np.ndarray:
+        """Embeddings (N, 512) for a (N, 160, 160, 3) batch of `to_model_input` arrays."""
+        with metrics.timer("model_inference_seconds", engine=self.name, model="Facenet512"):
+            out = self._model.model(np.ascontiguousarray(inputs, dtype=np.float32), training=False)
+        return np.asarray(out, dtype=np.float32).reshape(len(inputs), -1)
+
+
+class OnnxEngine:
+    """Facenet512 exported to ONNX, run with ONNX Runtime's CPU provider and configurable thread counts."""
+
+    name = "onnx"
+
+    def __init__(self, model_path: str, intra_op_threads: int = 0, inter_op_threads: int = 1) -> None:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads  # 0 = ONNX Runtime default (all physical cores)
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self._input_name = self._session.get_inputs()[0].name
+
+    def embed_batch(self, inputs: np.ndarray) -> np.ndarray:
+        """Embeddings (N, 512) for a (N, 160, 160, 3) batch of `to_model_input` arrays."""
+        with metrics.timer("model_inference_seconds", engine=self.name, model="Facenet512"):
+            (out,) = self._session.run(None, {self._input_name: np.ascontiguousarray(inputs, dtype=np.float32)})
+        return np.asarray(out, dtype=np.float32).reshape(len(inputs), -1)
+
+
+_engine: DeepFaceEngine | OnnxEngine | None = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> DeepFaceEngine | OnnxEngine:
+    """The process-wide engine selected by EMBEDDING_ENGINE (built on first use).
+
+    If the ONNX engine cannot be loaded (onnxruntime missing, model not exported yet) we log a warning
+    and fall back to DeepFace, the same way missing optional detectors are skipped.
+    """
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is None:
+            engine = None
+            if EMBEDDING_ENGINE == "onnx":
+                try:
+                    engine = OnnxEngine(ONNX_MODEL_PATH, ONNX_INTRA_OP_THREADS, ONNX_INTER_OP_THREADS)
+                    logger.info("Embedding engine: ONNX Runtime (%s)", ONNX_MODEL_PATH)
+                except Exception as e:
+                    logger.warning("ONNX engine unavailable (%s), falling back to DeepFace", e)
+            elif EMBEDDING_ENGINE != "deepface":
+                logger.warning("Unknown EMBEDDING_ENGINE=%r, using DeepFace", EMBEDDING_ENGINE)
+            _engine = engine or DeepFaceEngine()
+    return _engine
+
+
+def export_onnx(output_path: str = ONNX_MODEL_PATH, opset: int = 13) -> str:
+    """Export DeepFace's Facenet512 Keras model to ONNX with a dynamic batch dimension."""
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+
+    keras_model = DeepFace.build_model("Facenet512").model
+    spec = (tf.TensorSpec((None, INPUT_SIZE, INPUT_SIZE, 3), tf.float32, name="input"),)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tf2onnx.convert.from_keras(keras_model, input_signature=spec, opset=opset, output_path=output_path)
+    return output_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "export":
+        print("Exported:", export_onnx(*sys.argv[2:3]))
+    else:
+        print("usage: python -m services.embedding_engine export [output.onnx]")
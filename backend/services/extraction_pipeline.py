@@ -0,0 +1,165 @@
+"""Adaptive, deadline-bounded strategy pipeline for embedding extraction.
+
+A pipeline is an ordered list of named stages; the first stage that returns a result wins. Every run
+updates per-stage success rate and latency, and adaptive pipelines periodically reorder themselves so
+the cheapest likely winners run first. Stages behind a winner never run on their own, so adaptive
+pipelines also move an under-sampled stage forward now and then to measure it. Only detector stages
+(which can fail) move: `fixed` stages embed a specific crop and nearly always succeed, so they keep
+their configured position and the crop that wins does not depend on traffic. A deadline stops the
+cascade between stages, which bounds the worst case on frames without a face.
+"""
+from __future__ import annotations
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from core import metrics, tracing
+
+# Latency is smoothed with an exponential moving average so the order follows current load.
+_LATENCY_EWMA_ALPHA = 0.1
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[Any], Any]
+    # Embeds a fixed crop without detection (almost never fails): never reordered or explored
+    fixed: bool = False
+
+
+class StageStats:
+    __slots__ = ("attempts", "successes", "latency_ewma")
+
+    def __init__(self) -> None:
+        self.attempts = 0
+        self.successes = 0
+        self.latency_ewma: float | None = None
+
+    def record(self, success: bool, seconds: float) -> None:
+        self.attempts += 1
+        if success:
+            self.successes += 1
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += _LATENCY_EWMA_ALPHA * (seconds - self.latency_ewma)
+
+    def expected_cost(self) -> float:
+        """Seconds spent per success (Laplace-smoothed success rate)."""
+        success_rate = (self.successes + 1) / (self.attempts + 2)
+        return (self.latency_ewma or 0.0) / success_rate
+
+    def as_dict(self) -> dict:
+        return {
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "success_rate": round(self.successes / self.attempts, 4) if self.attempts else None,
+            "latency_ms": round(self.latency_ewma * 1000, 2) if self.latency_ewma is not None else None,
+        }
+
+
+class ExtractionPipeline:
+    """Runs stages in order until one succeeds, the list is exhausted or the deadline passes.
+
+    With `adaptive=True` the order is recomputed every `reorder_every` runs: within each run of
+    non-fixed stages between two fixed ones, stages with at least `min_samples` attempts are sorted by
+    expected cost per success; stages without enough samples keep their configured relative position
+    behind them (a stable sort), so a cold pipeline runs in the hand-tuned default order. Every
+    `explore_every` runs (0 = never) the non-fixed stage with the fewest attempts among those still
+    below `min_samples` moves to the front of its group for that one call, so it gathers the samples
+    it needs to be ranked. Fixed stages always stay where they were configured.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        stages: list[Stage],
+        *,
+        adaptive: bool = True,
+        min_samples: int = 20,
+        reorder_every: int = 50,
+        explore_every: int = 10,
+    ):
+        self.name = name
+        self.stages = list(stages)
+        self.adaptive = adaptive
+        self.min_samples = min_samples
+        self.reorder_every = reorder_every
+        self.explore_every = explore_every
+        self._stats = {s.name: StageStats() for s in stages}
+        self._order = list(stages)
+        self._runs = 0
+        self._lock = threading.Lock()
+
+    def _groups(self, order: list[Stage]) -> list[list[Stage]]:
+        """Split `order` into single fixed stages and runs of adaptive stages between them."""
+        groups: list[list[Stage]] = []
+        for stage in order:
+            if stage.fixed or not groups or groups[-1][0].fixed:
+                groups.append([stage])
+            else:
+                groups[-1].append(stage)
+        return groups
+
+    def _current_order(self, adaptive: bool) -> list[Stage]:
+        if not (self.adaptive and adaptive):
+            return self.stages
+        with self._lock:
+            self._runs += 1
+            if self._runs % self.reorder_every == 0:
+                def key(stage: Stage) -> float:
+                    stats = self._stats[stage.name]
+                    return stats.expected_cost() if stats.attempts >= self.min_samples else float("inf")
+                self._order = [
+                    s for group in self._groups(self.stages)
+                    for s in (group if group[0].fixed else sorted(group, key=key))
+                ]
+            if self.explore_every > 0 and self._runs % self.explore_every == 0:
+                cold = [s for s in self._order if not s.fixed and self._stats[s.name].attempts < self.min_samples]
+                if cold:
+                    probe = min(cold, key=lambda s: self._stats[s.name].attempts)
+                    metrics.inc("extraction_explore_total", pipeline=self.name, stage=probe.name)
+                    return [
+                        s for group in self._groups(self._order)
+                        for s in ([probe] + [g for g in group if g is not probe] if probe in group else group)
+                    ]
+            return self._order
+
+    def run(self, ctx: Any, deadline: float | None = None, *, adaptive: bool = True) -> tuple[Any, str | None]:
+        """Return (result, winning stage name) or (None, None).
+
+        `deadline` is a `time.perf_counter()` timestamp; it is checked before every stage except the
+        first, so even a tight budget gets one attempt. `adaptive=False` forces the default order
+        (used when the caller pins a model and stage order changes the output dimension).
+        """
+        for i, stage in enumerate(self._current_order(adaptive)):
+            if i > 0 and deadline is not None and time.perf_counter() >= deadline:
+                metrics.inc("extraction_deadline_exceeded_total", pipeline=self.name, stage=stage.name)
+                tracing.event("deadline_exceeded", pipeline=self.name, next_stage=stage.name)
+                return None, None
+            started = time.perf_counter()
+            with tracing.span(f"extract.{self.name}.{stage.name}") as span:
+                try:
+                    result = stage.run(ctx)
+                    outcome = "hit" if result else "miss"
+                except Exception as e:
+                    result = None
+                    outcome = "error"
+                    span.set(error=f"{type(e).__name__}: {e}")
+                span.set(outcome=outcome)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._stats[stage.name].record(bool(result), elapsed)
+            metrics.inc("extraction_stage_total", pipeline=self.name, stage=stage.name, outcome=outcome)
+            metrics.observe("extraction_stage_seconds", elapsed, pipeline=self.name, stage=stage.name, outcome=outcome)
+            if result:
+                return result, stage.name
+        return None, None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "order": [s.name for s in self._order],
+                "stages": {name: st.as_dict() for name, st in self._stats.items()},
+            }
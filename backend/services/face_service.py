@@ -2,15 +2,36 @@
 Face detection + embedding: Haar, center crop, full-image fallback. รองรับกรอบ oval กลางจอ
 """
 import logging
+import threading
+import time
 import numpy as np
 import cv2
 import base64
 
+from config import (
+    GROUP_PHOTO_MAX_SIDE,
+    DETECTOR_POOL_SIZE,
+    EXTRACTION_DEADLINE_MS,
+    EMBED_BATCH_MAX_SIZE,
+    EMBED_BATCH_MAX_WAIT_MS,
+    EMBED_BATCH_MAX_QUEUE,
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_TTL_SECONDS,
+)
+from core import logs, metrics, tracing
+from services.detector_pool import DetectorPool
+from services.embedding_cache import EmbeddingCache, content_key
+from services.embedding_engine import get_engine, to_model_input
+from services.extraction_pipeline import ExtractionPipeline, Stage
+from services.micro_batcher import MicroBatcher
+
 logger = logging.getLogger("face_service")
 
 # Facenet512 ต้องการรูปอย่างน้อยประมาณ 160x160
 MIN_FACE_SIZE = 160
 _embedding_model_loaded = False
+_embedding_model_lock = threading.Lock()
+_warmup_state: dict = {"status": "cold", "error": None, "seconds": None}
 
 
 def model_order_for_dim(dim: int) -> tuple[str, ...]:
@@ -26,7 +47,16 @@ def model_order_for_dim(dim: int) -> tuple[str, ...]:
 
 def _ensure_embedding_model():
     global _embedding_model_loaded
-    if not _embedding_model_loaded:
+    if _embedding_model_loaded:
+        return
+    with _embedding_model_lock:
+        if _embedding_model_loaded:
+            return
+        if get_engine().name != "deepface":
+            # Facenet512 runs on the ONNX engine (loaded by get_engine); DeepFace is only imported
+            # lazily if a fallback stage needs another model or detector
+            _embedding_model_loaded = True
+            return
         from deepface import DeepFace
         import os
         try:
@@ -49,6 +79,42 @@ def _ensure_embedding_model():
             _embedding_model_loaded = True
 
 
+def warm_up() -> dict:
+    """Load everything the first request would otherwise pay for: DeepFace/TensorFlow import,
+    Facenet512 weights, the batched forward path, MediaPipe and the Haar cascade.
+
+    Meant to run once in the background at startup; `readiness()` reports the outcome.
+    """
+    _warmup_state.update(status="warming", error=None)
+    started = time.perf_counter()
+    try:
+        get_engine()
+        _ensure_embedding_model()
+        blank = np.zeros((MIN_FACE_SIZE, MIN_FACE_SIZE, 3), dtype=np.uint8)
+        embed_faces_batch([blank])
+        _haar_face_boxes(blank)
+        try:
+            _mediapipe_face_boxes(blank)
+        except ImportError:
+            pass
+        _warmup_state.update(status="ready")
+    except Exception as e:
+        logger.exception("Model warm-up failed: %s", str(e))
+        _warmup_state.update(status="failed", error=f"{type(e).__name__}: {e}")
+    _warmup_state["seconds"] = round(time.perf_counter() - started, 2)
+    logger.info("Model warm-up %s in %.2fs", _warmup_state["status"], _warmup_state["seconds"])
+    return readiness()
+
+
+def readiness() -> dict:
+    """Warm-up status: {"status": "cold" | "warming" | "ready" | "failed", ...}."""
+    state = dict(_warmup_state)
+    if state["status"] == "cold" and _embedding_model_loaded:
+        # Warm-up disabled, but a request already loaded the model lazily
+        state["status"] = "ready"
+    return state
+
+
 def _prepare_for_embedding(img: np.ndarray) -> np.ndarray:
     """Resize to 160x160 (Facenet512 standard) — ให้แน่ใจว่าเป็น uint8, 3 channels"""
     h, w = img.shape[:2]
@@ -62,6 +128,51 @@ def _prepare_for_embedding(img: np.ndarray) -> np.ndarray:
     return out
 
 
+def _model_input(face_bgr: np.ndarray) -> np.ndarray:
+    """Facenet512 input for a face crop, identical to what the DeepFace.represent path builds from it
+    (`_prepare_for_embedding`, BGR→RGB, then DeepFace's own detect/crop/pad; see `embedding_engine`)."""
+    img_rgb = cv2.cvtColor(_prepare_for_embedding(face_bgr), cv2.COLOR_BGR2RGB)
+    with _haar_pool.acquire() as cascade:
+        return to_model_input(img_rgb, cascade)
+
+
+# Single-crop Facenet512 calls from concurrent requests are batched into one engine forward pass
+_embedding_batcher = MicroBatcher(
+    "facenet512",
+    lambda batch: get_engine().embed_batch(batch),
+    max_batch_size=EMBED_BATCH_MAX_SIZE,
+    max_wait_ms=EMBED_BATCH_MAX_WAIT_MS,
+    max_queue=EMBED_BATCH_MAX_QUEUE,
+)
+
+
+def _batching_enabled() -> bool:
+    return EMBED_BATCH_MAX_SIZE > 1
+
+
+def _represent_facenet512(face_bgr: np.ndarray) -> list[float] | None:
+    """Facenet512 embedding of one face crop through the configured engine (see `services.embedding_engine`).
+
+    With micro-batching on, the crop joins whatever other requests are embedding at the same moment.
+    """
+    if _batching_enabled():
+        model_input = _model_input(face_bgr)
+        with tracing.span("embed_micro_batch"):
+            return _embedding_batcher.submit(model_input).tolist()
+    engine = get_engine()
+    if engine.name != "deepface":
+        return engine.embed_batch(_model_input(face_bgr)[None])[0].tolist()
+    from deepface import DeepFace
+    img_rgb = cv2.cvtColor(_prepare_for_embedding(face_bgr), cv2.COLOR_BGR2RGB)
+    with metrics.timer("model_inference_seconds", engine="deepface.represent", model="Facenet512"):
+        objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
+    if objs and len(objs) > 0:
+        emb = objs[0].get("embedding")
+        if emb and len(emb) > 0:
+            return list(emb)
+    return None
+
+
 def _extract_embedding_with_model(
     face_img: np.ndarray,
     model_name: str,
@@ -69,74 +180,84 @@ def _extract_embedding_with_model(
     use_detector: bool = False,
     detector_backend: str = "opencv",
 ) -> tuple[list[float], float] | None:
-    from deepface import DeepFace
     if face_img.size == 0:
         return None
+    if model_name == "Facenet512" and not use_detector and (_batching_enabled() or get_engine().name != "deepface"):
+        emb = _represent_facenet512(face_img)
+        return (emb, 1.0) if emb else None
+    from deepface import DeepFace
     if not use_detector:
         face_img = _prepare_for_embedding(face_img)
     img_rgb = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
+    detector = detector_backend if use_detector else "none"
     try:
         kwargs = {"model_name": model_name, "enforce_detection": use_detector, "align": use_detector}
         if use_detector:
             kwargs["detector_backend"] = detector_backend
-        print(
-            f"    [DEBUG] Calling DeepFace.represent(model={model_name}, "
-            f"enforce={use_detector}, det={detector_backend if use_detector else 'none'}, "
-            f"img_shape={img_rgb.shape})"
-        )
-        objs = DeepFace.represent(img_rgb, **kwargs)
-        print(
-            f"    [DEBUG] DeepFace.represent returned: type={type(objs)}, "
-            f"len={len(objs) if objs else 0}"
-        )
+        # With a detector the time includes DeepFace's own face detection
+        engine = f"deepface.represent+{detector_backend}" if use_detector else "deepface.represent"
+        with metrics.timer("model_inference_seconds", engine=engine, model=model_name):
+            objs = DeepFace.represent(img_rgb, **kwargs)
         if objs and len(objs) > 0:
             obj = objs[0]
             emb = obj.get("embedding")
-            print(
-                f"    [DEBUG] embedding: type={type(emb)}, len={len(emb) if emb else 0}"
-            )
             if emb and len(emb) > 0:
                 conf = float(obj.get("face_confidence", 1.0))
                 return (list(emb), conf)
-        else:
-            print("    [DEBUG] DeepFace.represent returned empty or None")
+        logs.event(logger, "represent_empty", level=logging.DEBUG, model=model_name, detector=detector, shape=img_rgb.shape)
     except Exception as e:
-        err_msg = f"DeepFace.represent({model_name}, det={detector_backend if use_detector else 'no'}): {e}"
-        logger.warning(err_msg)
-        print(f"    [DEBUG] Exception: {type(e).__name__}: {e}")
-        import traceback
-        print(f"    [DEBUG] Traceback: {traceback.format_exc()}")
+        # enforce_detection=True raises on every frame without a face: sampled, traceback only at DEBUG
+        logs.sampled(logger, "represent_failed", model=model_name, detector=detector, error=f"{type(e).__name__}: {e}")
+        logger.debug("DeepFace.represent(%s, det=%s) failed", model_name, detector, exc_info=True)
     return None
 
 
+def _new_haar_cascade() -> "cv2.CascadeClassifier":
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    if cascade.empty():
+        raise RuntimeError("Haar cascade XML could not be loaded")
+    return cascade
+
+
+def _new_mediapipe_detector():
+    import mediapipe as mp
+    return mp.solutions.face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5)
+
+
+# Long-lived detectors, one per concurrent caller (neither object is thread-safe)
+_haar_pool = DetectorPool("haar", _new_haar_cascade, DETECTOR_POOL_SIZE)
+_mediapipe_pool = DetectorPool("mediapipe", _new_mediapipe_detector, DETECTOR_POOL_SIZE)
+
+
+def _haar_face_boxes(img_bgr: np.ndarray, pad_ratio: float = 0.2) -> list[tuple[int, int, int, int]]:
+    """OpenCV Haar Cascade → padded (x1, y1, x2, y2) boxes in detection order."""
+    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    gray = cv2.equalizeHist(gray)
+    with _haar_pool.acquire() as face_cascade:
+        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.05, minNeighbors=3, minSize=(20, 20))
+    h_img, w_img = img_bgr.shape[:2]
+    boxes = []
+    for x, y, w, h in (map(int, f) for f in faces):
+        pad = int(min(w, h) * pad_ratio)
+        boxes.append((max(0, x - pad), max(0, y - pad), min(w_img, x + w + pad), min(h_img, y + h + pad)))
+    return boxes
+
+
 def _extract_via_opencv_haar(img_bgr: np.ndarray) -> tuple[list[float], float] | None:
     """ใช้ OpenCV Haar Cascade ตรวจจับใบหน้าโดยตรง (ไม่ต้องพึ่ง DeepFace detector)"""
-    from deepface import DeepFace
     try:
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-        gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-        gray = cv2.equalizeHist(gray)
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.05, minNeighbors=3, minSize=(20, 20))
-        if len(faces) == 0:
+        boxes = _haar_face_boxes(img_bgr)
+        if not boxes:
             return None
-        x, y, w, h = faces[0]
-        pad = int(min(w, h) * 0.2)
-        x1 = max(0, x - pad)
-        y1 = max(0, y - pad)
-        x2 = min(img_bgr.shape[1], x + w + pad)
-        y2 = min(img_bgr.shape[0], y + h + pad)
+        x1, y1, x2, y2 = boxes[0]
         face_crop = img_bgr[y1:y2, x1:x2]
         if face_crop.size == 0:
             return None
-        face_crop = _prepare_for_embedding(face_crop)
-        img_rgb = cv2.cvtColor(face_crop, cv2.COLOR_BGR2RGB)
-        objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
-        if objs and len(objs) > 0:
-            emb = objs[0].get("embedding")
-            if emb and len(emb) > 0:
-                return (list(emb), 1.0)
+        emb = _represent_facenet512(face_crop)
+        if emb:
+            return (emb, 1.0)
     except Exception as e:
-        logger.warning("_extract_via_opencv_haar failed: %s", str(e))
+        logs.sampled(logger, "extraction_stage_failed", stage="haar", error=str(e))
     return None
 
 
@@ -158,13 +279,14 @@ def _extract_via_extract_faces(img_bgr: np.ndarray, detector: str) -> tuple[list
             face_img = cv2.cvtColor(face_img, cv2.COLOR_RGB2BGR)
         face_img = _prepare_for_embedding(face_img)
         img_rgb = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
-        objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
+        with metrics.timer("model_inference_seconds", engine="deepface.represent", model="Facenet512"):
+            objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
         if objs and len(objs) > 0:
             emb = objs[0].get("embedding")
             if emb and len(emb) > 0:
                 return (list(emb), float(objs[0].get("face_confidence", 1.0)))
     except Exception as e:
-        logger.warning("_extract_via_extract_faces failed: %s | det=%s", str(e), detector)
+        logs.sampled(logger, "extraction_stage_failed", stage="extract_faces", detector=detector, error=str(e))
     return None
 
 
@@ -172,43 +294,43 @@ def _extract_embedding(face_img: np.ndarray) -> tuple[list[float], float] | None
     return _extract_embedding_with_model(face_img, "Facenet512")
 
 
+def _mediapipe_face_boxes(img_bgr: np.ndarray, pad_ratio: float = 0.3) -> list[tuple[int, int, int, int]]:
+    """MediaPipe face detection → padded (x1, y1, x2, y2) boxes, best first. Raises ImportError without mediapipe."""
+    with _mediapipe_pool.acquire() as detector:
+        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+        results = detector.process(img_rgb)
+    if not results.detections:
+        return []
+    h, w = img_bgr.shape[:2]
+    boxes = []
+    for d in results.detections:
+        b = d.location_data.relative_bounding_box
+        x = int(b.xmin * w)
+        y = int(b.ymin * h)
+        bw = int(b.width * w)
+        bh = int(b.height * h)
+        pad = int(min(bw, bh) * pad_ratio)
+        boxes.append((max(0, x - pad), max(0, y - pad), min(w, x + bw + pad), min(h, y + bh + pad)))
+    return boxes
+
+
 def _extract_via_mediapipe_py(img_bgr: np.ndarray) -> tuple[list[float], float] | None:
     """ใช้ MediaPipe Python ตรวจจับใบหน้า → crop → DeepFace embedding (รองรับแว่น/มุมต่างๆ)"""
-    from deepface import DeepFace
     try:
-        import mediapipe as mp
-        mp_face = mp.solutions.face_detection
-        with mp_face.FaceDetection(model_selection=1, min_detection_confidence=0.5) as detector:
-            img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-            results = detector.process(img_rgb)
-            if not results.detections:
-                return None
-            h, w = img_bgr.shape[:2]
-            d = results.detections[0]
-            b = d.location_data.relative_bounding_box
-            x = int(b.xmin * w)
-            y = int(b.ymin * h)
-            bw = int(b.width * w)
-            bh = int(b.height * h)
-            pad = int(min(bw, bh) * 0.3)
-            x1 = max(0, x - pad)
-            y1 = max(0, y - pad)
-            x2 = min(w, x + bw + pad)
-            y2 = min(h, y + bh + pad)
-            face_crop = img_bgr[y1:y2, x1:x2]
-            if face_crop.size < 100:
-                return None
-            face_crop = _prepare_for_embedding(face_crop)
-            img_rgb = cv2.cvtColor(face_crop, cv2.COLOR_BGR2RGB)
-            objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
-            if objs and len(objs) > 0:
-                emb = objs[0].get("embedding")
-                if emb and len(emb) > 0:
-                    return (list(emb), 1.0)
+        boxes = _mediapipe_face_boxes(img_bgr)
+        if not boxes:
+            return None
+        x1, y1, x2, y2 = boxes[0]
+        face_crop = img_bgr[y1:y2, x1:x2]
+        if face_crop.size < 100:
+            return None
+        emb = _represent_facenet512(face_crop)
+        if emb:
+            return (emb, 1.0)
     except ImportError:
         return None
     except Exception as e:
-        logger.warning("_extract_via_mediapipe_py failed: %s", str(e))
+        logs.sampled(logger, "extraction_stage_failed", stage="mediapipe", error=str(e))
     return None
 
 
@@ -224,13 +346,12 @@ def _extract_via_face_recognition(img_bgr: np.ndarray) -> tuple[list[float], flo
     except ImportError:
         return None
     except Exception as e:
-        logger.warning("face_recognition failed: %s", str(e))
+        logs.sampled(logger, "extraction_stage_failed", stage="face_recognition", error=str(e))
         return None
 
 
 def _extract_center_then_represent(img_bgr: np.ndarray) -> tuple[list[float], float] | None:
     """ทางเลือกสุดท้าย: crop ตรงกลาง 70% แล้ว represent (กรณีรูปเป็น face crop)"""
-    from deepface import DeepFace
     try:
         h, w = img_bgr.shape[:2]
         if h < 50 or w < 50:
@@ -242,154 +363,174 @@ def _extract_center_then_represent(img_bgr: np.ndarray) -> tuple[list[float], fl
             center = img_bgr
         else:
             center = img_bgr[y1:y2, x1:x2]
-        center = _prepare_for_embedding(center)
-        img_rgb = cv2.cvtColor(center, cv2.COLOR_BGR2RGB)
-        objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
-        if objs and len(objs) > 0:
-            emb = objs[0].get("embedding")
-            if emb and len(emb) > 0:
-                return (list(emb), 0.9)
+        emb = _represent_facenet512(center)
+        if emb:
+            return (emb, 0.9)
     except Exception as e:
-        logger.warning("_extract_center_then_represent failed: %s", str(e))
+        logs.sampled(logger, "extraction_stage_failed", stage="center_crop", error=str(e))
     return None
 
 
-def get_embedding_from_image(
-    image_bgr: np.ndarray,
-    preferred_models: tuple[str, ...] | None = None,
-) -> tuple[list[float], float] | None:
-    # เมื่อต้องใช้ dimension เฉพาะ (เช่น 4096 จากข้อมูลเก่า) อย่าใช้ mediapipe/face_recognition ก่อน
-    # เพราะจะได้ 512/128 เสมอ → ต้องลอง preferred_models ก่อน
-    if not preferred_models:
-        r = _extract_via_mediapipe_py(image_bgr)
-        if r:
-            return r
-        r = _extract_via_face_recognition(image_bgr)
-        if r:
-            return r
-    _ensure_embedding_model()
+def _downscale_frame(image_bgr: np.ndarray, max_side: int = 960) -> np.ndarray:
+    """Shrink frames larger than `max_side` (longest edge); smaller images are copied unchanged."""
     h, w = image_bgr.shape[:2]
-    if h < 10 or w < 10:
-        return None
-    if max(h, w) > 960:
-        scale = 960 / max(h, w)
-        img = cv2.resize(image_bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_LINEAR)
-    else:
-        img = image_bgr.copy()
+    if max(h, w) > max_side:
+        scale = max_side / max(h, w)
+        return cv2.resize(image_bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_LINEAR)
+    return image_bgr.copy()
+
 
-    iw, ih = img.shape[1], img.shape[0]
+def _is_likely_face_crop(img: np.ndarray) -> bool:
+    """รูปเล็ก/กลาง สัดส่วนใกล้สี่เหลี่ยม มักเป็น face crop จาก frontend MediaPipe"""
+    ih, iw = img.shape[:2]
     max_dim = max(iw, ih)
-    is_likely_face_crop = max_dim <= 600 and 0.35 <= (min(iw, ih) / max_dim) <= 1.0
-    # Reduced logging for performance - only log if debug needed
-    # logger.info("get_embedding_from_image: %dx%d max_dim=%d is_face_crop=%s",
-    #             iw, ih, max_dim, is_likely_face_crop)
-
-    def _try_extract(img_region: np.ndarray, use_det: bool = False, det_backend: str = "opencv"):
-        # Fast-first model order to improve responsiveness
-        model_order = preferred_models or ("Facenet512", "Facenet", "OpenFace", "VGG-Face")
-        for model_name in model_order:
-            r = _extract_embedding_with_model(
-                img_region, model_name, use_detector=use_det, detector_backend=det_backend
-            )
-            if r:
-                return r
-        return None
+    return max_dim <= 600 and 0.35 <= (min(iw, ih) / max_dim) <= 1.0
 
-    # ถ้ารูปเล็ก/กลาง (มักเป็น face crop จาก frontend MediaPipe) → ใช้ทั้งรูปเลย ไม่ center crop
-    if is_likely_face_crop:
-        # Fast path: Try direct embedding first (fastest - no detection needed)
-        result = _try_extract(img)
-        if result:
-            return result
-        
-        # Fast detector fallback: Use OpenCV Haar (fastest detector) first
-        result = _extract_via_opencv_haar(img)
-        if result:
-            return result
-        
-        # Try center crop as fallback (very fast)
-        result = _extract_center_then_represent(img)
-        if result:
-            return result
-        
-        # Only try DeepFace detectors if above methods failed (slower)
-        # Prioritize faster detectors: opencv > mediapipe > ssd > yunet
-        for det in ("opencv", "mediapipe"):
-            try:
-                result = _try_extract(img, use_det=True, det_backend=det)
-                if result:
-                    return result
-            except Exception:
-                continue
-        
-        # Final fallback: Simple resize and represent (fastest fallback)
-        try:
-            from deepface import DeepFace
-            simple_resized = cv2.resize(img, (160, 160), interpolation=cv2.INTER_LINEAR)
-            img_rgb = cv2.cvtColor(simple_resized, cv2.COLOR_BGR2RGB)
-            objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
-            if objs and len(objs) > 0:
-                emb = objs[0].get("embedding")
-                if emb and len(emb) > 0:
-                    return (list(emb), 0.8)
-        except Exception as e:
-            logger.warning("Final fallback (simple resize) failed: %s", str(e))
-        return None
 
-    # รูปใหญ่ = เฟรมกล้องเต็ม → ใช้ center crop (ใบหน้าในกรอบ oval กลางจอ)
+def _oval_region(img: np.ndarray) -> np.ndarray:
+    """Center region of a full camera frame (ใบหน้าในกรอบ oval กลางจอ)."""
+    ih, iw = img.shape[:2]
     margin_x = int(iw * 0.05)
     margin_y = int(ih * 0.08)
     x1, y1 = margin_x, margin_y
     x2, y2 = iw - margin_x, ih - margin_y
     if x2 <= x1 or y2 <= y1:
-        face_region = img
-    else:
-        face_region = img[y1:y2, x1:x2]
-
-    # Fast path: Try center crop region first (most likely to contain face)
-    result = _try_extract(face_region)
-    if result:
-        return result
-    
-    # Try full image
-    result = _try_extract(img)
-    if result:
-        return result
-    
-    # Fast detector: OpenCV Haar (fastest)
-    result = _extract_via_opencv_haar(img)
-    if result:
-        return result
-    
-    # Try center crop fallback
-    result = _extract_center_then_represent(img)
-    if result:
-        return result
-    
-    # Only try DeepFace detectors if above methods failed (prioritize faster ones)
-    for det in ("opencv", "mediapipe"):
-        try:
-            result = _try_extract(img, use_det=True, det_backend=det)
-            if result:
-                return result
-        except Exception:
-            continue
-    
-    # Final fallback: Simple resize and represent
+        return img
+    return img[y1:y2, x1:x2]
+
+
+_DEFAULT_MODEL_ORDER = ("Facenet512", "Facenet", "OpenFace", "VGG-Face")
+
+
+class _ExtractionContext:
+    """Inputs shared by the cascade stages of one `get_embedding_from_image` call."""
+
+    __slots__ = ("image", "img", "face_region", "preferred_models")
+
+    def __init__(self, image: np.ndarray, preferred_models: tuple[str, ...] | None):
+        self.image = image
+        self.img: np.ndarray | None = None
+        self.face_region: np.ndarray | None = None
+        self.preferred_models = preferred_models
+
+
+def _try_extract(
+    ctx: _ExtractionContext,
+    img_region: np.ndarray,
+    use_det: bool = False,
+    det_backend: str = "opencv",
+) -> tuple[list[float], float] | None:
+    # Fast-first model order to improve responsiveness
+    for model_name in ctx.preferred_models or _DEFAULT_MODEL_ORDER:
+        r = _extract_embedding_with_model(
+            img_region, model_name, use_detector=use_det, detector_backend=det_backend
+        )
+        if r:
+            return r
+    return None
+
+
+def _extract_simple_resize(img: np.ndarray) -> tuple[list[float], float] | None:
+    """Final fallback: Simple resize and represent"""
     try:
-        from deepface import DeepFace
-        simple_resized = cv2.resize(img, (160, 160), interpolation=cv2.INTER_LINEAR)
-        img_rgb = cv2.cvtColor(simple_resized, cv2.COLOR_BGR2RGB)
-        objs = DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)
-        if objs and len(objs) > 0:
-            emb = objs[0].get("embedding")
-            if emb and len(emb) > 0:
-                return (list(emb), 0.8)
+        emb = _represent_facenet512(img)
+        if emb:
+            return (emb, 0.8)
     except Exception as e:
-        logger.warning("Final fallback (simple resize) failed: %s", str(e))
+        logs.sampled(logger, "extraction_stage_failed", stage="simple_resize", error=str(e))
     return None
 
 
+# เมื่อไม่ระบุโมเดล: mediapipe → face_recognition ก่อน (ลำดับคงที่ เพราะให้ dimension ต่างกัน 512/128)
+_PRELUDE_PIPELINE = ExtractionPipeline(
+    "prelude",
+    [
+        Stage("mediapipe", lambda ctx: _extract_via_mediapipe_py(ctx.image)),
+        Stage("face_recognition", lambda ctx: _extract_via_face_recognition(ctx.image)),
+    ],
+    adaptive=False,
+)
+
+# ถ้ารูปเล็ก/กลาง (มักเป็น face crop จาก frontend MediaPipe) → ใช้ทั้งรูปเลย ไม่ center crop
+# Default order: direct embedding (no detection) → Haar → center crop → DeepFace detectors → simple resize
+# fixed=True: stage ที่ไม่ใช้ detector ได้ crop คงที่ → ห้ามสลับลำดับ ไม่งั้นเวกเตอร์ตอนลงทะเบียน/จดจำจะไม่ตรงกัน
+_FACE_CROP_PIPELINE = ExtractionPipeline(
+    "face_crop",
+    [
+        Stage("direct", lambda ctx: _try_extract(ctx, ctx.img), fixed=True),
+        Stage("haar", lambda ctx: _extract_via_opencv_haar(ctx.img)),
+        Stage("center_crop", lambda ctx: _extract_center_then_represent(ctx.img), fixed=True),
+        Stage("deepface_opencv", lambda ctx: _try_extract(ctx, ctx.img, use_det=True, det_backend="opencv")),
+        Stage("deepface_mediapipe", lambda ctx: _try_extract(ctx, ctx.img, use_det=True, det_backend="mediapipe")),
+        Stage("simple_resize", lambda ctx: _extract_simple_resize(ctx.img), fixed=True),
+    ],
+)
+
+# รูปใหญ่ = เฟรมกล้องเต็ม → ใช้ center crop (ใบหน้าในกรอบ oval กลางจอ) ก่อน แล้วค่อยทั้งรูป
+_FRAME_PIPELINE = ExtractionPipeline(
+    "frame",
+    [
+        Stage("oval_region", lambda ctx: _try_extract(ctx, ctx.face_region), fixed=True),
+        Stage("full_image", lambda ctx: _try_extract(ctx, ctx.img), fixed=True),
+        Stage("haar", lambda ctx: _extract_via_opencv_haar(ctx.img)),
+        Stage("center_crop", lambda ctx: _extract_center_then_represent(ctx.img), fixed=True),
+        Stage("deepface_opencv", lambda ctx: _try_extract(ctx, ctx.img, use_det=True, det_backend="opencv")),
+        Stage("deepface_mediapipe", lambda ctx: _try_extract(ctx, ctx.img, use_det=True, det_backend="mediapipe")),
+        Stage("simple_resize", lambda ctx: _extract_simple_resize(ctx.img), fixed=True),
+    ],
+)
+
+
+def extraction_stats() -> dict:
+    """Per-stage success rate, smoothed latency and current order of every extraction pipeline."""
+    return {p.name: p.stats() for p in (_PRELUDE_PIPELINE, _FACE_CROP_PIPELINE, _FRAME_PIPELINE)}
+
+
+def get_embedding_from_image(
+    image_bgr: np.ndarray,
+    preferred_models: tuple[str, ...] | None = None,
+    deadline_ms: int | None = None,
+) -> tuple[list[float], float] | None:
+    """Run the extraction cascade until a stage yields an embedding or `deadline_ms` runs out.
+
+    deadline_ms: compute budget for this call (None = EXTRACTION_DEADLINE_MS, 0 = unbounded). It is
+    checked between stages, so at least one stage always runs.
+    """
+    # Load the model before any strategy runs (mediapipe/Haar paths call DeepFace.represent too);
+    # a no-op once warm_up() has finished at startup
+    _ensure_embedding_model()
+    budget_ms = EXTRACTION_DEADLINE_MS if deadline_ms is None else deadline_ms
+    deadline = time.perf_counter() + budget_ms / 1000 if budget_ms and budget_ms > 0 else None
+    ctx = _ExtractionContext(image_bgr, preferred_models)
+
+    # เมื่อต้องใช้ dimension เฉพาะ (เช่น 4096 จากข้อมูลเก่า) อย่าใช้ mediapipe/face_recognition ก่อน
+    # เพราะจะได้ 512/128 เสมอ → ต้องลอง preferred_models ก่อน
+    if not preferred_models:
+        r, stage = _PRELUDE_PIPELINE.run(ctx, deadline)
+        if r:
+            metrics.inc("extraction_result_total", pipeline=_PRELUDE_PIPELINE.name, stage=stage)
+            return r
+        if deadline is not None and time.perf_counter() >= deadline:
+            metrics.inc("extraction_deadline_exceeded_total", pipeline="prelude", stage="-")
+            metrics.inc("extraction_result_total", pipeline=_PRELUDE_PIPELINE.name, stage="none")
+            return None
+    h, w = image_bgr.shape[:2]
+    if h < 10 or w < 10:
+        metrics.inc("extraction_result_total", pipeline="-", stage="none")
+        return None
+    ctx.img = _downscale_frame(image_bgr)
+    if _is_likely_face_crop(ctx.img):
+        pipeline = _FACE_CROP_PIPELINE
+    else:
+        ctx.face_region = _oval_region(ctx.img)
+        pipeline = _FRAME_PIPELINE
+    # Only reorder for the default model order: with pinned models the Facenet512-only stages
+    # (Haar, center crop, resize) must stay behind the stages that honour preferred_models
+    result, stage = pipeline.run(ctx, deadline, adaptive=not preferred_models)
+    metrics.inc("extraction_result_total", pipeline=pipeline.name, stage=stage or "none")
+    return result
+
+
 def get_embedding_from_base64_debug(
     image_base64: str,
     preferred_models: tuple[str, ...] | None = None,
@@ -429,38 +570,279 @@ def get_embedding_from_base64_debug(
     return {"ok": False, "errors": errors, "image_size": raw_len, "image_dims": dims}
 
 
+_embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_BYTES, EMBEDDING_CACHE_TTL_SECONDS)
+
+
+def _decode_base64_bytes(image_base64: str | bytes | memoryview) -> bytes | None:
+    """Encoded image bytes of a (data-URL or bare) base64 string; None when empty or too small.
+
+    Also accepts the base64 text as bytes/memoryview (e.g. straight from a request body), which is
+    decoded in place: the data-URL prefix is skipped by slicing the view, not by copying the text.
+    """
+    if isinstance(image_base64, str):
+        s: str | memoryview = image_base64.strip()
+        if "," in s and s.startswith("data:"):
+            s = s.split(",", 1)[1]
+    elif isinstance(image_base64, (bytes, bytearray, memoryview)):
+        s = memoryview(image_base64)
+        if s[:5] == b"data:":
+            comma = bytes(s[:256]).find(b",")
+            if comma >= 0:
+                s = s[comma + 1:]
+    else:
+        s = ""
+    if not len(s):
+        logger.warning("get_embedding: empty or invalid input")
+        return None
+    raw = base64.b64decode(s, validate=False)
+    if len(raw) < 100:
+        logger.warning("get_embedding: base64 too small (%d bytes)", len(raw))
+        return None
+    return raw
+
+
+def _decode_base64_image(image_base64: str, max_side: int = 960) -> np.ndarray | None:
+    """Decode a (data-URL or bare) base64 image into a BGR array; None when it is not a usable image."""
+    raw = _decode_base64_bytes(image_base64)
+    return _decode_image_bytes(raw, max_side) if raw is not None else None
+
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, arithmetic); DHT/JPG/DAC are excluded
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def _jpeg_size(raw: bytes) -> tuple[int, int] | None:
+    """(width, height) from a JPEG's SOF header without decoding it; None for other formats."""
+    if raw[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(raw)
+    while i + 4 <= n:
+        if raw[i] != 0xFF:
+            return None
+        marker = raw[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # markers without a length
+            i += 2
+            continue
+        length = int.from_bytes(raw[i + 2:i + 4], "big")
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            height = int.from_bytes(raw[i + 5:i + 7], "big")
+            width = int.from_bytes(raw[i + 7:i + 9], "big")
+            return (width, height) if width and height else None
+        if marker == 0xDA:  # start of scan before any SOF
+            return None
+        i += 2 + length
+    return None
+
+
+def _decode_image_bytes(raw: bytes, max_side: int = 960) -> np.ndarray | None:
+    """Decode an encoded image into BGR. JPEGs whose longest side is at least 2x `max_side` are decoded
+    at 1/2, 1/4 or 1/8 resolution by libjpeg (IDCT scaling), never below `max_side`, since the cascade
+    would shrink them to `max_side` anyway. Other formats and smaller JPEGs decode at full size."""
+    arr = np.frombuffer(raw, dtype=np.uint8)
+    flag, factor = cv2.IMREAD_COLOR, 1
+    size = _jpeg_size(raw) if max_side > 0 else None
+    if size is not None:
+        for f, reduced in _REDUCED_DECODE_FLAGS:
+            if max(size) // f >= max_side:
+                flag, factor = reduced, f
+                break
+    with metrics.timer("image_decode_seconds", scale=f"1/{factor}"):
+        img = cv2.imdecode(arr, flag)
+    if img is None:
+        logger.warning("get_embedding: cv2.imdecode failed")
+        return None
+    metrics.inc("image_decode_total", scale=f"1/{factor}")
+    return img
+
+
 def get_embedding_from_base64(
-    image_base64: str,
+    image_base64: str | bytes | memoryview,
     preferred_models: tuple[str, ...] | None = None,
+    deadline_ms: int | None = None,
 ) -> tuple[list[float], float] | None:
-    """Decode base64 image and extract embedding."""
-    if not image_base64 or not isinstance(image_base64, str):
-        logger.warning("get_embedding: empty or invalid input")
+    """Decode base64 image and extract embedding (see `get_embedding_from_image` for deadline_ms)."""
+    try:
+        raw = _decode_base64_bytes(image_base64)
+    except Exception as e:
+        logger.exception("get_embedding: %s", str(e))
+        return None
+    if raw is None:
         return None
+    return get_embedding_from_bytes(raw, preferred_models=preferred_models, deadline_ms=deadline_ms)
+
+
+def get_embedding_from_bytes(
+    raw: bytes,
+    preferred_models: tuple[str, ...] | None = None,
+    deadline_ms: int | None = None,
+) -> tuple[list[float], float] | None:
+    """Extract an embedding from encoded image bytes (JPEG/PNG upload body or decoded base64).
+
+    Results are cached by a hash of the image bytes, so a client retry of the same frame is not re-extracted.
+    """
     try:
-        s = image_base64.strip()
-        if "," in s and s.startswith("data:"):
-            s = s.split(",", 1)[1]
-        raw = base64.b64decode(s, validate=False)
-        if len(raw) < 100:
-            logger.warning("get_embedding: base64 too small (%d bytes)", len(raw))
-            return None
-        arr = np.frombuffer(raw, dtype=np.uint8)
-        img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-        if img is None:
-            logger.warning("get_embedding: cv2.imdecode failed")
-            return None
-        h, w = img.shape[:2]
-        # Reduced logging for performance - only log failures
-        result = get_embedding_from_image(img, preferred_models=preferred_models)
-        if not result:
-            logger.warning("get_embedding: all extraction attempts failed for %dx%d", w, h)
-        return result
+        def extract() -> tuple[list[float], float] | None:
+            img = _decode_image_bytes(raw)
+            if img is None:
+                return None
+            h, w = img.shape[:2]
+            # Reduced logging for performance - only log failures
+            result = get_embedding_from_image(img, preferred_models=preferred_models, deadline_ms=deadline_ms)
+            if not result:
+                logs.sampled(logger, "extraction_failed", width=w, height=h)
+            return result
+
+        # preferred_models picks the model (and so the dim), so it is part of the key
+        return _embedding_cache.get_or_compute(content_key(raw, preferred_models), extract)
     except Exception as e:
         logger.exception("get_embedding: %s", str(e))
         return None
 
 
+def embed_faces_batch(faces_bgr: list[np.ndarray]) -> np.ndarray:
+    """Facenet512 embeddings for many face crops in one forward pass of the configured engine → float32 (N, 512)."""
+    batch = np.stack([_model_input(f) for f in faces_bgr])
+    return get_engine().embed_batch(batch)
+
+
+def _locate_face_crop(img_bgr: np.ndarray) -> tuple[np.ndarray, float] | None:
+    """First face crop the extraction cascade would embed with Facenet512 (no model call).
+
+    MediaPipe box when available, else the whole image for face crops or the oval region for camera frames.
+    """
+    try:
+        boxes = _mediapipe_face_boxes(img_bgr)
+        if boxes:
+            x1, y1, x2, y2 = boxes[0]
+            crop = img_bgr[y1:y2, x1:x2]
+            if crop.size >= 100:
+                return crop, 1.0
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.warning("_locate_face_crop mediapipe failed: %s", str(e))
+    h, w = img_bgr.shape[:2]
+    if h < 10 or w < 10:
+        return None
+    img = _downscale_frame(img_bgr)
+    region = img if _is_likely_face_crop(img) else _oval_region(img)
+    if min(region.shape[:2]) < 10:
+        return None
+    return region, 0.0
+
+
+def get_embeddings_from_base64_batch(images_base64: list[str]) -> list[tuple[list[float], float] | None]:
+    """Decode several images, crop one face per image and embed all crops in a single batched model call.
+
+    Each crop is embedded from the same model input the cascade's Facenet512 stages build (`_model_input`), so
+    the vectors are comparable with stored enrollments. Images whose crop cannot be located, or the whole batch
+    if the batched call fails, fall back to the regular per-image cascade (`get_embedding_from_image`).
+    """
+    results: list[tuple[list[float], float] | None] = [None] * len(images_base64)
+    images: list[np.ndarray | None] = []
+    for image_base64 in images_base64:
+        try:
+            images.append(_decode_base64_image(image_base64))
+        except Exception as e:
+            logger.warning("get_embeddings_batch: decode failed: %s", str(e))
+            images.append(None)
+
+    crops: list[np.ndarray] = []
+    crop_owner: list[int] = []
+    crop_conf: list[float] = []
+    fallback: list[int] = []
+    for i, img in enumerate(images):
+        if img is None:
+            continue
+        located = _locate_face_crop(img)
+        if located is None:
+            fallback.append(i)
+            continue
+        crops.append(located[0])
+        crop_conf.append(located[1])
+        crop_owner.append(i)
+
+    if crops:
+        try:
+            embs = embed_faces_batch(crops)
+            for i, emb, conf in zip(crop_owner, embs, crop_conf):
+                results[i] = (emb.tolist(), conf)
+        except Exception as e:
+            logger.warning("embed_faces_batch failed, falling back to per-image extraction: %s", str(e))
+            fallback.extend(crop_owner)
+
+    for i in sorted(fallback):
+        try:
+            results[i] = get_embedding_from_image(images[i])
+        except Exception as e:
+            logger.exception("get_embeddings_batch: %s", str(e))
+    return results
+
+
+def detect_face_boxes(img_bgr: np.ndarray) -> list[tuple[int, int, int, int]]:
+    """Every face in the image as padded (x1, y1, x2, y2) boxes: MediaPipe full-range, else Haar."""
+    try:
+        return _mediapipe_face_boxes(img_bgr)
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.warning("detect_face_boxes mediapipe failed: %s", str(e))
+    try:
+        return _haar_face_boxes(img_bgr)
+    except Exception as e:
+        logger.warning("detect_face_boxes haar failed: %s", str(e))
+    return []
+
+
+def get_face_embeddings_from_image(
+    image_bgr: np.ndarray,
+    max_side: int = GROUP_PHOTO_MAX_SIDE,
+) -> list[tuple[list[float], tuple[int, int, int, int]]]:
+    """Embed every face of a group photo with one batched model call.
+
+    Returns [(embedding, (x, y, w, h)), ...] with boxes in the coordinates of `image_bgr`.
+    Detection runs on a copy shrunk to `max_side` (kept larger than the single-face 960 px so small
+    faces at the back of a classroom survive).
+    """
+    h, w = image_bgr.shape[:2]
+    if h < 10 or w < 10:
+        return []
+    img = _downscale_frame(image_bgr, max_side=max_side)
+    scale = w / img.shape[1]
+    crops: list[np.ndarray] = []
+    boxes: list[tuple[int, int, int, int]] = []
+    for x1, y1, x2, y2 in detect_face_boxes(img):
+        crop = img[y1:y2, x1:x2]
+        if crop.size < 100 or min(crop.shape[:2]) < 10:
+            continue
+        crops.append(crop)
+        boxes.append((
+            int(x1 * scale), int(y1 * scale), int((x2 - x1) * scale), int((y2 - y1) * scale)
+        ))
+    if not crops:
+        return []
+    embs = embed_faces_batch(crops)
+    return [(emb.tolist(), box) for emb, box in zip(embs, boxes)]
+
+
+def get_face_embeddings_from_base64(image_base64: str) -> list[tuple[list[float], tuple[int, int, int, int]]]:
+    """Decode a base64 group photo and embed every face in it (empty list on failure)."""
+    try:
+        img = _decode_base64_image(image_base64, max_side=GROUP_PHOTO_MAX_SIDE)
+        if img is None:
+            return []
+        return get_face_embeddings_from_image(img)
+    except Exception as e:
+        logger.exception("get_face_embeddings: %s", str(e))
+        return []
+
+
 def cosine_similarity(a: list[float], b: list[float]) -> float:
     """Cosine similarity between two vectors (higher=more similar)."""
     a_arr = np.array(a, dtype=np.float32)
@@ -0,0 +1,86 @@
+"""Dynamic micro-batching: concurrent single-item requests share one batched model call.
+
+Callers block in `submit()`. A worker thread takes the first queued item, keeps collecting for at most
+`max_wait_ms` or until `max_batch_size` items are waiting, runs `run_batch` once on the stacked items and
+hands each caller its row. Under light load a request waits at most `max_wait_ms`; under load the model
+sees batches instead of a stream of single images, which is much cheaper per image on CPU.
+"""
+from __future__ import annotations
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+import numpy as np
+
+from core import metrics
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        name: str,
+        run_batch: Callable[[np.ndarray], np.ndarray],
+        *,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        max_queue: int = 256,
+    ):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        # Bounded: when the model falls behind, submit() blocks instead of queueing without limit
+        self._queue: queue.Queue[tuple[np.ndarray, Future, float]] = queue.Queue(maxsize=max(1, max_queue))
+        self._worker: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, item: np.ndarray, timeout: float | None = None) -> np.ndarray:
+        """Queue one item (e.g. a (160, 160, 3) crop) and block until its output row is ready."""
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        metrics.set_gauge("embed_batch_queue_depth", self._queue.qsize(), batcher=self.name)
+        return future.result(timeout=timeout)
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> list[tuple[np.ndarray, Future, float]]:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            metrics.set_gauge("embed_batch_queue_depth", self._queue.qsize(), batcher=self.name)
+            metrics.inc("embed_batches_total", batcher=self.name)
+            metrics.inc("embed_batch_items_total", len(batch), batcher=self.name)
+            metrics.inc("embed_batch_wait_seconds_total", sum(started - t for _, _, t in batch), batcher=self.name)
+            metrics.set_gauge("embed_batch_last_size", len(batch), batcher=self.name)
+            try:
+                out = self.run_batch(np.stack([item for item, _, _ in batch]))
+                if len(out) != len(batch):
+                    # zip() would leave the callers past the short output waiting forever
+                    raise RuntimeError(f"{self.name}: run_batch returned {len(out)} rows for {len(batch)} items")
+            except BaseException as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            metrics.inc("embed_batch_run_seconds_total", time.perf_counter() - started, batcher=self.name)
+            for row, (_, future, _) in zip(out, batch):
+                future.set_result(row)
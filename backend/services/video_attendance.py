@@ -0,0 +1,208 @@
+"""Attendance from a short classroom video: decode → sample → detect → track → embed, as generators.
+
+Every stage pulls one frame at a time from the previous one, so memory stays bounded by a single frame,
+the open tracks and one embedding batch, however long the video is. Frames are sampled at
+VIDEO_SAMPLE_FPS (skipped frames are only grabbed, never converted), faces are followed across sampled
+frames by an IoU tracker, and each track is embedded a few times (VIDEO_EMBEDS_PER_TRACK) instead of on
+every frame. The result is one averaged embedding per track with the time it was first seen; matching
+those against a class gallery is left to the caller.
+
+Decoding, detection and tracking are light per sampled frame but last as long as the video; the caller
+passes `embed` so only the batched model calls need to go to the inference pool (see the route).
+"""
+from __future__ import annotations
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+
+import cv2
+import numpy as np
+
+from config import GROUP_PHOTO_MAX_SIDE, VIDEO_EMBEDS_PER_TRACK, VIDEO_MAX_SECONDS, VIDEO_SAMPLE_FPS
+from core import metrics
+from services.face_service import _downscale_frame, detect_face_boxes, embed_faces_batch
+
+logger = logging.getLogger("face_service")
+
+# Sampled frames between two embeddings of the same track (spreads them over pose changes)
+_EMBED_EVERY_HITS = 3
+_EMBED_BATCH_SIZE = 16
+
+
+@dataclass
+class Track:
+    track_id: int
+    box: tuple[int, int, int, int]  # (x1, y1, x2, y2) in the detection frame
+    first_seen: float  # seconds from the start of the video
+    last_seen: float
+    hits: int = 1
+    missed: int = 0
+    embeddings: int = 0
+    _sum: np.ndarray | None = field(default=None, repr=False)
+
+    def add_embedding(self, embedding: np.ndarray) -> None:
+        norm = float(np.linalg.norm(embedding))
+        if norm == 0:
+            return
+        unit = embedding / norm
+        self._sum = unit if self._sum is None else self._sum + unit
+        self.embeddings += 1
+
+    @property
+    def embedding(self) -> np.ndarray | None:
+        """Mean of the track's normalized embeddings (None when it was never embedded)."""
+        return None if self._sum is None else self._sum / self.embeddings
+
+    def wants_embedding(self) -> bool:
+        return self.embeddings < VIDEO_EMBEDS_PER_TRACK and (self.hits - 1) % _EMBED_EVERY_HITS == 0
+
+
+def iou(a: tuple[int, int, int, int], b: tuple[int, int, int, int]) -> float:
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+class IoUTracker:
+    """Greedy IoU association of per-frame detections to tracks; a track ends after `max_missed` misses."""
+
+    def __init__(self, iou_threshold: float = 0.3, max_missed: int = 5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.active: list[Track] = []
+        self._next_id = 0
+
+    def update(self, boxes: list[tuple[int, int, int, int]], t: float) -> tuple[list[tuple[Track, int]], list[Track]]:
+        """Associate one frame's boxes. Returns ([(track, box index), ...], tracks that just ended)."""
+        pairs = sorted(
+            ((iou(track.box, box), ti, bi) for ti, track in enumerate(self.active) for bi, box in enumerate(boxes)),
+            reverse=True,
+        )
+        used_tracks: set[int] = set()
+        used_boxes: set[int] = set()
+        matched: list[tuple[Track, int]] = []
+        for overlap, ti, bi in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if ti in used_tracks or bi in used_boxes:
+                continue
+            track = self.active[ti]
+            track.box, track.last_seen, track.missed = boxes[bi], t, 0
+            track.hits += 1
+            used_tracks.add(ti)
+            used_boxes.add(bi)
+            matched.append((track, bi))
+        ended: list[Track] = []
+        still_active: list[Track] = []
+        for ti, track in enumerate(self.active):
+            if ti not in used_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    ended.append(track)
+                    continue
+            still_active.append(track)
+        for bi, box in enumerate(boxes):
+            if bi not in used_boxes:
+                track = Track(self._next_id, box, t, t)
+                self._next_id += 1
+                still_active.append(track)
+                matched.append((track, bi))
+        self.active = still_active
+        return matched, ended
+
+
+def decode(path: str, sample_fps: float = VIDEO_SAMPLE_FPS, max_seconds: float = VIDEO_MAX_SECONDS) -> Iterator[tuple[float, np.ndarray]]:
+    """(timestamp seconds, BGR frame) for frames sampled at `sample_fps`; the rest are grabbed, not decoded to BGR."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("cannot open video")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        fps = fps if 1.0 <= fps <= 240.0 else 30.0
+        step = max(1, round(fps / sample_fps)) if sample_fps > 0 else 1
+        index = 0
+        while capture.grab():
+            t = index / fps
+            if t > max_seconds:
+                break
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if ok and frame is not None:
+                    yield t, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def detect(frames: Iterator[tuple[float, np.ndarray]], max_side: int = GROUP_PHOTO_MAX_SIDE):
+    """(t, downscaled frame, face boxes) per sampled frame."""
+    for t, frame in frames:
+        img = _downscale_frame(frame, max_side=max_side)
+        yield t, img, detect_face_boxes(img)
+
+
+def track(detections, tracker: IoUTracker):
+    """(t, track, face crop) for each tracked face that still needs an embedding; ended tracks are dropped
+    from the tracker as they finish (their state lives on in the Track objects)."""
+    for t, img, boxes in detections:
+        matched, _ = tracker.update(boxes, t)
+        for face, bi in matched:
+            if not face.wants_embedding():
+                continue
+            x1, y1, x2, y2 = boxes[bi]
+            crop = img[y1:y2, x1:x2]
+            if crop.size < 100 or min(crop.shape[:2]) < 10:
+                continue
+            # Counted as taken now so the same track is not queued twice before the batch runs
+            face.embeddings += 1
+            yield t, face, crop.copy()
+
+
+@dataclass
+class VideoResult:
+    tracks: list[Track]
+    frames_sampled: int
+    duration_seconds: float
+
+
+def process_video(path: str, embed: Callable[[list[np.ndarray]], np.ndarray] = embed_faces_batch) -> VideoResult:
+    """Run the pipeline over a video file and return every track that got at least one embedding.
+
+    `embed` turns a list of face crops into (N, 512) embeddings (default: `embed_faces_batch` in this thread).
+    """
+    tracker = IoUTracker()
+    tracks: dict[int, Track] = {}
+    frames_sampled = 0
+    duration = 0.0
+
+    def counted(frames):
+        nonlocal frames_sampled, duration
+        for t, frame in frames:
+            frames_sampled += 1
+            duration = t
+            yield t, frame
+
+    batch: list[tuple[Track, np.ndarray]] = []
+
+    def flush() -> None:
+        embeddings = embed([crop for _, crop in batch])
+        for (face, _), embedding in zip(batch, embeddings):
+            face.embeddings -= 1  # reserved in track(); add_embedding counts it for real
+            face.add_embedding(embedding)
+        batch.clear()
+
+    for _, face, crop in track(detect(counted(decode(path))), tracker):
+        tracks[face.track_id] = face
+        batch.append((face, crop))
+        if len(batch) >= _EMBED_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    embedded = [t for t in tracks.values() if t.embedding is not None]
+    metrics.inc("video_frames_sampled_total", frames_sampled)
+    metrics.inc("video_tracks_total", len(embedded))
+    logger.info("video: %d sampled frames, %d tracks over %.1fs", frames_sampled, len(embedded), duration)
+    return VideoResult(embedded, frames_sampled, duration)
@@ -0,0 +1,162 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+
+from repositories import ann_index
+from repositories.ann_index import IVFIndex
+from repositories.gallery_index import normalize_rows
+
+
+def _rows(rng, n: int, dim: int = 64) -> np.ndarray:
+    return normalize_rows(rng.standard_normal((n, dim)))
+
+
+def _brute_force(items: dict, query: np.ndarray, min_embeddings: int | None = None) -> list[tuple[str, str, float]]:
+    best: dict[str, tuple[str, str, float]] = {}
+    for (classroom_id, student_id), rows in items.items():
+        if min_embeddings is not None and rows.shape[0] < min_embeddings:
+            continue
+        score = float(np.max(rows @ query))
+        if student_id not in best or score > best[student_id][2]:
+            best[student_id] = (student_id, classroom_id, score)
+    return sorted(best.values(), key=lambda hit: -hit[2])
+
+
+@pytest.fixture
+def small_min_rows(monkeypatch):
+    # Train centroids on test-sized indexes instead of scanning them exactly
+    monkeypatch.setattr(ann_index, "ANN_MIN_ROWS", 64)
+
+
+@pytest.mark.parametrize("trained", [False, True])
+def test_add_remove_search_match_brute_force(monkeypatch, trained):
+    if trained:
+        monkeypatch.setattr(ann_index, "ANN_MIN_ROWS", 64)
+    rng = np.random.default_rng(0)
+    items = {(f"c{i % 3}", f"s{i}"): _rows(rng, 1 + i % 4) for i in range(60)}
+    index = IVFIndex.build(64, [(c, s, rows) for (c, s), rows in items.items()])
+    assert (index.centroids is not None) == trained
+
+    # Replace, add and remove students in place
+    items[("c0", "s0")] = _rows(rng, 2)
+    items[("c1", "new")] = _rows(rng, 3)
+    for key in (("c0", "s0"), ("c1", "new")):
+        index.set_student(*key, items[key])
+    index.set_student("c1", "s1", None)
+    del items[("c1", "s1")]
+    assert len(index) == sum(rows.shape[0] for rows in items.values())
+
+    nprobe = index.centroids.shape[0] if trained else ann_index.ANN_NPROBE
+    for query in _rows(rng, 10):
+        hits = index.search(query, k=3, nprobe=nprobe)
+        expected = _brute_force(items, query)[:3]
+        assert [h[:2] for h in hits] == [e[:2] for e in expected]
+        np.testing.assert_allclose([h[2] for h in hits], [e[2] for e in expected], atol=1e-5)
+
+
+def test_search_skips_students_below_min_embeddings():
+    rng = np.random.default_rng(1)
+    items = {("c0", "few"): _rows(rng, 2), ("c0", "enough"): _rows(rng, 5)}
+    index = IVFIndex.build(64, [(c, s, rows) for (c, s), rows in items.items()])
+    query = items[("c0", "few")][0]
+    assert index.search(query, k=1)[0][0] == "few"
+    assert [h[0] for h in index.search(query, k=2, min_embeddings=5)] == ["enough"]
+
+
+def test_compacted_drops_dead_rows_and_retrains(small_min_rows):
+    rng = np.random.default_rng(2)
+    index = IVFIndex.build(64, [("c", f"s{i}", _rows(rng, 2)) for i in range(10)])
+    assert index.centroids is None
+    for i in range(10, 60):
+        index.set_student("c", f"s{i}", _rows(rng, 2))
+    assert index.needs_compaction()
+    compacted = index.compacted()
+    assert compacted.centroids is not None and compacted.dead_rows == 0
+    assert len(compacted) == len(index) == 120
+    assert not compacted.needs_compaction()
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ann_index, "ANN_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(ann_index, "_request_compaction", lambda user_id, dim: None)
+    ann_index._indexes.clear()
+    yield tmp_path
+    ann_index._indexes.clear()
+
+
+def _other_worker():
+    """Forget this process's loaded indexes, as if the next call ran in another worker."""
+    ann_index._indexes.clear()
+
+
+def test_updates_append_to_the_delta_without_rewriting_the_snapshot(index_dir):
+    rng = np.random.default_rng(3)
+    stored = {("c0", "s0"): _rows(rng, 2), ("c1", "s1"): _rows(rng, 2)}
+    index = ann_index.get_or_build("u", 64, lambda _user: [(c, s, rows.tolist()) for (c, s), rows in stored.items()])
+    assert len(index) == 4
+    snapshot = ann_index._path("u", 64)
+    signature = ann_index._signature(snapshot)
+
+    new_rows = _rows(rng, 3)
+    ann_index.set_student("u", "c1", "s2", new_rows.tolist())
+    ann_index.set_student("u", "c0", "s0", [])
+    assert ann_index._signature(snapshot) == signature
+    with open(ann_index._delta_path(snapshot), "rb") as f:
+        assert len(f.read().splitlines()) == 3  # header + two updates
+    assert len(index) == 5  # patched in place
+
+    _other_worker()
+    replayed = ann_index.get_or_build("u", 64, lambda _user: pytest.fail("must not rebuild"))
+    assert replayed.search(new_rows[0], k=1)[0][:2] == ("s2", "c1")
+    assert replayed.student_count("c0", "s0") == 0
+
+    ann_index.compact("u", 64)
+    with open(ann_index._delta_path(snapshot), "rb") as f:
+        assert f.read().splitlines() == [b'{"generation": 1}']
+    _other_worker()
+    compacted = ann_index.get_or_build("u", 64, lambda _user: pytest.fail("must not rebuild"))
+    assert len(compacted) == 5 and compacted.dead_rows == 0
+
+
+def test_torn_delta_line_is_dropped(index_dir):
+    rng = np.random.default_rng(4)
+    ann_index.get_or_build("u", 64, lambda _user: [("c", "s0", _rows(rng, 1).tolist())])
+    ann_index.set_student("u", "c", "s1", _rows(rng, 1).tolist())
+    with open(ann_index._delta_path(ann_index._path("u", 64)), "ab") as f:
+        f.write(b'{"c":"c","s":"s2","ro')
+    _other_worker()
+    index = ann_index.get_or_build("u", 64, lambda _user: pytest.fail("must not rebuild"))
+    assert (index.student_count("c", "s1"), index.student_count("c", "s2")) == (1, 0)
+
+
+def test_invalidate_removes_snapshot_and_delta(index_dir):
+    rng = np.random.default_rng(5)
+    ann_index.get_or_build("u", 64, lambda _user: [("c", "s0", _rows(rng, 1).tolist())])
+    ann_index.invalidate("u")
+    assert os.listdir(index_dir) == [f for f in os.listdir(index_dir) if f.endswith(".lock")]
+
+
+def test_identify_requires_min_enrollments(monkeypatch):
+    from api.routes import face
+    from config import MIN_ENROLLMENTS_FOR_ATTENDANCE
+    from schemas.face import IdentifyRequest
+
+    rng = np.random.default_rng(6)
+    enrolled = _rows(rng, MIN_ENROLLMENTS_FOR_ATTENDANCE, 512)
+    partial = _rows(rng, MIN_ENROLLMENTS_FOR_ATTENDANCE - 1, 512)
+    index = IVFIndex.build(512, [("c1", "enrolled", enrolled), ("c2", "partial", partial)])
+
+    async def embed(_fn, image_base64, **_kwargs):
+        return {"enrolled": enrolled[0], "partial": partial[0]}[image_base64].tolist(), 1.0
+
+    monkeypatch.setattr(face, "run_inference", embed)
+    monkeypatch.setattr(face, "get_user_index", lambda _user_id, _dim: index)
+
+    matched = asyncio.run(face.identify(IdentifyRequest(user_id="u", image_base64="enrolled")))
+    assert (matched.student_id, matched.classroom_id, matched.matched) == ("enrolled", "c1", True)
+    # Too few images to take attendance with, exactly like /recognize
+    unmatched = asyncio.run(face.identify(IdentifyRequest(user_id="u", image_base64="partial")))
+    assert unmatched.student_id is None and not unmatched.matched
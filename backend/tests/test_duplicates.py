@@ -0,0 +1,39 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from api.routes import face
+from repositories.gallery_index import ClassGallery
+from services.face_service import embedding_similarity, embedding_to_similarity
+
+
+def _check_duplicate_baseline(rows_by_student: dict, embedding: list[float], exclude_student_id: str) -> dict:
+    """The pre-index loop: best display similarity per other student, from the raw stored vectors."""
+    dim = len(embedding)
+    return {
+        sid: max(embedding_to_similarity(embedding_similarity(embedding, e), dim) for e in embs)
+        for sid, embs in rows_by_student.items()
+        if sid != exclude_student_id
+    }
+
+
+@pytest.mark.parametrize("dim, scale", [(128, 0.05), (512, 1.0)])
+def test_duplicates_match_the_baseline_scores(monkeypatch, dim, scale):
+    rng = np.random.default_rng(dim)
+    # face_recognition (128-d) vectors are not unit length, so normalizing them would change the distance
+    rows = {f"s{i}": (rng.standard_normal((2, dim)) * scale).tolist() for i in range(12)}
+    query = (np.asarray(rows["s3"][1]) + rng.standard_normal(dim) * scale * 0.002).tolist()
+    rows["s7"][0] = (np.asarray(query) + rng.standard_normal(dim) * scale * 0.003).tolist()
+
+    async def stored(_user_id, _class_id, student_ids):
+        return {sid: rows[sid] for sid in student_ids if sid in rows}
+
+    monkeypatch.setattr(face, "aget_embeddings_for_students", stored)
+    hits = asyncio.run(face._find_duplicates("u", "c", ClassGallery(rows), query, "s0", top_k=5))
+
+    expected = _check_duplicate_baseline(rows, query, "s0")
+    assert [sid for sid, _ in hits] == sorted((s for s, v in expected.items() if v >= 0.95), key=lambda s: -expected[s])
+    assert {sid for sid, _ in hits} == {"s3", "s7"}
+    for sid, similarity in hits:
+        assert similarity == pytest.approx(expected[sid], abs=1e-5)
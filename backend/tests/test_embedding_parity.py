@@ -0,0 +1,83 @@
+"""The engine/batched Facenet512 path must produce the embeddings DeepFace.represent produced for the same crop.
+
+Every enrollment already stored was computed by `DeepFace.represent(img_rgb, enforce_detection=False,
+align=False)`; a query embedded any other way would be compared against a different input distribution.
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+
+deepface_detection = pytest.importorskip("deepface.modules.detection")
+deepface_preprocessing = pytest.importorskip("deepface.modules.preprocessing")
+
+from services import face_service  # noqa: E402
+
+
+def _crops() -> list[np.ndarray]:
+    rng = np.random.default_rng(0)
+    face = synthetic.face_image(320, 240)
+    return [
+        face,  # Haar finds the drawn face → DeepFace crops it
+        face[40:200, 20:300],  # wide crop → padded resize
+        rng.integers(0, 255, (200, 120, 3), dtype=np.uint8),  # no face → whole image
+        face[100:108, 100:140],  # below _prepare_for_embedding's minimum size
+    ]
+
+
+def _deepface_input(face_bgr: np.ndarray) -> np.ndarray:
+    img_rgb = cv2.cvtColor(face_service._prepare_for_embedding(face_bgr), cv2.COLOR_BGR2RGB)
+    objs = deepface_detection.extract_faces(
+        img_path=img_rgb, detector_backend="opencv", grayscale=False, enforce_detection=False, align=False
+    )
+    return deepface_preprocessing.resize_image(img=objs[0]["face"][:, :, ::-1], target_size=(160, 160))[0]
+
+
+@pytest.mark.parametrize("index", range(len(_crops())))
+def test_model_input_matches_deepface_preprocessing(index):
+    crop = _crops()[index]
+    np.testing.assert_allclose(face_service._model_input(crop), _deepface_input(crop), rtol=0, atol=1e-6)
+
+
+def _facenet512_weights_available() -> bool:
+    from deepface.commons import folder_utils
+    return os.path.isfile(os.path.join(folder_utils.get_deepface_home(), ".deepface", "weights", "facenet512_weights.h5"))
+
+
+def _cosine(a, b) -> float:
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def _represent(face_bgr: np.ndarray) -> list[float]:
+    from deepface import DeepFace
+    img_rgb = cv2.cvtColor(face_service._prepare_for_embedding(face_bgr), cv2.COLOR_BGR2RGB)
+    return DeepFace.represent(img_rgb, model_name="Facenet512", enforce_detection=False, align=False)[0]["embedding"]
+
+
+@pytest.mark.skipif(not _facenet512_weights_available(), reason="Facenet512 weights not downloaded")
+def test_embed_faces_batch_matches_represent():
+    crops = _crops()[:3]
+    batch = face_service.embed_faces_batch(crops)
+    for crop, emb in zip(crops, batch):
+        assert _cosine(emb, _represent(crop)) > 0.9999
+
+
+@pytest.mark.skipif(not _facenet512_weights_available(), reason="Facenet512 weights not downloaded")
+def test_micro_batched_embedding_matches_represent(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from services.micro_batcher import MicroBatcher
+
+    batcher = MicroBatcher(
+        "parity", lambda batch: face_service.get_engine().embed_batch(batch), max_batch_size=8, max_wait_ms=50
+    )
+    monkeypatch.setattr(face_service, "_embedding_batcher", batcher)
+    monkeypatch.setattr(face_service, "_batching_enabled", lambda: True)
+    crops = _crops()[:3]
+    with ThreadPoolExecutor(len(crops)) as pool:
+        embeddings = list(pool.map(face_service._represent_facenet512, crops))
+    for crop, emb in zip(crops, embeddings):
+        assert _cosine(emb, _represent(crop)) > 0.9999
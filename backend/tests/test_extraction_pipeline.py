@@ -0,0 +1,135 @@
+import time
+
+from services.extraction_pipeline import ExtractionPipeline, Stage
+
+
+class _Clock:
+    """Stage latencies without sleeping: each stage advances a fake time.perf_counter()."""
+
+    def __init__(self, monkeypatch):
+        self.now = 0.0
+        monkeypatch.setattr(time, "perf_counter", lambda: self.now)
+
+    def stage(self, name: str, seconds: float, succeeds: bool, calls: list[str], fixed: bool = False) -> Stage:
+        def run(_ctx):
+            calls.append(name)
+            self.now += seconds
+            return name if succeeds else None
+        return Stage(name, run, fixed)
+
+
+def test_cold_pipeline_runs_default_order(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [clock.stage("a", 0.1, False, calls), clock.stage("b", 0.1, True, calls)],
+        explore_every=0,
+    )
+    assert pipeline.run(None) == ("b", "b")
+    assert calls == ["a", "b"]
+
+
+def test_reorders_cheapest_likely_winner_first(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [clock.stage("slow_miss", 0.5, False, calls), clock.stage("fast_hit", 0.01, True, calls)],
+        min_samples=5,
+        reorder_every=10,
+        explore_every=0,
+    )
+    for _ in range(10):
+        pipeline.run(None)
+    assert pipeline.stats()["order"] == ["fast_hit", "slow_miss"]
+    calls.clear()
+    pipeline.run(None)
+    assert calls == ["fast_hit"]
+
+
+def test_explores_stages_behind_an_always_successful_stage(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [clock.stage("direct", 0.5, True, calls), clock.stage("haar", 0.01, True, calls)],
+        min_samples=3,
+        reorder_every=10,
+        explore_every=2,
+    )
+    for _ in range(10):
+        pipeline.run(None)
+    stats = pipeline.stats()
+    assert stats["stages"]["haar"]["attempts"] >= 3
+    # Once measured, the cheaper stage wins the front on the next reorder
+    assert stats["order"] == ["haar", "direct"]
+
+
+def test_fixed_stage_keeps_winning_under_reorder_and_explore(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [
+            clock.stage("direct", 0.5, True, calls, fixed=True),
+            clock.stage("haar", 0.01, True, calls),
+            clock.stage("simple_resize", 0.01, True, calls, fixed=True),
+        ],
+        min_samples=1,
+        reorder_every=2,
+        explore_every=1,
+    )
+    # The crop that gets embedded must not depend on how much traffic the pipeline has seen
+    for _ in range(50):
+        assert pipeline.run(None) == ("direct", "direct")
+    assert set(calls) == {"direct"}
+    assert pipeline.stats()["order"] == ["direct", "haar", "simple_resize"]
+
+
+def test_reorders_only_between_fixed_stages(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [
+            clock.stage("haar", 0.5, False, calls),
+            clock.stage("deepface", 0.01, True, calls),
+            clock.stage("center_crop", 0.01, True, calls, fixed=True),
+            clock.stage("mediapipe", 0.5, False, calls),
+            clock.stage("retina", 0.01, True, calls),
+        ],
+        min_samples=3,
+        reorder_every=10,
+        explore_every=0,
+    )
+    for _ in range(10):
+        pipeline.run(None)
+    assert pipeline.stats()["order"] == ["deepface", "haar", "center_crop", "mediapipe", "retina"]
+
+
+def test_non_adaptive_run_keeps_configured_order(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [clock.stage("a", 0.5, True, calls), clock.stage("b", 0.01, True, calls)],
+        min_samples=1,
+        reorder_every=1,
+        explore_every=1,
+    )
+    for _ in range(5):
+        assert pipeline.run(None, adaptive=False) == ("a", "a")
+    assert calls == ["a"] * 5
+
+
+def test_deadline_stops_between_stages(monkeypatch):
+    clock = _Clock(monkeypatch)
+    calls: list[str] = []
+    pipeline = ExtractionPipeline(
+        "t",
+        [clock.stage("a", 0.2, False, calls), clock.stage("b", 0.2, True, calls)],
+        explore_every=0,
+    )
+    assert pipeline.run(None, deadline=0.1) == (None, None)
+    assert calls == ["a"]
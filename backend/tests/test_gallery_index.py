@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+
+from repositories import gallery_index
+from repositories.gallery_index import ClassGallery, GalleryMatrix, best_two_from_scores
+
+
+def _rows(rng, n: int, dim: int = 512) -> list[list[float]]:
+    return rng.standard_normal((n, dim)).astype(np.float32).tolist()
+
+
+def test_set_student_is_copy_on_write():
+    rng = np.random.default_rng(0)
+    gallery = ClassGallery({"a": _rows(rng, 2), "b": _rows(rng, 3)})
+    snapshot = gallery.matrix(512)
+    before = snapshot.matrix.copy()
+
+    gallery.set_student("c", _rows(rng, 1))
+    gallery.set_student("a", _rows(rng, 4))
+    gallery.drop_student("b")
+
+    # A reader holding the old matrix still sees the gallery as it was
+    assert snapshot.student_ids == ["a", "b"]
+    np.testing.assert_array_equal(snapshot.matrix, before)
+    assert gallery.counts() == {"c": 1, "a": 4}
+    assert gallery.student_count("b") == 0
+
+
+def test_set_student_moves_between_dims():
+    rng = np.random.default_rng(1)
+    gallery = ClassGallery({"a": _rows(rng, 2, 128), "b": _rows(rng, 1)})
+    gallery.set_student("a", _rows(rng, 1))
+    assert gallery.dims() == {512}
+    assert gallery.student_dim("a") == 512
+    gallery.drop_student("a")
+    gallery.drop_student("b")
+    assert gallery.dims() == set()
+
+
+def test_patch_and_drop_update_the_cached_gallery():
+    rng = np.random.default_rng(2)
+    key = ("user-patch", "class-patch")
+    gallery_index.put(*key, ClassGallery({"a": _rows(rng, 1)}), gallery_index.version(*key))
+    cached = gallery_index.get(*key)
+    snapshot = cached.matrix(512)
+
+    gallery_index.patch_student(*key, "b", _rows(rng, 2))
+    assert gallery_index.get(*key).counts() == {"a": 1, "b": 2}
+    assert snapshot.student_ids == ["a"]
+
+    gallery_index.drop_student(*key, "a")
+    assert gallery_index.get(*key).counts() == {"b": 2}
+    gallery_index.invalidate(*key)
+    assert gallery_index.get(*key) is None
+
+
+def test_put_rejects_a_load_that_raced_with_a_write():
+    rng = np.random.default_rng(3)
+    key = ("user-race", "class-race")
+    loaded_version = gallery_index.version(*key)
+    gallery_index.patch_student(*key, "a", _rows(rng, 1))
+    assert not gallery_index.put(*key, ClassGallery({"a": _rows(rng, 1)}), loaded_version)
+    assert gallery_index.get(*key) is None
+
+
+def _brute_force(items: dict[str, np.ndarray], query: np.ndarray, min_embeddings: int | None) -> dict[str, float]:
+    """The old per-student loop: best cosine per student, skipping students with too few rows."""
+    return {
+        sid: float(np.max(rows @ query))
+        for sid, rows in items.items()
+        if min_embeddings is None or rows.shape[0] >= min_embeddings
+    }
+
+
+def test_student_scores_match_brute_force():
+    rng = np.random.default_rng(4)
+    items = {f"s{i}": gallery_index.normalize_rows(_rows(rng, int(rng.integers(1, 6)))) for i in range(40)}
+    matrix = GalleryMatrix.build(512, list(items.items()), "none")
+    queries = gallery_index.normalize_rows(_rows(rng, 8))
+
+    for min_embeddings in (None, 3):
+        scores = matrix.student_scores(queries, min_embeddings)
+        assert scores.shape == (8, 40)
+        for q, row in zip(queries, scores):
+            expected = _brute_force(items, q, min_embeddings)
+            for i, sid in enumerate(matrix.student_ids):
+                if sid in expected:
+                    assert row[i] == pytest.approx(expected[sid], abs=1e-5)
+                else:
+                    assert row[i] == -np.inf
+            best = max(expected, key=expected.get)
+            best_id, best_sim, second_sim = best_two_from_scores(matrix.student_ids, row)
+            assert best_id == best
+            assert best_sim == pytest.approx(expected[best], abs=1e-5)
+            assert second_sim == pytest.approx(sorted(expected.values())[-2], abs=1e-5)
+
+
+def test_best_two_ignores_non_positive_scores():
+    assert best_two_from_scores(["a", "b"], np.array([-0.2, -0.1], dtype=np.float32)) == (None, 0.0, 0.0)
+    assert best_two_from_scores(["a", "b"], np.array([0.7, -0.1], dtype=np.float32)) == ("a", pytest.approx(0.7), 0.0)
+    assert best_two_from_scores([], np.zeros(0, dtype=np.float32)) == (None, 0.0, 0.0)
+
+
+def _query_near(rng, row: np.ndarray, cosine: float) -> np.ndarray:
+    """Unit query whose cosine with the unit `row` is exactly `cosine`."""
+    other = rng.standard_normal(row.shape[0]).astype(np.float64)
+    other -= (other @ row) * row
+    other /= np.linalg.norm(other)
+    return (cosine * row + np.sqrt(1 - cosine ** 2) * other).astype(np.float32)
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_quantized_scores_stay_within_their_bounds(quantization):
+    rng = np.random.default_rng(5)
+    items = [(f"s{i}", gallery_index.normalize_rows(_rows(rng, 3))) for i in range(30)]
+    quantized_matrix = GalleryMatrix.build(512, items, quantization)
+    queries = gallery_index.normalize_rows(_rows(rng, 16))
+    exact = GalleryMatrix.build(512, items, "none").student_scores(queries)
+    approx = quantized_matrix.student_scores(queries)
+    assert np.all(np.abs(exact - approx) <= quantized_matrix.student_bounds() + 1e-6)
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_quantized_decision_matches_exact_at_the_threshold(monkeypatch, quantization):
+    import asyncio
+    from api.routes import face
+    from config import SIMILARITY_THRESHOLD
+
+    rng = np.random.default_rng(7)
+    raw = {f"s{i}": _rows(rng, 2) for i in range(20)}
+    items = [(sid, gallery_index.normalize_rows(rows)) for sid, rows in raw.items()]
+    exact_matrix = GalleryMatrix.build(512, items, "none")
+    quantized_matrix = GalleryMatrix.build(512, items, quantization)
+
+    async def exact_rows(_user_id, _class_id, student_ids):
+        return {sid: raw[sid] for sid in student_ids}
+
+    monkeypatch.setattr(face, "aget_embeddings_for_students", exact_rows)
+
+    target = items[0][1][0]
+    # Straddle the threshold within the int8 error bound, where only the exact re-rank decides correctly
+    # (exactly on the threshold float32 rounding alone decides, quantized or not)
+    steps = np.linspace(0.0001, 0.004, 12)
+    for delta in np.concatenate([-steps, steps]):
+        query = _query_near(rng, target, SIMILARITY_THRESHOLD + delta)
+        exact = best_two_from_scores(exact_matrix.student_ids, exact_matrix.student_scores(query)[0])
+        scores = quantized_matrix.student_scores(query)[0]
+        refined = asyncio.run(face._exact_best_two("u", "c", quantized_matrix, query, scores, 512))
+        expected, got = face._decide_match(*exact, 512), face._decide_match(*refined, 512)
+        assert (got.student_id, got.matched) == (expected.student_id, expected.matched)
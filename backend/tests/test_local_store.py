@@ -0,0 +1,112 @@
+import json
+
+import numpy as np
+
+from repositories.local_store import LocalEmbeddingStore
+
+
+def _store(tmp_path, **kwargs) -> LocalEmbeddingStore:
+    return LocalEmbeddingStore(str(tmp_path / "embeddings.f32"), str(tmp_path / "embeddings.index.json"), **kwargs)
+
+
+def _vector(seed: int, dim: int = 512) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def test_add_remove_and_reopen(tmp_path):
+    store = _store(tmp_path)
+    store.add("u_c_a", _vector(0), 0.9, "t0")
+    store.add("u_c_a", _vector(1), 0.8, "t1")
+    store.add("u_c_b", _vector(2), 0.7, "t2")
+    store.remove_at("u_c_a", 0)
+
+    records = store.records("u_c_a")
+    assert [r["enrolledAt"] for r in records] == ["t1"]
+    np.testing.assert_array_equal(records[0]["embedding"], _vector(1))
+    assert store.counts("u_c_") == {"a": 1, "b": 1}
+
+    store.remove("u_c_b")
+    reopened = _store(tmp_path)
+    assert reopened.counts("u_c_") == {"a": 1}
+    np.testing.assert_array_equal(reopened.records("u_c_a")[0]["embedding"], _vector(1))
+
+
+def test_add_evicts_oldest_and_other_dims(tmp_path):
+    store = _store(tmp_path)
+    store.add("k", _vector(0, 128), 0.9, "old-model")
+    for i in range(3):
+        store.add("k", _vector(10 + i), 0.9, f"t{i}", max_per_key=2, replace_other_dims=True)
+    assert [r["enrolledAt"] for r in store.records("k")] == ["t1", "t2"]
+
+
+def test_imports_legacy_json_once(tmp_path):
+    legacy = tmp_path / "embeddings.json"
+    legacy.write_text(json.dumps({"u_c_a": [{"embedding": _vector(0).tolist(), "confidence": 0.9}]}))
+    store = _store(tmp_path, legacy_json_path=str(legacy))
+    np.testing.assert_allclose(store.records("u_c_a")[0]["embedding"], _vector(0))
+
+    legacy.write_text(json.dumps({}))
+    assert _store(tmp_path, legacy_json_path=str(legacy)).count("u_c_a") == 1
+
+
+def test_vectors_by_suffix_returns_views(tmp_path):
+    store = _store(tmp_path)
+    store.add("u_c_a", _vector(0), 0.9, "t0")
+    store.add("u_d_b", _vector(1), 0.9, "t1")
+    items = dict(store.vectors_by_suffix("u_c_"))
+    assert list(items) == ["a"]
+    np.testing.assert_array_equal(items["a"][0], _vector(0))
+    assert not items["a"][0].flags.writeable
+
+
+def test_second_store_replays_the_journal(tmp_path):
+    writer = _store(tmp_path)
+    reader = _store(tmp_path)
+    writer.add("k", _vector(0), 0.9, "t0")
+    writer.add("k", _vector(1), 0.9, "t1")
+    # The reader shares the files like another worker process and picks up the journal on its next read
+    assert [r["enrolledAt"] for r in reader.records("k")] == ["t0", "t1"]
+    writer.remove_at("k", 0)
+    assert reader.count("k") == 1
+
+
+def test_torn_journal_line_is_dropped(tmp_path):
+    store = _store(tmp_path)
+    store.add("k", _vector(0), 0.9, "t0")
+    with open(store.journal_path, "ab") as f:
+        f.write(b'{"op":"add","key":"k","ent')
+    reopened = _store(tmp_path)
+    assert reopened.count("k") == 1
+    reopened.add("k", _vector(1), 0.9, "t1")
+    assert [r["enrolledAt"] for r in _store(tmp_path).records("k")] == ["t0", "t1"]
+
+
+def test_concurrent_adds_are_all_committed(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    store = _store(tmp_path)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: store.add(f"k{i}", _vector(i), 0.9, str(i)), range(32)))
+    reopened = _store(tmp_path)
+    assert sum(reopened.counts("k").values()) == 32
+    for i in range(32):
+        np.testing.assert_array_equal(reopened.records(f"k{i}")[0]["embedding"], _vector(i))
+
+
+def test_compaction_folds_the_journal_and_drops_dead_rows(tmp_path):
+    store = _store(tmp_path)
+    other = _store(tmp_path)  # a worker that loaded the old generation
+    for i in range(10):
+        store.add("k", _vector(i), 0.9, str(i), max_per_key=10)
+    for _ in range(8):
+        store.remove_at("k", 0)
+    store.compact()
+
+    with open(store.journal_path, "rb") as f:
+        assert len(f.read().splitlines()) == 1  # header only
+    assert store._vectors_name != "embeddings.f32"
+    assert not (tmp_path / "embeddings.f32").exists()
+    for s in (store, other, _store(tmp_path)):
+        records = s.records("k")
+        assert [r["enrolledAt"] for r in records] == ["8", "9"]
+        np.testing.assert_array_equal(records[1]["embedding"], _vector(9))
@@ -0,0 +1,48 @@
+import threading
+
+import numpy as np
+import pytest
+
+from services.micro_batcher import MicroBatcher
+
+
+def _submit_concurrently(batcher: MicroBatcher, n: int) -> list:
+    results: list = [None] * n
+    start = threading.Barrier(n)
+
+    def call(i: int) -> None:
+        start.wait()
+        try:
+            results[i] = batcher.submit(np.full(4, i, dtype=np.float32), timeout=5)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_each_caller_gets_its_own_row():
+    batcher = MicroBatcher("t-rows", lambda batch: batch * 2, max_batch_size=8, max_wait_ms=50)
+    results = _submit_concurrently(batcher, 8)
+    for i, row in enumerate(results):
+        np.testing.assert_array_equal(row, np.full(4, 2 * i, dtype=np.float32))
+
+
+def test_short_output_fails_every_caller_instead_of_hanging():
+    batcher = MicroBatcher("t-short", lambda batch: batch[:-1], max_batch_size=4, max_wait_ms=50)
+    results = _submit_concurrently(batcher, 4)
+    # Nobody times out, and nobody is handed a row that may belong to another caller
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_run_batch_error_reaches_every_caller():
+    def fail(_batch):
+        raise ValueError("boom")
+
+    batcher = MicroBatcher("t-error", fail, max_batch_size=4, max_wait_ms=50)
+    with pytest.raises(ValueError):
+        batcher.submit(np.zeros(4, dtype=np.float32), timeout=5)
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from repositories import gallery_index, shared_gallery
+from repositories.gallery_index import ClassGallery, GalleryMatrix
+
+
+def _gallery(seed: int, students: int = 3, quantization: str = "none") -> ClassGallery:
+    rng = np.random.default_rng(seed)
+    rows = {f"s{i}": rng.standard_normal((i + 1, 512)).astype(np.float32).tolist() for i in range(students)}
+    items = [(sid, gallery_index.normalize_rows(r)) for sid, r in rows.items()]
+    return ClassGallery.from_matrices({512: GalleryMatrix.build(512, items, quantization)})
+
+
+@pytest.mark.parametrize("quantization", ["none", "float16", "int8"])
+def test_write_then_read_round_trips(tmp_path, quantization):
+    path = shared_gallery.segment_path(str(tmp_path), "user/1", "class 1")
+    gallery = _gallery(0, quantization=quantization)
+    shared_gallery.write(path, 7, gallery.matrices)
+
+    generation, _, matrices = shared_gallery.read(path)
+    assert generation == 7
+    assert shared_gallery.read_generation(path) == (7, True)
+    assert shared_gallery.list_segments(str(tmp_path)) == [("user/1", "class 1")]
+    mapped, original = matrices[512], gallery.matrix(512)
+    assert mapped.student_ids == original.student_ids
+    assert mapped.quantization == quantization
+    np.testing.assert_array_equal(mapped.offsets, original.offsets)
+    np.testing.assert_array_equal(mapped.matrix, original.matrix)
+    np.testing.assert_array_equal(mapped.student_bounds(), original.student_bounds())
+
+
+def test_invalid_marker_keeps_the_generation(tmp_path):
+    path = str(tmp_path / "u__c.gal")
+    assert shared_gallery.read_generation(path) == (0, False)
+    assert shared_gallery.signature(path) is None
+    shared_gallery.write(path, 3, _gallery(0).matrices)
+    signature = shared_gallery.signature(path)
+    shared_gallery.write(path, 4, None)
+    assert shared_gallery.read(path) is None
+    assert shared_gallery.read_generation(path) == (4, False)
+    assert shared_gallery.signature(path) != signature
+
+
+@pytest.fixture
+def shared_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(gallery_index, "GALLERY_SHARED_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _other_worker():
+    """Forget this process's mapped galleries, as if the next call ran in another worker."""
+    gallery_index._galleries.clear()
+
+
+def test_publish_is_seen_by_other_workers(shared_dir):
+    key = ("user-shared", "class-publish")
+    assert gallery_index.put(*key, _gallery(1), gallery_index.version(*key))
+    _other_worker()
+    gallery = gallery_index.get(*key)
+    assert gallery.counts() == {"s0": 1, "s1": 2, "s2": 3}
+    assert gallery.segment_signature == shared_gallery.signature(gallery_index._segment(key))
+
+
+def test_patch_bumps_the_generation_for_every_worker(shared_dir):
+    key = ("user-shared", "class-patch")
+    gallery_index.put(*key, _gallery(2), gallery_index.version(*key))
+    generation = shared_gallery.read_generation(gallery_index._segment(key))[0]
+    stale = gallery_index.get(*key)
+
+    gallery_index.patch_student(*key, "s3", np.ones((1, 512), dtype=np.float32).tolist())
+    gallery_index.drop_student(*key, "s0")
+    assert shared_gallery.read_generation(gallery_index._segment(key))[0] == generation + 2
+    # Mapped snapshots held by readers are not modified in place
+    assert stale.counts() == {"s0": 1, "s1": 2, "s2": 3}
+    _other_worker()
+    assert gallery_index.get(*key).counts() == {"s1": 2, "s2": 3, "s3": 1}
+
+
+def test_load_that_raced_with_another_worker_is_not_published(shared_dir):
+    key = ("user-shared", "class-race")
+    loaded_version = gallery_index.version(*key)
+    # Another worker writes to the class while this one is still loading it from storage
+    shared_gallery.write(gallery_index._segment(key), loaded_version[1] + 1, None)
+    assert not gallery_index.put(*key, _gallery(3), loaded_version)
+    assert gallery_index.get(*key) is None
@@ -0,0 +1,50 @@
+-- ย้าย face_embeddings.embedding จาก JSONB ไปเก็บแบบ binary (base64 ของ float32)
+-- วิธีใช้: ไปที่ Supabase Dashboard → SQL Editor → วาง script นี้ → Run
+--
+-- ลำดับการ deploy:
+-- 1. Run script นี้ (เพิ่มคอลัมน์ + backfill ข้อมูลเดิม) — backend เวอร์ชันเดิมยังทำงานได้ตามปกติ
+-- 2. Deploy backend ใหม่ (อ่าน embedding_f32, เขียนทั้ง binary และ JSONB)
+-- 3. เมื่อทุก instance เป็นเวอร์ชันใหม่แล้ว ตั้ง EMBEDDING_WRITE_JSONB=false เพื่อหยุดเขียน JSONB
+-- 4. (ไม่บังคับ) Run ส่วน "cleanup" ท้ายไฟล์เพื่อลบข้อมูล JSONB ที่ไม่ใช้แล้ว
+
+-- 1) คอลัมน์ใหม่
+ALTER TABLE public.face_embeddings ADD COLUMN IF NOT EXISTS embedding_f32 TEXT;
+ALTER TABLE public.face_embeddings ADD COLUMN IF NOT EXISTS embedding_dim SMALLINT;
+ALTER TABLE public.face_embeddings ADD COLUMN IF NOT EXISTS embedding_norm REAL;
+ALTER TABLE public.face_embeddings ADD COLUMN IF NOT EXISTS model_name TEXT;
+ALTER TABLE public.face_embeddings ALTER COLUMN embedding DROP NOT NULL;
+
+-- 2) Backfill: แปลง JSON array → float4send (big-endian) ต่อกัน → base64
+-- (encode() ขึ้นบรรทัดใหม่ทุก 76 ตัวอักษร จึงลบ newline ออก)
+UPDATE public.face_embeddings AS fe
+SET
+  embedding_f32 = v.encoded,
+  embedding_dim = v.dim,
+  embedding_norm = v.norm,
+  model_name = CASE v.dim
+    WHEN 512 THEN 'Facenet512'
+    WHEN 128 THEN 'Facenet'
+    WHEN 4096 THEN 'VGG-Face'
+  END
+FROM (
+  SELECT
+    id,
+    replace(encode(string_agg(float4send(x::float4), ''::bytea ORDER BY ord), 'base64'), E'\n', '') AS encoded,
+    count(*)::smallint AS dim,
+    sqrt(sum((x::float8) * (x::float8)))::real AS norm
+  FROM public.face_embeddings,
+    LATERAL jsonb_array_elements_text(embedding) WITH ORDINALITY AS e(x, ord)
+  WHERE embedding_f32 IS NULL AND embedding IS NOT NULL
+  GROUP BY id
+) AS v
+WHERE fe.id = v.id;
+
+-- ตรวจสอบ: ต้องได้ 0 แถว
+SELECT count(*) AS rows_without_binary
+FROM public.face_embeddings
+WHERE embedding_f32 IS NULL;
+
+-- ============================================
+-- cleanup (ไม่บังคับ): run หลังตั้ง EMBEDDING_WRITE_JSONB=false แล้วเท่านั้น
+-- ============================================
+-- UPDATE public.face_embeddings SET embedding = NULL WHERE embedding_f32 IS NOT NULL;
@@ -0,0 +1,61 @@
+-- ฟังก์ชัน enroll_face_embedding: ลงทะเบียนใบหน้า 1 รายการใน transaction เดียว (round trip เดียวจาก backend)
+-- วิธีใช้: ไปที่ Supabase Dashboard → SQL Editor → วาง script นี้ → Run
+-- ต้อง run scripts/migrate-face-embeddings-binary.sql ก่อน (ใช้คอลัมน์ embedding_f32/embedding_dim)
+--
+-- ภายใน transaction:
+-- 1. lock ต่อ (user, classroom, student) เพื่อไม่ให้ enroll พร้อมกันเกินจำนวนสูงสุด
+-- 2. ลบ embedding ของโมเดลอื่น (dim ไม่ตรง) ของนักเรียนคนนี้
+-- 3. ลบรายการเก่าสุดให้เหลือ p_max_per_student - 1 รายการ
+-- 4. insert รายการใหม่
+-- 5. คืน embedding ทั้งหมดของนักเรียน (เรียงตาม enrolled_at) ให้ backend อัปเดต gallery cache
+
+CREATE OR REPLACE FUNCTION public.enroll_face_embedding(
+  p_user_id UUID,
+  p_classroom_id UUID,
+  p_student_id UUID,
+  p_embedding_f32 TEXT,
+  p_embedding_dim SMALLINT,
+  p_embedding_norm REAL,
+  p_model_name TEXT,
+  p_confidence FLOAT,
+  p_embedding JSONB DEFAULT NULL,
+  p_max_per_student INT DEFAULT 5
+)
+RETURNS TABLE (id UUID, embedding_f32 TEXT, enrolled_at TIMESTAMPTZ)
+LANGUAGE plpgsql
+AS $$
+#variable_conflict use_column
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtextextended(p_user_id::text || ':' || p_classroom_id::text || ':' || p_student_id::text, 0));
+
+  DELETE FROM public.face_embeddings AS fe
+  WHERE fe.user_id = p_user_id
+    AND fe.classroom_id = p_classroom_id
+    AND fe.student_id = p_student_id
+    AND coalesce(fe.embedding_dim, jsonb_array_length(fe.embedding)) IS DISTINCT FROM p_embedding_dim;
+
+  DELETE FROM public.face_embeddings AS fe
+  WHERE fe.id IN (
+    SELECT old.id
+    FROM public.face_embeddings AS old
+    WHERE old.user_id = p_user_id
+      AND old.classroom_id = p_classroom_id
+      AND old.student_id = p_student_id
+    ORDER BY old.enrolled_at DESC
+    OFFSET greatest(p_max_per_student - 1, 0)
+  );
+
+  INSERT INTO public.face_embeddings
+    (user_id, classroom_id, student_id, embedding, embedding_f32, embedding_dim, embedding_norm, model_name, confidence)
+  VALUES
+    (p_user_id, p_classroom_id, p_student_id, p_embedding, p_embedding_f32, p_embedding_dim, p_embedding_norm, p_model_name, p_confidence);
+
+  RETURN QUERY
+  SELECT fe.id, fe.embedding_f32, fe.enrolled_at
+  FROM public.face_embeddings AS fe
+  WHERE fe.user_id = p_user_id
+    AND fe.classroom_id = p_classroom_id
+    AND fe.student_id = p_student_id
+  ORDER BY fe.enrolled_at ASC;
+END;
+$$;
@@ -103,10 +103,15 @@ CREATE TABLE IF NOT EXISTS public.face_embeddings (
   user_id UUID NOT NULL REFERENCES auth.users(id) ON DELETE CASCADE,
   classroom_id UUID NOT NULL REFERENCES classrooms(id) ON DELETE CASCADE,
   student_id UUID NOT NULL REFERENCES students(id) ON DELETE CASCADE,
-  embedding JSONB NOT NULL, -- เก็บเป็น JSON array ของ numbers
+  embedding JSONB, -- (เดิม) JSON array ของ numbers — ใช้ระหว่าง migrate เท่านั้น
+  embedding_f32 TEXT, -- base64 ของ float32 big-endian (float4send) — backend อ่านคอลัมน์นี้
+  embedding_dim SMALLINT,
+  embedding_norm REAL,
+  model_name TEXT,
   confidence FLOAT NOT NULL,
   enrolled_at TIMESTAMPTZ DEFAULT NOW()
 );
+-- enroll แบบ round trip เดียว: run scripts/migrate-face-embeddings-enroll-rpc.sql (ฟังก์ชัน enroll_face_embedding)
 
 -- ============================================
 -- Indexes สำหรับ Performance